@@ -1,135 +1,298 @@
-import subprocess
-import threading
 import streamlit as st
-import speech_recognition as sr
-import pyttsx3
 import time
-import pyperclip  # For Copy Output functionality
+import uuid
+from collections import deque
+from itertools import islice
+
+from backend_pool import make_backend
+from cancellation import CancelToken
+from conversation_context import ConversationContext
+from conversation_store import StoredTurn, get_conversation_store
+from document_index import augment, get_document_index
+from metrics import RequestTrace
+from model_router import get_router
+from ollama_backend import start_warm_up
+from response_cache import get_response_cache
+from scheduler import describe_wait, get_scheduler
+from stt_worker import get_speech_input
+from think_parser import ANSWER, ThinkStreamParser
+from tts_worker import get_speech_pipeline
+
+MAX_STORED_TURNS = 200   # Turns kept in memory per session; older ones stay in the store
+VISIBLE_TURNS = 20       # Turns rendered per rerun ("Show earlier" widens the window)
+RENDER_INTERVAL = 0.05   # Seconds between placeholder updates while streaming
+
 
 class DeepSeekChatbot:
+    """
+    Process-wide resources (backend client, scheduler, cache, speech), created
+    once via `get_chatbot` and shared by every session; per-session state
+    lives in `st.session_state`.
+    """
+
     def __init__(self):
-        self.latest_response = ""  # Reset before new response
-        self.is_muted = False  # Track mute state
-        self.speech_thread = None  # Store the speech thread
+        self.speech = get_speech_pipeline()  # Persistent TTS engine on its own thread
+        self.speech_input = get_speech_input()  # Streaming speech recognition on one microphone stream
+        self.backend = make_backend()  # One Ollama host, or a balanced pool (OLLAMA_HOSTS)
+        self.router = get_router()  # Picks a deepseek-r1 size per prompt
+        self.scheduler = get_scheduler()  # Shared by every Streamlit session in this process
+        self.response_cache = get_response_cache()  # Replays answers to repeated prompts
+        self.conversation_store = get_conversation_store()  # Conversations survive restarts
 
     def toggle_speaker(self):
         """Toggle between mute and speaker functionality."""
-        if self.is_muted:
-            self.is_muted = False
-            if self.latest_response:
+        if st.session_state.is_muted:
+            st.session_state.is_muted = False
+            self.speech.unmute()
+            if st.session_state.latest_response:
                 self.speak_output()  # Speak the latest response
         else:
-            self.is_muted = True
-            if self.speech_thread and self.speech_thread.is_alive():
-                self.stop_speech()  # Stop speaking
+            st.session_state.is_muted = True
+            self.speech.mute()  # Stop speaking
 
     def stop_speech(self):
         """Stop the speech synthesis."""
-        if self.speech_thread:
-            self.speech_thread.join()  # Wait for the speech thread to finish
+        self.speech.stop()
 
     def run_deepseek(self, prompt):
-        """Run DeepSeek model and process the output."""
+        """
+        Run DeepSeek model and stream the output into this turn's placeholders.
+        A Streamlit rerun (e.g. the Stop button) interrupts the loop; the
+        partial answer is kept as a stopped turn.
+        """
         st.session_state.status = "Generating..."
-        try:
-            self.process = subprocess.Popen(
-                ["ollama", "run", "deepseek-r1:8b"],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-
-            # Send user input to DeepSeek
-            self.process.stdin.write(prompt + "\n")
-            self.process.stdin.flush()
-            self.process.stdin.close()
-
-            # Read output in real-time
-            response = ""
-            for line in iter(self.process.stdout.readline, ""):
-                response += line
-                st.session_state.chat_history.append(f"🤖 Bot: {line.strip()}")
-
-            self.latest_response = response.strip()  # Store response for speech output
-            st.session_state.chat_history.append(f"🤖 Bot: {self.latest_response}")
-            st.session_state.status = "Idle"
+        conversation = st.session_state.conversation
+        cancel_token = st.session_state.cancel_token = CancelToken()
+        ticket = None
+        stream = None
+        completed = False
+        model = self.router.route(prompt)
+        # Passages from the local document folder (if configured) go into the model's prompt
+        # and skip near-duplicate matching, where the passages would dominate the comparison
+        model_prompt, sources = augment(prompt)
+        trace = RequestTrace("streamlit", model)
+        status = "cancelled"
+        parser = ThinkStreamParser()
+        note = "🛑 Stopped"
+        with st.chat_message("assistant"):
+            if sources:
+                st.caption(f"📚 Sources: {', '.join(sources)}")
+            status_box = st.empty()
+            reasoning_box = st.expander("💭 Reasoning", expanded=False).empty()
+            answer_box = st.empty()
+            try:
+                # Send user input to DeepSeek (cached answers are replayed)
+                stream = self.response_cache.generate(
+                    self.backend, standalone=not (conversation.turns or sources),
+                    cancel_token=cancel_token, **conversation.request(model_prompt, model))
+
+                # Wait for a free generation slot
+                if not stream.cached:
+                    trace.queued()
+                    ticket = self.scheduler.submit(st.session_state.client_id, model, cancel_token=cancel_token)
+                    while not ticket.wait(timeout=1.0):
+                        if ticket.cancelled:
+                            return
+                        smaller = self.router.fallback(ticket)
+                        if smaller:
+                            # Queued past the latency target: move to the smaller model
+                            ticket.release()
+                            model = smaller
+                            trace.rerouted(model)
+                            stream = self.response_cache.generate(
+                                self.backend, bypass=True, standalone=not (conversation.turns or sources),
+                                cancel_token=cancel_token, **conversation.request(model_prompt, model))
+                            ticket = self.scheduler.submit(st.session_state.client_id, model,
+                                                           cancel_token=cancel_token)
+                        status_box.info(describe_wait(ticket))
+                    status_box.empty()
+                    trace.admitted()
+
+                # Stream into the placeholders; reasoning is kept out of speech
+                utterance = None if st.session_state.is_muted else self.speech.begin(on_start=trace.tts_started)
+                if utterance:
+                    cancel_token.on_cancel(lambda: self.speech.cancel(utterance))
+                last_render = 0.0
+                for chunk in stream:
+                    trace.token()
+                    for channel, text in parser.feed(chunk):
+                        if utterance and channel == ANSWER:
+                            self.speech.feed(text, utterance)  # Speak sentences as they complete
+                    now = time.perf_counter()
+                    if now - last_render >= RENDER_INTERVAL:
+                        # One delta per interval, not per token
+                        self._render(reasoning_box, answer_box, parser, trace, cursor=True)
+                        last_render = now
+                parser.flush()
+                if cancel_token.cancelled:
+                    return
+                if utterance:
+                    self.speech.flush(utterance)
+                self._render(reasoning_box, answer_box, parser, trace)
+
+                st.session_state.latest_response = parser.answer.strip()  # Store answer for speech output
+                conversation.add_turn(prompt, parser.answer, stream.context, model)
+                completed = True
+                note = ""
+                status = "ok"
 
+            except Exception as e:
+                status = "error"
+                note = f"❌ Error: {e}"
+                status_box.error(note)
+            finally:
+                if not completed:
+                    # Stopped, failed or interrupted by a Streamlit rerun
+                    cancel_token.cancel()
+                if ticket:
+                    ticket.release()
+                trace.finish(status, stream)
+                self.router.record(trace, status)
+                self.save_turn(prompt, parser, note, stream.context if completed else None, model)
+                st.session_state.status = "Idle" if status != "error" else "Error"
+
+    def save_turn(self, prompt, parser, note, context=None, model=None):
+        """Store a turn and keep it in the session's in-memory window."""
+        answer, reasoning = parser.answer.strip(), parser.reasoning.strip()
+        seq = None
+        try:
+            if st.session_state.conversation_id is None:
+                st.session_state.conversation_id = self.conversation_store.create("streamlit")
+                st.query_params["c"] = st.session_state.conversation_id  # Reopened on reload
+            seq = self.conversation_store.append_turn(
+                st.session_state.conversation_id, prompt, answer, reasoning, note, context, model)
         except Exception as e:
-            st.session_state.chat_history.append(f"❌ Error: {e}")
-            st.session_state.status = "Error"
+            print(f"[DEBUG] Could not save turn: {e}")
+        st.session_state.turns.append(StoredTurn(seq, prompt, answer, reasoning, note, time.time()))
+
+    def load_earlier(self):
+        """Fetch the previous page of stored turns into the session window."""
+        turns = st.session_state.turns
+        if not turns or turns[0].seq is None or st.session_state.conversation_id is None:
+            return 0
+        page = self.conversation_store.load_page(st.session_state.conversation_id, before=turns[0].seq)
+        # The bound grows by the page asked for; new turns push the oldest out again
+        st.session_state.turns = deque([*page, *turns], maxlen=turns.maxlen + len(page))
+        return len(page)
+
+    def _render(self, reasoning_box, answer_box, parser, trace, cursor=False):
+        started = time.perf_counter()
+        if parser.reasoning:
+            reasoning_box.markdown(parser.reasoning)
+        if parser.answer:
+            answer_box.markdown(parser.answer + ("▌" if cursor else ""))
+        trace.add_render(time.perf_counter() - started)
 
     def speak_output(self):
         """Convert latest response to speech without UI lag"""
-        if self.latest_response and not self.is_muted:  # Check if not muted
-            def speak_text():
-                engine = pyttsx3.init()
-                engine.setProperty('rate', 150)  # Adjust speech speed
-                engine.say(self.latest_response)
-                engine.runAndWait()
-
-            # Run speech synthesis in a separate thread
-            self.speech_thread = threading.Thread(target=speak_text, daemon=True)
-            self.speech_thread.start()
+        if st.session_state.latest_response and not st.session_state.is_muted:  # Check if not muted
+            self.speech.speak(st.session_state.latest_response)
 
     def start_voice_input(self):
         """Convert speech to text & update input box"""
-        recognizer = sr.Recognizer()
-        with sr.Microphone() as source:
-            try:
-                # Adjust for ambient noise (helps in noisy environments)
-                recognizer.adjust_for_ambient_noise(source, duration=1)
-
-                # Capture audio with a timeout
-                audio = recognizer.listen(source, timeout=5, phrase_time_limit=10)
-
-                # Convert speech to text
-                text = recognizer.recognize_google(audio)
-                return text
-
-            except sr.UnknownValueError:
-                return "❌ Couldn't recognize speech."
-            except sr.RequestError:
-                return "❌ Speech service unavailable."
-            except sr.WaitTimeoutError:
-                return "❌ No speech detected. Try again."
-            except Exception as e:
-                return f"❌ Error: {e}"
+        # Recognized while recording; ends as soon as the user stops speaking
+        return self.speech_input.recognize_prompt()
 
-# Initialize the chatbot
-chatbot = DeepSeekChatbot()
 
-# Streamlit UI
-st.title("AI Chatbot")
-st.sidebar.title("Options")
+def render_turn(turn: StoredTurn):
+    """Render one stored turn."""
+    with st.chat_message("user"):
+        st.write(turn.prompt)
+    with st.chat_message("assistant"):
+        if turn.reasoning:
+            with st.expander("💭 Reasoning", expanded=False):
+                st.markdown(turn.reasoning)
+        if turn.answer:
+            st.markdown(turn.answer)
+        if turn.note:
+            st.caption(turn.note)
+
+
+@st.cache_resource
+def get_chatbot() -> DeepSeekChatbot:
+    """Created once per server process, not on every rerun."""
+    chatbot = DeepSeekChatbot()
+    start_warm_up(chatbot.backend, *chatbot.router.models)   # Load the models in the background
+    get_document_index()   # Start indexing CHATBOT_DOCS, if set
+    return chatbot
+
+
+# Initialize the chatbot
+chatbot = get_chatbot()
 
 # Initialize session state
-if 'chat_history' not in st.session_state:
-    st.session_state.chat_history = []
+if 'conversation' not in st.session_state:
+    st.session_state.conversation = ConversationContext()
+if 'turns' not in st.session_state:
+    # Reopen the conversation named in the URL, loading only its latest page
+    st.session_state.turns = deque(maxlen=MAX_STORED_TURNS)
+    st.session_state.conversation_id = None
+    conversation_id = st.query_params.get("c")
+    if conversation_id and chatbot.conversation_store.exists(conversation_id):
+        st.session_state.conversation_id = conversation_id
+        st.session_state.turns = deque(chatbot.conversation_store.resume(
+            conversation_id, st.session_state.conversation), maxlen=MAX_STORED_TURNS)
+if 'visible_turns' not in st.session_state:
+    st.session_state.visible_turns = VISIBLE_TURNS
+if 'client_id' not in st.session_state:
+    st.session_state.client_id = uuid.uuid4().hex
+if 'cancel_token' not in st.session_state:
+    st.session_state.cancel_token = None
 if 'status' not in st.session_state:
     st.session_state.status = "Idle"
+if 'latest_response' not in st.session_state:
+    st.session_state.latest_response = ""
+if 'is_muted' not in st.session_state:
+    st.session_state.is_muted = False
 
-# Display chat history
-for message in st.session_state.chat_history:
-    st.write(message)
+# Streamlit UI
+st.title("AI Chatbot")
+st.sidebar.title("Options")
 
-# User input
-user_input = st.text_input("You:", "")
-if st.button("Send"):
-    if user_input:
-        st.session_state.chat_history.append(f"🧑‍💻 You: {user_input}")
-        chatbot.run_deepseek(user_input)
+# Controls live in the sidebar so they are handled before any new generation starts.
+# Stop button: cancels this session's generation (stream, queue slot and speech)
+if st.sidebar.button("🛑 Stop"):
+    if st.session_state.cancel_token:
+        st.session_state.cancel_token.cancel()
+        st.session_state.status = "Idle"
 
 # Speaker button
-if st.button("🔊" if not chatbot.is_muted else "🔇"):
+if st.sidebar.button("🔊" if not st.session_state.is_muted else "🔇"):
     chatbot.toggle_speaker()
 
 # Voice input button
-if st.button("🎙️ Start Voice Input"):
-    voice_input = chatbot.start_voice_input()
-    if voice_input:
-        st.session_state.chat_history.append(f"🧑‍💻 You: {voice_input}")
-        chatbot.run_deepseek(voice_input)
+voice_prompt = None
+if st.sidebar.button("🎙️ Start Voice Input"):
+    voice_prompt = chatbot.start_voice_input()
+    if voice_prompt.startswith("❌"):
+        st.sidebar.warning(voice_prompt)
+        voice_prompt = None
 
 # Status display
-st.sidebar.write(f"Status: {st.session_state.status}")
\ No newline at end of file
+status_display = st.sidebar.empty()
+status_display.write(f"Status: {st.session_state.status}")
+
+# Display only the most recent turns, so rerun cost stays flat as history grows
+turns = st.session_state.turns
+hidden = len(turns) - st.session_state.visible_turns
+has_older = hidden > 0 or bool(
+    turns and turns[0].seq and st.session_state.conversation_id
+    and chatbot.conversation_store.has_older(st.session_state.conversation_id, turns[0].seq))
+if has_older and st.button("Show earlier"):
+    if hidden <= 0:
+        hidden += chatbot.load_earlier()
+        turns = st.session_state.turns
+    st.session_state.visible_turns += VISIBLE_TURNS
+    hidden -= VISIBLE_TURNS
+for turn in islice(turns, max(hidden, 0), None):
+    render_turn(turn)
+
+# User input
+prompt = st.chat_input("You:") or voice_prompt
+if prompt:
+    st.session_state.visible_turns = VISIBLE_TURNS
+    with st.chat_message("user"):
+        st.write(prompt)
+    status_display.write("Status: Generating...")
+    chatbot.run_deepseek(prompt)
+    status_display.write(f"Status: {st.session_state.status}")
@@ -0,0 +1,387 @@
+import asyncio
+import json
+import os
+import threading
+import time
+
+from ollama_backend import DEFAULT_HOST, DEFAULT_KEEP_ALIVE, DEFAULT_MODEL, OllamaBackend, OllamaError
+
+# =============================================================================
+# Asyncio Generation Engine
+# =============================================================================
+#
+# OllamaBackend blocks one OS thread per stream on a socket read. This engine
+# runs every stream as a task on a single event loop instead, speaking
+# HTTP/1.1 to Ollama over asyncio streams. Body bytes are decoded as soon as
+# they arrive, without waiting for line or buffer boundaries, and hundreds of
+# concurrent generations cost one thread between them.
+#
+# Streams are pulled, not pushed: the socket is only read when the consumer
+# asks for the next chunk, so a slow consumer pushes back on the server
+# through TCP flow control instead of filling a buffer. At most MAX_STREAMS
+# requests are open per loop; the rest wait for a slot.
+#
+# Two APIs share the same code:
+#   * async:  `async for text in engine.agenerate(prompt): ...` on any loop
+#             (e.g. an async Gradio handler);
+#   * sync:   `engine.generate(...)` returns a GenerationStream-compatible
+#             iterator driven on the engine's own loop thread, so the
+#             engine is a drop-in backend for the Tk, Streamlit and Gradio
+#             apps (CHATBOT_ENGINE=async, see backend_pool.make_backend).
+
+MAX_STREAMS = int(os.environ.get("CHATBOT_ENGINE_STREAMS", "256"))   # Open requests per event loop
+READ_SIZE = 64 * 1024
+
+
+class _LoopState:
+    """Per-event-loop connection pool and stream slots (asyncio objects can't cross loops)."""
+
+    def __init__(self, max_streams: int):
+        self.idle = []            # Keep-alive (reader, writer) pairs, most recent last
+        self.slots = asyncio.Semaphore(max_streams)
+
+
+class _Body:
+    """Reads an HTTP/1.1 response body (chunked, sized or until close) as bytes arrive."""
+
+    def __init__(self, reader, headers: dict, timeout: float):
+        self.reader = reader
+        self.timeout = timeout
+        self.chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        self.sized = not self.chunked and "content-length" in headers
+        self.remaining = int(headers["content-length"]) if self.sized else 0
+        self.complete = self.sized and self.remaining == 0
+
+    async def _wait(self, awaitable):
+        return await asyncio.wait_for(awaitable, self.timeout)
+
+    async def read(self) -> bytes:
+        """The next bytes of the body, or b"" once it is complete."""
+        if self.complete:
+            return b""
+        if self.chunked and not self.remaining:
+            line = await self._wait(self.reader.readline())
+            if not line:
+                raise asyncio.IncompleteReadError(b"", None)
+            size = int(line.split(b";")[0].strip() or b"0", 16)
+            if not size:
+                while (await self._wait(self.reader.readline())).strip():
+                    pass   # Trailers
+                self.complete = True
+                return b""
+            self.remaining = size
+        limit = min(self.remaining, READ_SIZE) if (self.chunked or self.sized) else READ_SIZE
+        data = await self._wait(self.reader.read(limit))
+        if not data:
+            if self.chunked or self.sized:
+                raise asyncio.IncompleteReadError(b"", None)
+            self.complete = True   # Body delimited by the server closing the connection
+            return b""
+        if self.chunked or self.sized:
+            self.remaining -= len(data)
+            if self.chunked and not self.remaining:
+                await self._wait(self.reader.readexactly(2))   # CRLF after the chunk
+            elif self.sized and not self.remaining:
+                self.complete = True
+        return data
+
+    async def text(self) -> str:
+        parts = []
+        while True:
+            data = await self.read()
+            if not data:
+                return b"".join(parts).decode("utf-8", "replace")
+            parts.append(data)
+
+
+class AsyncGeneration:
+    """
+    Async iterable over the text chunks of one streamed generation. Like
+    GenerationStream, `final`, `done` and `timings` are filled in as it runs.
+    `close()` may be called from any thread to abort the request.
+    """
+
+    def __init__(self, engine, path: str, payload: dict, field: str):
+        self._engine = engine
+        self._path = path
+        self._payload = payload
+        self._field = field
+        self._loop = None
+        self._writer = None
+        self._closed = False
+        self.done = False
+        self.final = {}
+        self.timings = {}
+
+    @property
+    def context(self):
+        return self.final.get("context")
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _open(self, state):
+        """Send the request, retrying once if a pooled connection has gone stale."""
+        engine = self._engine
+        body = json.dumps(self._payload).encode("utf-8")
+        request = (f"POST {self._path} HTTP/1.1\r\nHost: {engine.pool.hostname}:{engine.pool.port}\r\n"
+                   f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                   f"Connection: keep-alive\r\n\r\n").encode("ascii") + body
+        while True:
+            reused = bool(state.idle)
+            if reused:
+                reader, writer = state.idle.pop()
+                self.timings["connect"] = 0.0
+            else:
+                started = time.perf_counter()
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(engine.pool.hostname, engine.pool.port), engine.timeout)
+                self.timings["connect"] = time.perf_counter() - started
+            # Published before waiting for the response so close() can abort a slow model load
+            self._writer = writer
+            try:
+                writer.write(request)
+                await writer.drain()
+                status, headers = await self._read_head(reader)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self._writer = None
+                writer.close()
+                if reused and not self._closed:
+                    continue
+                raise
+            except BaseException:
+                self._writer = None
+                writer.close()
+                raise
+            return reader, writer, status, headers
+
+    async def _read_head(self, reader):
+        timeout = self._engine.timeout
+        line = await asyncio.wait_for(reader.readline(), timeout)
+        if not line:
+            raise ConnectionResetError("Ollama closed the connection")
+        status = int(line.split()[1])
+        headers = {}
+        while True:
+            line = await asyncio.wait_for(reader.readline(), timeout)
+            if not line.strip():
+                return status, headers
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+    def _field_text(self, obj: dict) -> str:
+        if self._field == "message":
+            return (obj.get("message") or {}).get("content", "")
+        return obj.get(self._field, "")
+
+    def _parse(self, line: bytes):
+        """Text of one NDJSON status object (None for a blank line)."""
+        line = line.strip()
+        if not line:
+            return None
+        obj = json.loads(line)
+        if "error" in obj:
+            raise OllamaError(obj["error"])
+        if obj.get("done"):
+            self.final = obj
+            self.done = True
+        return self._field_text(obj)
+
+    async def _chunks(self):
+        if self._closed:
+            return
+        self._loop = asyncio.get_running_loop()
+        state = self._engine._state()
+        async with state.slots:
+            try:
+                reader, writer, status, headers = await self._open(state)
+            except (OSError, asyncio.IncompleteReadError):
+                if self._closed:
+                    return
+                raise
+            if self._closed:
+                # Cancelled while connecting; don't wait for the first token
+                self._abort()
+            body = _Body(reader, headers, self._engine.timeout)
+            try:
+                if status != 200:
+                    detail = await body.text()
+                    try:
+                        detail = json.loads(detail).get("error", detail)
+                    except ValueError:
+                        pass
+                    raise OllamaError(f"Ollama returned HTTP {status}: {detail}", status)
+                pending = b""
+                while not self.done and not self._closed:
+                    data = await body.read()
+                    if not data:
+                        break
+                    *lines, pending = (pending + data).split(b"\n")
+                    for line in lines:
+                        text = self._parse(line)
+                        if text:
+                            yield text
+                        if self.done:
+                            break
+                if not self.done and not self._closed:
+                    text = self._parse(pending)   # A last object without a newline
+                    if text:
+                        yield text
+                if not self.done and not self._closed:
+                    raise ConnectionResetError("Ollama closed the connection mid-response")
+            except asyncio.IncompleteReadError as e:
+                if not self._closed:
+                    raise ConnectionResetError("Ollama closed the connection mid-response") from e
+            except (OSError, ValueError):
+                if not self._closed:
+                    raise
+            finally:
+                await self._finish(state, body, headers, reader, writer)
+
+    async def _finish(self, state, body, headers, reader, writer):
+        self._writer = None
+        # Only a fully drained response leaves the connection reusable
+        reusable = not self._closed and (self.done or body.complete) \
+            and (body.chunked or body.sized) and headers.get("connection", "").lower() != "close"
+        if reusable:
+            try:
+                while await body.read():
+                    pass
+            except (OSError, asyncio.IncompleteReadError):
+                reusable = False
+        if reusable and len(state.idle) < self._engine.pool.maxsize:
+            state.idle.append((reader, writer))
+        else:
+            writer.close()
+
+    def _abort(self):
+        writer = self._writer
+        if writer is not None:
+            writer.transport.abort()
+
+    def close(self):
+        """Abort the generation; Ollama stops generating once the socket closes."""
+        self._closed = True
+        loop = self._loop
+        if loop is not None and not loop.is_closed():
+            loop.call_soon_threadsafe(self._abort)
+
+
+async def _next(chunks):
+    return await chunks.__anext__()
+
+
+class SyncStream:
+    """
+    GenerationStream-compatible iterator over an AsyncGeneration that runs on
+    the engine's loop thread. Each chunk is fetched when it is asked for.
+    """
+
+    def __init__(self, engine, generation: AsyncGeneration, cancel_token=None):
+        self._engine = engine
+        self._generation = generation
+        if cancel_token is not None:
+            cancel_token.on_cancel(self.close)
+
+    done = property(lambda self: self._generation.done)
+    final = property(lambda self: self._generation.final)
+    timings = property(lambda self: self._generation.timings)
+    context = property(lambda self: self._generation.context)
+
+    def __iter__(self):
+        loop = self._engine.loop
+        chunks = self._generation.__aiter__()
+        try:
+            while True:
+                try:
+                    yield asyncio.run_coroutine_threadsafe(_next(chunks), loop).result()
+                except StopAsyncIteration:
+                    return
+        finally:
+            # Also runs when the caller stops iterating early: releases the connection and slot
+            asyncio.run_coroutine_threadsafe(chunks.aclose(), loop).result()
+
+    def close(self):
+        self._generation.close()
+
+
+class AsyncOllamaEngine(OllamaBackend):
+    """
+    Ollama client that multiplexes every stream on an event loop. Offers
+    `agenerate`/`achat` for asyncio code and the OllamaBackend interface
+    (`generate`, `chat`, `warm_up`, ...) for threaded callers.
+    """
+
+    def __init__(self, model: str = DEFAULT_MODEL, host: str = DEFAULT_HOST,
+                 keep_alive=DEFAULT_KEEP_ALIVE, pool_size: int = 32,
+                 timeout: float = 300.0, options: dict = None, max_streams: int = MAX_STREAMS):
+        super().__init__(model, host, keep_alive, pool_size, timeout, options)
+        self.timeout = timeout
+        self.max_streams = max_streams
+        self._states = {}         # Event loop -> _LoopState
+        self._lock = threading.Lock()
+        self._loop = None
+        self._thread = None
+
+    def _state(self) -> _LoopState:
+        loop = asyncio.get_running_loop()
+        state = self._states.get(loop)
+        if state is None:
+            with self._lock:
+                for closed in [other for other in self._states if other.is_closed()]:
+                    del self._states[closed]   # e.g. left behind by asyncio.run
+                state = self._states.setdefault(loop, _LoopState(self.max_streams))
+        return state
+
+    @property
+    def loop(self):
+        """The engine's own event loop, started on a daemon thread on first use."""
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever,
+                                                name="ollama-engine", daemon=True)
+                self._thread.start()
+            return self._loop
+
+    # ---- Async API ---------------------------------------------------------
+
+    def agenerate(self, prompt: str, model: str = None, context=None,
+                  options: dict = None, **extra) -> AsyncGeneration:
+        """Stream a completion from /api/generate: `async for text in engine.agenerate(...)`."""
+        payload = self._payload(model, options, extra)
+        payload["prompt"] = prompt
+        if context:
+            payload["context"] = context
+        return AsyncGeneration(self, "/api/generate", payload, "response")
+
+    def achat(self, messages: list, model: str = None, options: dict = None,
+              **extra) -> AsyncGeneration:
+        """Stream an assistant reply from /api/chat."""
+        payload = self._payload(model, options, extra)
+        payload["messages"] = messages
+        return AsyncGeneration(self, "/api/chat", payload, "message")
+
+    # ---- Sync bridge -------------------------------------------------------
+
+    def generate(self, prompt: str, model: str = None, context=None,
+                 options: dict = None, cancel_token=None, **extra) -> SyncStream:
+        """Stream a completion from /api/generate, driven on the engine's loop."""
+        return SyncStream(self, self.agenerate(prompt, model, context, options, **extra), cancel_token)
+
+    def chat(self, messages: list, model: str = None, options: dict = None,
+             cancel_token=None, **extra) -> SyncStream:
+        """Stream an assistant reply from /api/chat, driven on the engine's loop."""
+        return SyncStream(self, self.achat(messages, model, options, **extra), cancel_token)
+
+    def close(self):
+        """Close pooled connections on the engine's loop."""
+        super().close()
+        if self._loop is None:
+            return
+
+        async def close_idle():
+            state = self._states.pop(self._loop, None)
+            for _, writer in state.idle if state else ():
+                writer.close()
+        asyncio.run_coroutine_threadsafe(close_idle(), self._loop).result()
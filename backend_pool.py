@@ -0,0 +1,261 @@
+import http.client
+import itertools
+import os
+import threading
+
+from metrics import get_metrics
+from ollama_backend import (DEFAULT_HOST, DEFAULT_KEEP_ALIVE, DEFAULT_MODEL, OllamaBackend,
+                            OllamaError)
+
+# =============================================================================
+# Multi-Host Load Balancing
+# =============================================================================
+#
+# Spreads generations across several Ollama servers (OLLAMA_HOSTS, comma
+# separated), so throughput isn't capped by one machine's CPU. Each request
+# goes to the healthy host with the lowest score. The score is the host's
+# outstanding requests, plus a penalty if the requested model isn't already
+# resident there, since loading a model costs more than waiting behind a
+# request or two.
+#
+# A background thread polls every host's /api/ps. This refreshes the
+# resident models, evicts hosts after repeated failures and re-admits them
+# once they answer again. If a stream fails before its first token because
+# of a connection error or a 5xx response, it is retried on another host,
+# invisibly to the caller. Rejected requests (4xx) and failures after text has
+# been streamed are raised as usual and don't count against the host.
+
+HOSTS = [h.strip() for h in os.environ.get("OLLAMA_HOSTS", "").split(",") if h.strip()]
+ENGINE = os.environ.get("CHATBOT_ENGINE", "threads")   # "async" multiplexes streams on one event loop
+HEALTH_INTERVAL = 10.0       # Seconds between health checks
+HEALTH_TIMEOUT = 2.0
+EVICT_AFTER = 2              # Consecutive failures before a host is taken out of rotation
+READMIT_AFTER = 2            # Consecutive successful checks before it is put back
+COLD_PENALTY = 2             # Score added when the model would have to be loaded first
+
+
+class _Host:
+    """One Ollama server and what the balancer knows about it."""
+
+    def __init__(self, backend: OllamaBackend):
+        self.backend = backend
+        self.url = backend.host
+        self.outstanding = 0      # Requests streaming from this host
+        self.healthy = True
+        self.failures = 0         # Consecutive failed checks or streams
+        self.successes = 0        # Consecutive successful checks while evicted
+        self.resident = set()     # Models loaded in the server's memory
+
+
+def _host_fault(error) -> bool:
+    """
+    Whether a failed request says something about the host: connection errors
+    and 5xx responses do, a rejected request (e.g. 404 for an unknown model)
+    would fail the same way anywhere.
+    """
+    if isinstance(error, OllamaError):
+        return error.status is not None and error.status >= 500
+    return True
+
+
+class BalancedStream:
+    """
+    GenerationStream over whichever host the pool picks, retrying on another
+    host if the request fails before the first chunk.
+    """
+
+    def __init__(self, pool, model: str, start, cancel_token=None):
+        self._pool = pool
+        self._model = model
+        self._start = start        # backend -> GenerationStream
+        self._stream = None
+        self._closed = False
+        self.host = None
+        self.done = False
+        self.final = {}
+        self.timings = {}
+        if cancel_token is not None:
+            cancel_token.on_cancel(self.close)
+
+    @property
+    def context(self):
+        return self.final.get("context")
+
+    def __iter__(self):
+        tried = set()
+        error = None
+        while not self._closed:
+            host = self._pool._acquire(self._model, tried)
+            if host is None:
+                raise error or OllamaError("No Ollama host available")
+            tried.add(host)
+            self.host = host.url
+            stream = self._stream = self._start(host.backend)
+            if self._closed:
+                stream.close()
+            started = False
+            try:
+                for chunk in stream:
+                    started = True
+                    yield chunk
+            except (OSError, http.client.HTTPException, OllamaError) as e:
+                if started or self._closed or not _host_fault(e):
+                    raise
+                error = e
+                self._pool._failed(host, e)
+                continue
+            finally:
+                self.done, self.final, self.timings = stream.done, stream.final, stream.timings
+                self._pool._release(host)
+            self._pool._served(host, self._model)
+            return
+
+    def close(self):
+        self._closed = True
+        if self._stream is not None:
+            self._stream.close()
+
+
+class BackendPool:
+    """
+    OllamaBackend-compatible client that balances requests over several hosts.
+    Thread-safe.
+    """
+
+    def __init__(self, hosts, model: str = DEFAULT_MODEL, keep_alive=DEFAULT_KEEP_ALIVE,
+                 pool_size: int = 4, timeout: float = 300.0, options: dict = None,
+                 health_interval: float = HEALTH_INTERVAL, registry=None, backend_class=OllamaBackend):
+        if not hosts:
+            raise ValueError("at least one host is required")
+        self.model = model
+        self.options = dict(options or {})
+        self.registry = registry or get_metrics()
+        self.hosts = [_Host(backend_class(model, host, keep_alive, pool_size, timeout, self.options))
+                      for host in hosts]
+        self._lock = threading.Lock()
+        self._rotation = itertools.count()
+        self._stop = threading.Event()
+        self._checker = None
+        if health_interval:
+            self._checker = threading.Thread(target=self._check_loop, args=(health_interval,),
+                                             name="ollama-health", daemon=True)
+            self._checker.start()
+
+    # ---- Host selection ----------------------------------------------------
+
+    def _acquire(self, model: str, exclude=()):
+        """Pick and reserve a host for `model`, or None when every host has been tried."""
+        with self._lock:
+            candidates = [h for h in self.hosts if h.healthy and h not in exclude]
+            if not candidates:
+                # Nothing healthy left: an evicted host is better than failing outright
+                candidates = [h for h in self.hosts if h not in exclude]
+            if not candidates:
+                return None
+            offset = next(self._rotation)   # Spreads ties evenly
+            host = min(candidates, key=lambda h: (
+                h.outstanding + (0 if model in h.resident else COLD_PENALTY),
+                (self.hosts.index(h) - offset) % len(self.hosts)))
+            host.outstanding += 1
+            return host
+
+    def _release(self, host: _Host):
+        with self._lock:
+            host.outstanding -= 1
+
+    def _served(self, host: _Host, model: str):
+        with self._lock:
+            host.failures = 0
+            host.resident.add(model)
+
+    def _failed(self, host: _Host, error):
+        print(f"[DEBUG] Ollama host {host.url} failed before the first token, retrying elsewhere: {error}")
+        self.registry.inc("chatbot_backend_retries_total", host=host.url)
+        self._mark_failure(host)
+
+    def _mark_failure(self, host: _Host):
+        with self._lock:
+            host.failures += 1
+            host.successes = 0
+            if host.healthy and host.failures >= EVICT_AFTER:
+                host.healthy = False
+                print(f"[DEBUG] Ollama host {host.url} evicted")
+
+    # ---- Health checks -----------------------------------------------------
+
+    def check_health(self):
+        """Poll every host once: refresh resident models, evict or re-admit."""
+        for host in self.hosts:
+            try:
+                resident = host.backend.loaded_models(timeout=HEALTH_TIMEOUT)
+            except Exception:
+                self._mark_failure(host)
+                continue
+            with self._lock:
+                host.resident = resident
+                host.failures = 0
+                if not host.healthy:
+                    host.successes += 1
+                    if host.successes >= READMIT_AFTER:
+                        host.healthy = True
+                        host.successes = 0
+                        print(f"[DEBUG] Ollama host {host.url} re-admitted")
+
+    def _check_loop(self, interval: float):
+        while not self._stop.is_set():
+            self.check_health()
+            self._stop.wait(interval)
+
+    # ---- OllamaBackend interface -------------------------------------------
+
+    def generate(self, prompt: str, model: str = None, context=None,
+                 options: dict = None, cancel_token=None, **extra) -> BalancedStream:
+        """Stream a completion from /api/generate on the best host."""
+        return BalancedStream(self, model or self.model, lambda backend: backend.generate(
+            prompt, model=model, context=context, options=options, **extra), cancel_token)
+
+    def chat(self, messages: list, model: str = None, options: dict = None,
+             cancel_token=None, **extra) -> BalancedStream:
+        """Stream an assistant reply from /api/chat on the best host."""
+        return BalancedStream(self, model or self.model, lambda backend: backend.chat(
+            messages, model=model, options=options, **extra), cancel_token)
+
+    def warm_up(self, model: str = None) -> float:
+        """Load the model on every healthy host; returns the total seconds."""
+        seconds = 0.0
+        for host in self.hosts:
+            if not host.healthy:
+                continue
+            try:
+                seconds += host.backend.warm_up(model)
+                self._served(host, model or self.model)
+            except Exception as e:
+                print(f"[DEBUG] Warm-up failed on {host.url}: {e}")
+                self._mark_failure(host)
+        return seconds
+
+    def status(self) -> list:
+        """(host, healthy, outstanding, resident models) for each host."""
+        with self._lock:
+            return [(h.url, h.healthy, h.outstanding, sorted(h.resident)) for h in self.hosts]
+
+    def close(self):
+        self._stop.set()
+        for host in self.hosts:
+            host.backend.close()
+
+
+def make_backend(hosts=None, engine: str = ENGINE, **kwargs):
+    """
+    A BackendPool when several hosts are configured (OLLAMA_HOSTS), otherwise
+    a single-host client. `engine="async"` (CHATBOT_ENGINE) uses the asyncio
+    engine for every host instead of a thread-blocking OllamaBackend.
+    """
+    hosts = list(hosts or HOSTS or [DEFAULT_HOST])
+    backend_class = OllamaBackend
+    if engine == "async":
+        from async_engine import AsyncOllamaEngine
+        backend_class = AsyncOllamaEngine
+    if len(hosts) == 1:
+        return backend_class(host=hosts[0], **kwargs)
+    return BackendPool(hosts, backend_class=backend_class, **kwargs)
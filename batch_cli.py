@@ -0,0 +1,267 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from backend_pool import ENGINE, make_backend
+from cancellation import CancelToken
+from metrics import RequestTrace
+from model_router import DEFAULT_MODELS, ModelRouter
+from response_cache import get_response_cache
+from scheduler import GenerationScheduler
+from think_parser import ThinkStreamParser
+
+# =============================================================================
+# Headless Batch Runner
+# =============================================================================
+#
+# Answers a file of prompts without a UI, e.g. nightly evaluations or bulk
+# jobs over tens of thousands of prompts. Each prompt goes through the same
+# path as a chat message: response cache, model router, generation
+# scheduler, streaming backend and reasoning parser. Prompts are read
+# lazily, `--parallel` of them run at once, and each result is appended to
+# the output JSONL as soon as it finishes, with its timings and token
+# counts. Rerunning with the same output file skips prompts that already
+# have an answer, so an interrupted batch resumes where it stopped (failed
+# and stopped prompts are retried; the last record for an id wins).
+#
+#   python batch_cli.py prompts.jsonl -o answers.jsonl --parallel 4
+#   python batch_cli.py questions.txt -o answers.jsonl --model deepseek-r1:1.5b
+#   cat prompts.txt | python batch_cli.py - -o answers.jsonl
+#
+# Input is JSONL ({"id": ..., "prompt": ..., "model": ..., "options": {...}};
+# only "prompt" is required) or plain text with one prompt per line. Files
+# named *.jsonl or *.ndjson, or any input with --jsonl, are read as JSONL.
+# Items without an id are named after their line number, and malformed JSON
+# lines are reported and skipped.
+
+DEFAULT_PARALLEL = 2
+PROGRESS_INTERVAL = 10.0     # Seconds between progress lines on stderr
+
+
+def read_items(stream, jsonl: bool = False):
+    """Yield prompt items from a JSONL or text stream, one per non-blank line."""
+    for number, line in enumerate(stream, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            item = json.loads(line) if jsonl else {"prompt": line}
+        except ValueError as e:
+            print(f"[DEBUG] Skipping line {number}: invalid JSON ({e})", file=sys.stderr)
+            continue
+        if not isinstance(item, dict) or not item.get("prompt"):
+            print(f"[DEBUG] Skipping line {number}: no prompt", file=sys.stderr)
+            continue
+        item["id"] = str(item.get("id", f"line-{number}"))
+        yield item
+
+
+def finished_ids(path: str) -> set:
+    """Ids already answered in an earlier run's output."""
+    done = set()
+    if not os.path.exists(path):
+        return done
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue   # A line cut off when the previous run was killed
+            if record.get("status") == "ok":
+                done.add(str(record.get("id")))
+    return done
+
+
+class BatchRunner:
+    """Runs prompt items through the chat generation path, one call to `run_item` per item."""
+
+    def __init__(self, backend, router, scheduler, cache=None, bypass_cache: bool = False,
+                 timeout: float = None):
+        self.backend = backend
+        self.router = router
+        self.scheduler = scheduler
+        self.cache = cache
+        self.bypass_cache = bypass_cache
+        self.timeout = timeout
+        self.stopping = threading.Event()
+        self._active = set()   # Cancel tokens of running items
+        self._lock = threading.Lock()
+
+    def _generate(self, item, model, cancel_token, bypass):
+        request = dict(prompt=item["prompt"], model=model, options=item.get("options"),
+                       cancel_token=cancel_token)
+        if self.cache is None or self.bypass_cache:
+            # --no-cache neither reads nor records answers, so the shared cache is left as it was
+            return self.backend.generate(**request)
+        return self.cache.generate(self.backend, bypass=bypass, standalone=True, **request)
+
+    def run_item(self, item) -> dict:
+        """Generate one answer; returns its output record (never raises)."""
+        model = item.get("model") or self.router.route(item["prompt"])
+        trace = RequestTrace("batch", model)
+        cancel_token = CancelToken()
+        timer = None
+        if self.timeout:
+            timer = threading.Timer(self.timeout, cancel_token.cancel)
+            timer.daemon = True
+            timer.start()
+        with self._lock:
+            self._active.add(cancel_token)
+        parser = ThinkStreamParser()
+        stream = ticket = None
+        status, error = "ok", None
+        try:
+            stream = self._generate(item, model, cancel_token, self.bypass_cache)
+            if not getattr(stream, "cached", False):
+                trace.queued()
+                ticket = self.scheduler.submit("batch", model, cancel_token=cancel_token)
+                while not ticket.wait(timeout=1.0):
+                    if ticket.cancelled:
+                        break
+                    smaller = None if item.get("model") else self.router.fallback(ticket)
+                    if smaller:
+                        # Queued past the latency target: move to the smaller model
+                        ticket.release()
+                        model = smaller
+                        trace.rerouted(model)
+                        stream = self._generate(item, model, cancel_token, True)
+                        ticket = self.scheduler.submit("batch", model, cancel_token=cancel_token)
+                if ticket.admitted:
+                    trace.admitted()
+            for chunk in stream:
+                trace.token()
+                parser.feed(chunk)
+            parser.flush()
+            if cancel_token.cancelled:
+                status = "stopped" if self.stopping.is_set() else "timeout"
+        except Exception as e:
+            status, error = "error", str(e)
+        finally:
+            if timer:
+                timer.cancel()
+            if ticket:
+                ticket.release()
+            with self._lock:
+                self._active.discard(cancel_token)
+        trace.finish(status, stream)
+        self.router.record(trace, status)
+        final = getattr(stream, "final", None) or {}
+        record = {
+            "id": item["id"],
+            "status": status,
+            "model": model,
+            "cached": trace.cached,
+            "prompt": item["prompt"],
+            "answer": parser.answer.strip(),
+            "reasoning": parser.reasoning.strip(),
+            "prompt_tokens": final.get("prompt_eval_count"),
+            "completion_tokens": final.get("eval_count", trace.tokens),
+            "seconds": round(time.perf_counter() - trace.start, 3),
+            "timings": trace.spans,
+        }
+        if error:
+            record["error"] = error
+        return record
+
+    def stop(self):
+        """Cancel every running item (they are recorded as stopped and retried on resume)."""
+        self.stopping.set()
+        with self._lock:
+            active = list(self._active)
+        for cancel_token in active:
+            cancel_token.cancel()
+
+
+def run_batch(runner: BatchRunner, items, output, parallel: int = DEFAULT_PARALLEL, skip=frozenset()) -> dict:
+    """Run items with `parallel` workers, appending one JSON line per result to `output`."""
+    counts = {"ok": 0, "skipped": 0, "failed": 0}
+    started = last_progress = time.monotonic()
+    pending = set()
+    with ThreadPoolExecutor(max_workers=parallel, thread_name_prefix="batch") as pool:
+        def drain(block):
+            nonlocal last_progress
+            done, _ = wait(pending, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.discard(future)
+                record = future.result()
+                output.write(json.dumps(record, ensure_ascii=False) + "\n")
+                output.flush()
+                counts["ok" if record["status"] == "ok" else "failed"] += 1
+            now = time.monotonic()
+            if now - last_progress >= PROGRESS_INTERVAL:
+                last_progress = now
+                finished = counts["ok"] + counts["failed"]
+                print(f"[DEBUG] {finished} done ({counts['failed']} failed, {counts['skipped']} skipped), "
+                      f"{finished / (now - started):.2f} prompts/s", file=sys.stderr)
+
+        try:
+            for item in items:
+                if item["id"] in skip:
+                    counts["skipped"] += 1
+                    continue
+                # Keep only a small window of prompts in flight, so huge inputs stream through
+                while len(pending) >= parallel * 2:
+                    drain(block=True)
+                pending.add(pool.submit(runner.run_item, item))
+                drain(block=False)
+            while pending:
+                drain(block=True)
+        except KeyboardInterrupt:
+            print("[DEBUG] Interrupted; stopping running prompts (rerun to resume).", file=sys.stderr)
+            runner.stop()
+            while pending:
+                drain(block=True)
+    counts["seconds"] = round(time.monotonic() - started, 1)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Answer a file of prompts without a UI.")
+    parser.add_argument("input", help="JSONL or text file of prompts, or - for stdin")
+    parser.add_argument("-o", "--output", required=True, help="JSONL file results are appended to")
+    parser.add_argument("--jsonl", action="store_true",
+                        help="Read the input as JSONL whatever its name (e.g. from stdin)")
+    parser.add_argument("--parallel", type=int, default=DEFAULT_PARALLEL, help="Prompts generated at once")
+    parser.add_argument("--model", help="Use this model for every prompt instead of routing")
+    parser.add_argument("--host", action="append", dest="hosts",
+                        help="Ollama server (repeat to balance over several; default OLLAMA_HOSTS/OLLAMA_HOST)")
+    parser.add_argument("--engine", choices=("threads", "async"), default=ENGINE,
+                        help="Stream with a blocking socket per prompt or on one asyncio loop "
+                             "(default CHATBOT_ENGINE)")
+    parser.add_argument("--timeout", type=float, help="Seconds allowed per prompt")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Always generate fresh answers, without storing them in the cache")
+    parser.add_argument("--restart", action="store_true",
+                        help="Answer every prompt again instead of resuming from the output file")
+    args = parser.parse_args(argv)
+
+    # This process is the batch: every slot goes to it, with no per-client rate limit
+    scheduler = GenerationScheduler(max_concurrent=args.parallel, rate_limit=0)
+    router = ModelRouter(models=(args.model,) if args.model else DEFAULT_MODELS, scheduler=scheduler)
+    backend = make_backend(args.hosts, engine=args.engine, pool_size=args.parallel)
+    runner = BatchRunner(backend, router, scheduler, cache=get_response_cache(),
+                         bypass_cache=args.no_cache, timeout=args.timeout)
+    skip = set() if args.restart else finished_ids(args.output)
+    if skip:
+        print(f"[DEBUG] Resuming: {len(skip)} prompts already answered in {args.output}", file=sys.stderr)
+
+    source = sys.stdin if args.input == "-" else open(args.input, encoding="utf-8")
+    jsonl = args.jsonl or args.input.endswith((".jsonl", ".ndjson"))
+    try:
+        with open(args.output, "a", encoding="utf-8") as output:
+            counts = run_batch(runner, read_items(source, jsonl), output, args.parallel, skip)
+    finally:
+        if source is not sys.stdin:
+            source.close()
+        backend.close()
+    print(f"[DEBUG] Batch finished: {counts['ok']} answered, {counts['failed']} failed, "
+          f"{counts['skipped']} already done, {counts['seconds']}s", file=sys.stderr)
+    return 1 if counts["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,512 @@
+import argparse
+import gc
+import importlib
+import itertools
+import json
+import math
+import os
+import random
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from conversation_context import ConversationContext
+from conversation_store import ConversationStore
+from response_cache import ResponseCache
+from scheduler import GenerationScheduler
+from stream_render import IncrementalMarkdownRenderer
+from think_parser import REASONING, ThinkStreamParser
+from tk_render import TkRenderQueue
+
+# =============================================================================
+# Streaming Benchmarks
+# =============================================================================
+#
+# Feeds recorded or synthetic deepseek-r1 token streams through the streaming
+# and rendering hot paths and reports per-chunk latency, CPU time and peak
+# allocations for each response size. A fake backend replays the chunks as
+# fast as they are consumed, so the numbers measure the front-end's own
+# overhead, not the model. Results can be saved as a baseline, and later
+# runs are compared against it so regressions show up.
+#
+#   python benchmark.py                    # run and compare with the baseline
+#   python benchmark.py --save-baseline    # record a new baseline
+#   python benchmark.py --recorded out.ndjson --targets think_parser tk_render
+#   python benchmark.py --imports          # startup import budget check
+#
+# Targets whose front-end dependencies (gradio, streamlit, ...) are not
+# installed are reported as skipped.
+
+DEFAULT_SIZES = (1_000, 10_000, 50_000, 200_000)
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+DEFAULT_TOLERANCE = 0.25      # Allowed slowdown before a metric counts as a regression
+DEFAULT_REPEAT = 3
+RUN_BUDGET_SECONDS = 60.0     # Longer runs are cut short and marked truncated
+CHUNKS_PER_FRAME = 8          # Tk frames drained per chunks (~500 tokens/s at 60 fps)
+COMPARED_METRICS = ("cpu_ms", "chunk_p95_us", "peak_alloc_kb")
+NOISE_FLOOR = {"cpu_ms": 1.0, "chunk_p95_us": 2.0, "peak_alloc_kb": 16.0}  # Smaller changes are ignored
+
+# Startup: each entry point is imported in a fresh interpreter (after its UI
+# framework, which is not ours to trim) and must stay within the budget
+# without pulling in any of the lazily loaded optional subsystems. The test
+# suite checks this on every run (tests/test_startup.py).
+ENTRY_POINTS = {"chatbot_gradio": "gradio", "Streamlit_Chat": "streamlit",
+                "gui_run": "tkinter", "run_deepseek": "tkinter"}
+LAZY_MODULES = ("pyttsx3", "speech_recognition", "vosk", "pyaudio", "mistune", "bs4", "markdown", "pyperclip")
+IMPORT_BUDGET_MS = 1000.0
+IMPORT_PROBE = """
+import json, sys, time
+import {framework}
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"import_ms": elapsed * 1e3, "loaded": [m for m in {lazy!r} if m in sys.modules]}}))
+"""
+
+WORDS = ("the model stream token latency render cache answer question context python "
+         "thread queue socket buffer frame chunk reason result value function request").split()
+
+
+# =============================================================================
+# Synthetic and Recorded Streams
+# =============================================================================
+
+def synthetic_response(size: int, seed: int = 0) -> str:
+    """A deepseek-r1 style response of about `size` characters: reasoning, then markdown."""
+    rng = random.Random(seed)
+
+    def sentence():
+        words = [rng.choice(WORDS) for _ in range(rng.randint(6, 16))]
+        return " ".join(words).capitalize() + "."
+
+    reasoning = []
+    while sum(map(len, reasoning)) < size * 0.3:
+        reasoning.append(sentence())
+    blocks = []
+    while sum(map(len, blocks)) < size * 0.7:
+        kind = rng.random()
+        if kind < 0.15:
+            blocks.append("## " + sentence().rstrip("."))
+        elif kind < 0.35:
+            blocks.append("\n".join(f"- **{rng.choice(WORDS)}**: {sentence()}" for _ in range(rng.randint(2, 5))))
+        elif kind < 0.45:
+            lines = [f"    {rng.choice(WORDS)} = {rng.randint(0, 99)}" for _ in range(rng.randint(2, 8))]
+            blocks.append("```python\ndef f():\n" + "\n".join(lines) + "\n```")
+        else:
+            blocks.append(" ".join(sentence() for _ in range(rng.randint(2, 5))))
+    return "<think>\n" + " ".join(reasoning) + "\n</think>\n\n" + "\n\n".join(blocks)
+
+
+def tokenize(text: str, seed: int = 0) -> list:
+    """Split text into token-sized chunks (1-6 characters, like Ollama's stream)."""
+    rng = random.Random(seed)
+    chunks, i = [], 0
+    while i < len(text):
+        step = rng.randint(1, 6)
+        chunks.append(text[i:i + step])
+        i += step
+    return chunks
+
+
+def load_recorded(path: str) -> list:
+    """Chunks from a recorded /api/generate or /api/chat NDJSON stream."""
+    chunks = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            chunk = data.get("response") or (data.get("message") or {}).get("content")
+            if chunk:
+                chunks.append(chunk)
+    return chunks
+
+
+# =============================================================================
+# Stand-ins
+# =============================================================================
+
+class FakeStream:
+    """
+    Replays chunks with the GenerationStream interface. The time the consumer
+    spends on each chunk (from yield until the next chunk is requested) is
+    recorded in `latencies`.
+    """
+
+    cached = False
+
+    def __init__(self, chunks, budget: float = RUN_BUDGET_SECONDS, cancel_token=None):
+        self.chunks = chunks
+        self.budget = budget
+        self.latencies = []
+        self.timings = {}
+        self.truncated = False
+        self.final = None
+        self.done = False
+        self._closed = False
+        if cancel_token is not None:
+            cancel_token.on_cancel(self.close)
+
+    @property
+    def context(self):
+        return self.final.get("context") if self.final else None
+
+    def __iter__(self):
+        clock = time.perf_counter
+        deadline = clock() + self.budget
+        for chunk in self.chunks:
+            if self._closed:
+                return
+            start = clock()
+            if start > deadline:
+                self.truncated = True
+                return
+            yield chunk
+            if _recording:
+                self.latencies.append(clock() - start)
+        self.final = {"done": True, "context": [1, 2, 3]}
+        self.done = True
+
+    def close(self):
+        self._closed = True
+
+
+class FakeBackend:
+    """OllamaBackend stand-in that streams the configured chunks."""
+
+    def __init__(self, model: str = "benchmark"):
+        self.model = model
+        self.options = {}
+        self.chunks = []
+        self.budget = RUN_BUDGET_SECONDS
+        self.last_stream = None
+
+    def generate(self, prompt, context=None, options=None, cancel_token=None, **extra):
+        self.last_stream = FakeStream(self.chunks, self.budget, cancel_token)
+        return self.last_stream
+
+    def close(self):
+        pass
+
+
+class HeadlessText:
+    """Just enough of a Tk Text widget for TkRenderQueue, without a display."""
+
+    def __init__(self):
+        self.state = "disabled"
+        self.length = 0
+        self.scheduled = []
+
+    def after(self, ms, callback):
+        self.scheduled.append(callback)
+
+    def run_frame(self):
+        callbacks, self.scheduled = self.scheduled, []
+        for callback in callbacks:
+            callback()
+
+    def yview(self):
+        return (0.0, 1.0)
+
+    def see(self, index):
+        pass
+
+    def cget(self, option):
+        return self.state
+
+    def config(self, state=None):
+        self.state = state
+
+    def insert(self, index, *runs):
+        self.length += sum(len(text) for text in runs[::2])
+
+
+# =============================================================================
+# Targets
+# =============================================================================
+#
+# Each target takes the chunk list and returns (per-chunk latencies, truncated).
+# Targets that need an optional front-end raise ImportError when it is missing.
+
+_prompts = itertools.count()
+_recording = True   # Off during the allocation pass, so the samples don't count as allocations
+
+
+def _unique_prompt() -> str:
+    # A fresh prompt per run, so the response cache never replays
+    return f"benchmark prompt {next(_prompts)}"
+
+
+def _timed_feed(chunks, feed):
+    clock = time.perf_counter
+    deadline = clock() + RUN_BUDGET_SECONDS
+    latencies = []
+    for chunk in chunks:
+        start = clock()
+        if start > deadline:
+            return latencies, True
+        feed(chunk)
+        if _recording:
+            latencies.append(clock() - start)
+    return latencies, False
+
+
+def bench_think_parser(chunks):
+    return _timed_feed(chunks, ThinkStreamParser().feed)
+
+
+def bench_markdown_to_plain(chunks):
+    from markdown_render import markdown_to_plain
+    parser = ThinkStreamParser()
+    renderer = IncrementalMarkdownRenderer(markdown_to_plain)
+
+    def feed(chunk):
+        for channel, text in parser.feed(chunk):
+            if channel != REASONING:
+                renderer.feed(text)
+    result = _timed_feed(chunks, feed)
+    renderer.finish()
+    return result
+
+
+def bench_markdown_to_html(chunks):
+    """The Gradio display path: HTML per closed block, escaped source of the open one."""
+    from markdown_render import markdown_to_html, open_block_to_text
+    parser = ThinkStreamParser()
+    renderer = IncrementalMarkdownRenderer(markdown_to_html, open_block_to_text)
+
+    def feed(chunk):
+        for channel, text in parser.feed(chunk):
+            if channel != REASONING:
+                renderer.feed(text)
+    result = _timed_feed(chunks, feed)
+    renderer.finish()
+    return result
+
+
+def bench_tk_render(chunks):
+    """The Tk display path headless: parse, queue, and drain a frame every few chunks."""
+    widget = HeadlessText()
+    render = TkRenderQueue(widget)
+    parser = ThinkStreamParser()
+    counter = itertools.count(1)
+
+    def feed(chunk):
+        for channel, text in parser.feed(chunk):
+            render.write(text, "think" if channel == REASONING else "bot")
+        if next(counter) % CHUNKS_PER_FRAME == 0:
+            widget.run_frame()
+    result = _timed_feed(chunks, feed)
+    widget.run_frame()
+    return result
+
+
+def _gradio_module(backend):
+    module = importlib.import_module("chatbot_gradio")
+    module.backend = backend
+    module.response_cache = ResponseCache(":memory:")
+    module.conversation_store = ConversationStore(":memory:")
+    module.scheduler = GenerationScheduler(rate_limit=0)
+    return module
+
+
+def bench_stream_deepseek(chunks, backend):
+    module = _gradio_module(backend)
+    for _ in module.stream_deepseek(_unique_prompt(), module.ChatSession()):
+        pass
+    return backend.last_stream.latencies, backend.last_stream.truncated
+
+
+def bench_stream_chat_with_ai(chunks, backend):
+    module = _gradio_module(backend)
+    for _ in module.stream_chat_with_ai(_unique_prompt(), module.ChatSession()):
+        pass
+    return backend.last_stream.latencies, backend.last_stream.truncated
+
+
+def bench_streamlit_run_deepseek(chunks, backend):
+    module = importlib.import_module("Streamlit_Chat")
+    st = module.st
+    chatbot = module.chatbot
+    chatbot.backend = backend
+    chatbot.response_cache = ResponseCache(":memory:")
+    chatbot.conversation_store = ConversationStore(":memory:")
+    chatbot.scheduler = GenerationScheduler(rate_limit=0)
+    st.session_state.is_muted = True
+    st.session_state.conversation = ConversationContext()
+    chatbot.run_deepseek(_unique_prompt())
+    return backend.last_stream.latencies, backend.last_stream.truncated
+
+
+TARGETS = {
+    "think_parser": bench_think_parser,
+    "markdown_to_plain": bench_markdown_to_plain,
+    "markdown_to_html": bench_markdown_to_html,
+    "tk_render": bench_tk_render,
+    "stream_deepseek": bench_stream_deepseek,
+    "stream_chat_with_ai": bench_stream_chat_with_ai,
+    "streamlit_run_deepseek": bench_streamlit_run_deepseek,
+}
+BACKEND_TARGETS = {"stream_deepseek", "stream_chat_with_ai", "streamlit_run_deepseek"}
+
+
+# =============================================================================
+# Runner
+# =============================================================================
+
+def _percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def run_once(name, chunks, measure_allocations=False):
+    """Run one target over one stream; returns its metrics."""
+    global _recording
+    target = TARGETS[name]
+    args = (chunks,)
+    if name in BACKEND_TARGETS:
+        backend = FakeBackend()
+        backend.chunks = chunks
+        args = (chunks, backend)
+    gc.collect()
+    if measure_allocations:
+        # Tracing slows everything down, so allocations get their own pass
+        _recording = False
+        tracemalloc.start()
+        try:
+            target(*args)
+            _, peak = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+            _recording = True
+        return {"peak_alloc_kb": round(peak / 1024, 1)}
+    wall, cpu = time.perf_counter(), time.process_time()
+    latencies, truncated = target(*args)
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    return {
+        "chunks": len(latencies),
+        "chunk_p50_us": round(statistics.median(latencies) * 1e6, 1) if latencies else 0.0,
+        "chunk_p95_us": round(_percentile(latencies, 0.95) * 1e6, 1),
+        "chunk_max_us": round(max(latencies, default=0.0) * 1e6, 1),
+        "cpu_ms": round(cpu * 1e3, 2),
+        "wall_ms": round(wall * 1e3, 2),
+        "truncated": truncated,
+    }
+
+
+def run_benchmarks(targets, streams, repeat=DEFAULT_REPEAT):
+    """Returns {target: {size label: metrics}}; the fastest of `repeat` runs is kept."""
+    results = {}
+    for name in targets:
+        results[name] = {}
+        for label, chunks in streams.items():
+            try:
+                runs = [run_once(name, chunks) for _ in range(repeat)]
+                metrics = min(runs, key=lambda run: run["cpu_ms"])
+                metrics.update(run_once(name, chunks, measure_allocations=True))
+            except ImportError as e:
+                print(f"[DEBUG] Skipping {name}: {e}")
+                results[name] = {"skipped": str(e)}
+                break
+            results[name][label] = metrics
+            print(f"{name:<24} {label:>8}  {metrics['chunks']:>7} chunks  "
+                  f"p50 {metrics['chunk_p50_us']:>9.1f} us  p95 {metrics['chunk_p95_us']:>9.1f} us  "
+                  f"cpu {metrics['cpu_ms']:>9.2f} ms  peak {metrics['peak_alloc_kb']:>9.1f} KB"
+                  + ("  (truncated)" if metrics["truncated"] else ""))
+    return results
+
+
+def check_imports(budget_ms=IMPORT_BUDGET_MS):
+    """Import each entry point in a fresh interpreter; returns the list of failures."""
+    failures = []
+    for module, framework in ENTRY_POINTS.items():
+        probe = IMPORT_PROBE.format(framework=framework, module=module, lazy=LAZY_MODULES)
+        proc = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=120)
+        if proc.returncode != 0:
+            if "ModuleNotFoundError" in proc.stderr:
+                print(f"[DEBUG] Skipping {module}: {proc.stderr.strip().splitlines()[-1]}")
+                continue
+            failures.append((module, proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else "failed"))
+            continue
+        result = json.loads(proc.stdout.strip().splitlines()[-1])
+        print(f"{module:<24} import {result['import_ms']:>8.1f} ms"
+              + (f"  loaded {', '.join(result['loaded'])}" if result["loaded"] else ""))
+        if result["import_ms"] > budget_ms:
+            failures.append((module, f"import took {result['import_ms']:.0f} ms (budget {budget_ms:.0f} ms)"))
+        if result["loaded"]:
+            failures.append((module, f"imported {', '.join(result['loaded'])} at startup"))
+    for module, reason in failures:
+        print(f"IMPORT BUDGET {module}: {reason}")
+    return failures
+
+
+def compare(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Print changes against the baseline; returns the list of regressions."""
+    regressions = []
+    for name, sizes in results.items():
+        for label, metrics in sizes.items():
+            before = baseline.get(name, {}).get(label)
+            if not isinstance(metrics, dict) or not isinstance(before, dict):
+                continue
+            for metric in COMPARED_METRICS:
+                old, new = before.get(metric), metrics.get(metric)
+                if not old or new is None or abs(new - old) < NOISE_FLOOR[metric]:
+                    continue
+                ratio = new / old
+                if ratio > 1 + tolerance:
+                    regressions.append((name, label, metric, old, new))
+                    print(f"REGRESSION {name} {label} {metric}: {old} -> {new} ({ratio:.2f}x)")
+                elif ratio < 1 - tolerance:
+                    print(f"improved   {name} {label} {metric}: {old} -> {new} ({ratio:.2f}x)")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the streaming and rendering hot paths.")
+    parser.add_argument("--targets", nargs="+", choices=sorted(TARGETS), default=list(TARGETS))
+    parser.add_argument("--sizes", nargs="+", type=int, default=list(DEFAULT_SIZES),
+                        help="Synthetic response sizes in characters")
+    parser.add_argument("--recorded", action="append", default=[],
+                        help="Recorded Ollama NDJSON stream to replay (repeatable)")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the baseline")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    parser.add_argument("--imports", action="store_true",
+                        help="Only check the entry points' startup import time and lazy imports")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET_MS, help="Milliseconds")
+    args = parser.parse_args(argv)
+
+    if args.imports:
+        return 1 if check_imports(args.import_budget) else 0
+
+    streams = {}
+    for size in args.sizes:
+        label = f"{size // 1000}KB" if size >= 1000 else f"{size}B"
+        streams[label] = tokenize(synthetic_response(size, seed=size), seed=size)
+    for path in args.recorded:
+        streams[os.path.basename(path)] = load_recorded(path)
+
+    results = run_benchmarks(args.targets, streams, repeat=args.repeat)
+
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f"Baseline saved to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print("No baseline yet; run with --save-baseline to record one.")
+        return 0
+    with open(args.baseline, encoding="utf-8") as f:
+        baseline = json.load(f)
+    return 1 if compare(results, baseline, args.tolerance) else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,58 @@
+import threading
+
+# =============================================================================
+# Cancellation
+# =============================================================================
+#
+# A CancelToken is created per generation and handed to every stage that
+# holds resources for it: the backend stream (socket), the scheduler ticket
+# (generation slot), the TTS utterance and the front-end's reader loop.
+# Cancelling runs each stage's registered cleanup immediately, so a stopped
+# generation stops using CPU without waiting for the stages to notice.
+
+
+class GenerationCancelled(Exception):
+    """Raised by `CancelToken.raise_if_cancelled` once the token is cancelled."""
+
+
+class CancelToken:
+    """Thread-safe, one-shot cancellation signal with cleanup callbacks."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self):
+        """Cancel and run every registered callback (once)."""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"[DEBUG] Cancel callback failed: {e}")
+
+    def on_cancel(self, callback):
+        """Run `callback` when cancelled (immediately if already cancelled)."""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return callback
+        callback()
+        return callback
+
+    def wait(self, timeout: float = None) -> bool:
+        """Block until cancelled or timeout; True if cancelled."""
+        return self._event.wait(timeout)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise GenerationCancelled()
@@ -0,0 +1,230 @@
+import itertools
+import tkinter as tk
+
+from tk_render import stored_turn_runs
+
+# =============================================================================
+# Virtualized Tk Chat View
+# =============================================================================
+#
+# A Text widget gets slower to insert into and scroll as its buffer grows, so
+# long desktop sessions keep only a bounded window of turns rendered. The
+# full list of turns (the model) is kept as stored-turn records; turns that
+# scroll far out of view are deleted from the widget and re-rendered from the
+# model when the user scrolls back to them. Scrolling past the oldest
+# turn in the model pulls the previous page from the conversation store.
+#
+# Each rendered turn starts at a left-gravity mark, so a turn can be deleted
+# or a page prepended without tracking line numbers. All methods run on the
+# Tk main loop; worker threads reach them through TkRenderQueue.call.
+
+MAX_RENDERED_TURNS = 40   # Turns kept in the widget
+PAGE_TURNS = 10           # Turns rendered per scroll page
+
+
+class VirtualChatView:
+    """
+    Bounded window of rendered turns over `turns`. `load_older(before_seq)`
+    returns the stored turns preceding `before_seq` (oldest first), or [].
+    """
+
+    def __init__(self, widget, render, load_older=None, max_rendered: int = MAX_RENDERED_TURNS,
+                 page_turns: int = PAGE_TURNS):
+        self.widget = widget
+        self.render = render
+        self.load_older = load_older
+        self.max_rendered = max_rendered
+        self.page_turns = page_turns
+        self.turns = []           # Model: every known turn, oldest first
+        self.sources = {}         # Turn -> documents it was answered from (this session only)
+        self.first = 0            # Rendered window is turns[first:last]
+        self.last = 0
+        self.live = False         # A turn is streaming in below turns[last - 1]
+        self._marks = []          # One mark per rendered turn (plus the live one)
+        self._names = (f"turn{n}" for n in itertools.count())
+        self._exhausted = False   # The store has no older turns
+        self._scheduled = False
+        scrollbar = getattr(widget, "vbar", None)
+        self._scroll_set = scrollbar.set if scrollbar is not None else None
+        widget.config(yscrollcommand=self._on_scroll)
+
+    # ---- Model updates -----------------------------------------------------
+
+    def set_turns(self, turns):
+        """Replace the model and show its newest turns."""
+        sources = self.sources
+        self.clear()
+        self.sources = sources
+        self.turns = list(turns)
+        self.first = self.last = max(0, len(self.turns) - self.max_rendered)
+        self._append(self.first, len(self.turns))
+        self.widget.see(tk.END)
+
+    def clear(self):
+        """Forget every turn (flush the render queue first when called from a UI handler)."""
+        self.render.delete_now("1.0", tk.END)
+        for name in self._marks:
+            self.widget.mark_unset(name)
+        self._marks = []
+        self.turns = []
+        self.sources = {}
+        self.first = self.last = 0
+        self.live = False
+        self._exhausted = False
+
+    def begin_live(self):
+        """A new turn is about to stream in at the end (queue this before its text)."""
+        if self.last != len(self.turns):
+            # Scrolled back in history: jump to the newest turns first
+            self.set_turns(self.turns)
+        self._marks.append(self._new_mark(tk.END + "-1c"))
+        self.live = True
+
+    def finish_live(self, turn, sources=()):
+        """
+        The streamed turn has been drawn; record it in the model and redraw it
+        with its markdown rendered (queue this after its text).
+        """
+        if not self.live:
+            return
+        self.live = False
+        at_bottom = self.widget.yview()[1] >= 1.0
+        self.render.delete_now(self._marks[-1], tk.END)
+        if sources:
+            self.sources[turn] = sources
+        self.render.insert_now(stored_turn_runs(turn, sources))
+        if at_bottom:
+            self.widget.see(tk.END)
+        self.turns.append(turn)
+        self.last = len(self.turns)
+        self._trim(from_top=True)
+
+    def pop_turn(self):
+        """Remove the newest turn (e.g. before regenerating it) and return it, or None."""
+        if self.live or not self.turns:
+            return None
+        turn = self.turns.pop()
+        self.sources.pop(turn, None)
+        if self.last > len(self.turns):
+            # It is rendered: delete it from its mark to the end
+            name = self._marks.pop()
+            self.render.delete_now(name, tk.END)
+            self.widget.mark_unset(name)
+            self.last = len(self.turns)
+            self.first = min(self.first, self.last)
+        return turn
+
+    # ---- Paging ------------------------------------------------------------
+
+    def page_up(self):
+        """Render the previous page of turns above the window."""
+        if self.first == 0 and not self._fetch_older():
+            return
+        anchor = self._marks[0] if self._marks else None
+        self._prepend(max(0, self.first - self.page_turns), self.first)
+        if anchor:
+            self.widget.yview(anchor)   # Keep the previous top turn in place
+        self._trim(from_top=False)
+
+    def page_down(self):
+        """Render the next page of turns below the window."""
+        if self.live or self.last >= len(self.turns):
+            return
+        self._append(self.last, min(len(self.turns), self.last + self.page_turns))
+        self._trim(from_top=True)
+
+    def _fetch_older(self) -> bool:
+        if self.load_older is None:
+            self._exhausted = True
+        if self._exhausted:
+            return False
+        before = next((turn.seq for turn in self.turns if turn.seq), None)
+        older = self.load_older(before) if before else []
+        if not older:
+            self._exhausted = True
+            return False
+        self.turns[:0] = older
+        self.first += len(older)
+        self.last += len(older)
+        return True
+
+    def _on_scroll(self, first, last):
+        if self._scroll_set:
+            self._scroll_set(first, last)
+        if self._scheduled:
+            return
+        if float(first) <= 0.0 and (self.first > 0 or not self._exhausted):
+            action = self.page_up
+        elif float(last) >= 1.0 and not self.live and self.last < len(self.turns):
+            action = self.page_down
+        else:
+            return
+        self._scheduled = True
+        self.widget.after_idle(self._run_scheduled, action)
+
+    def _run_scheduled(self, action):
+        try:
+            action()
+        except Exception as e:
+            print(f"[DEBUG] Chat view paging error: {e}")
+        finally:
+            self._scheduled = False
+
+    # ---- Widget updates ----------------------------------------------------
+
+    def _new_mark(self, index):
+        name = next(self._names)
+        self.widget.mark_set(name, index)
+        self.widget.mark_gravity(name, tk.LEFT)
+        return name
+
+    def _append(self, start, stop):
+        """Render turns[start:stop] at the end of the widget (start == self.last)."""
+        for turn in self.turns[start:stop]:
+            self._marks.append(self._new_mark(tk.END + "-1c"))
+            self.render.insert_now(stored_turn_runs(turn, self.sources.get(turn, ())))
+        self.last = stop
+
+    def _prepend(self, start, stop):
+        """Render turns[start:stop] above the window (stop == self.first)."""
+        widget = self.widget
+        for turn in reversed(self.turns[start:stop]):
+            top = self._marks[0] if self._marks else None
+            if top:
+                widget.mark_gravity(top, tk.RIGHT)   # Stay with its turn as text goes in before it
+            self.render.insert_now(stored_turn_runs(turn, self.sources.get(turn, ())), "1.0")
+            if top:
+                widget.mark_gravity(top, tk.LEFT)
+            self._marks.insert(0, self._new_mark("1.0"))
+        self.first = start
+
+    def _trim(self, from_top: bool):
+        """Evict off-screen turns beyond the bound, from the top or the bottom."""
+        widget = self.widget
+        excess = len(self._marks) - self.max_rendered
+        if excess <= 0:
+            return
+        count = 0
+        if from_top:
+            # A top turn is off-screen if the next turn starts above the view
+            top_visible = widget.index("@0,0")
+            while count < excess and count + 1 < len(self._marks) \
+                    and widget.compare(self._marks[count + 1], "<=", top_visible):
+                count += 1
+            if count:
+                self.render.delete_now("1.0", self._marks[count])
+                for name in self._marks[:count]:
+                    widget.mark_unset(name)
+                del self._marks[:count]
+                self.first += count
+        elif not self.live:
+            bottom_visible = widget.index(f"@0,{widget.winfo_height()}")
+            while count < excess and count + 1 < len(self._marks) \
+                    and widget.compare(self._marks[-(count + 1)], ">", bottom_visible):
+                count += 1
+            if count:
+                self.render.delete_now(self._marks[-count], tk.END)
+                for name in self._marks[-count:]:
+                    widget.mark_unset(name)
+                del self._marks[-count:]
+                self.last -= count
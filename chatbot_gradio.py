@@ -1,28 +1,80 @@
 import gradio as gr
-import subprocess
+import os
 import threading
 import time
-import speech_recognition as sr
-import pyttsx3
-import pyperclip
-import mistune
-from bs4 import BeautifulSoup
+import uuid
+
+from backend_pool import make_backend
+from cancellation import CancelToken
+from conversation_context import ConversationContext
+from conversation_store import get_conversation_store
+from document_index import augment, get_document_index
+from markdown_render import markdown_to_html, markdown_to_plain, open_block_to_text
+from metrics import RequestTrace, start_metrics_server
+from model_router import get_router
+from ollama_backend import start_warm_up
+from response_cache import get_response_cache
+from scheduler import RateLimitExceeded, describe_wait, get_scheduler
+from stt_worker import get_speech_input
+from stream_render import IncrementalMarkdownRenderer
+from think_parser import ANSWER, ThinkStreamParser
+from tts_worker import get_speech_pipeline
 
 
 # Global Variables and Initialization
  
-latest_response = ""       # Stores the latest AI response (plain text)
-is_speaking = False         # Flag to indicate if TTS is active
-is_muted = False            # Flag to track speaker mute state
-process_handle = None       # Subprocess handle for the DeepSeek call
-chat_history = []           # List to store conversation messages as dictionaries
+MAX_CONCURRENT_STREAMS = 16  # Generations Gradio may run at the same time
+MAX_QUEUE_SIZE = 64          # Pending events before new requests are rejected
+STREAM_FPS = float(os.environ.get("CHATBOT_STREAM_FPS", "20"))  # Chat display updates per second while streaming
+
+# Shared Ollama client (pooled keep-alive connections, model kept resident),
+# balanced over several servers when OLLAMA_HOSTS lists more than one
+backend = make_backend()
+
+# Picks a deepseek-r1 size per prompt from its complexity, the load and a latency target
+router = get_router()
+
+# Caps concurrent generations per model and queues the rest fairly per session
+scheduler = get_scheduler()
+
+# Conversations persisted across restarts (reopened per browser via BrowserState)
+conversation_store = get_conversation_store()
+
+# Finished answers, replayed for repeated prompts
+response_cache = get_response_cache()
+
+# Text-to-speech: one persistent engine on a worker thread, fed sentence by sentence
+speech = get_speech_pipeline()
 
-# Initialize text-to-speech engine
-tts_engine = pyttsx3.init()
-tts_engine.setProperty("rate", 150)
+# Speech recognition: one microphone stream, recognized while recording
+speech_input = get_speech_input()
 
-# Initialize Speech Recognizer
-recognizer = sr.Recognizer()
+
+class ChatSession:
+    """
+    Per-browser-session state, held in a `gr.State` so concurrent users
+    each get their own conversation.
+    """
+
+    def __init__(self):
+        self.client_id = uuid.uuid4().hex  # Identifies this session to the scheduler
+        self.cancel_token = None        # Cancels the current generation end to end
+        self.latest_response = ""       # Stores the latest AI response (plain text)
+        self.is_muted = False           # Flag to track speaker mute state
+        self.utterance = None           # Speech pipeline utterance reading this session's response
+        self.streaming = False          # Whether a response is currently streaming
+        self.partial_response = ""      # Raw text streamed so far for the current response
+        self.lock = threading.Lock()    # Guards the streaming fields above
+        self.process_handle = None      # Active generation stream for the DeepSeek call
+        self.chat_history = []          # List to store conversation messages as dictionaries
+        self.conversation = ConversationContext()  # Prior turns and model context sent with each prompt
+        self.conversation_id = None     # Stored conversation, created with the first turn
+        self.oldest_seq = None          # Oldest stored turn shown (for loading earlier pages)
+        self.last_turn_seq = None       # Latest stored turn (retracted on regenerate)
+
+    def __deepcopy__(self, memo):
+        # gr.State deep-copies its default for every new session; start fresh.
+        return ChatSession()
 
 # 
 # Utility Functions
@@ -32,13 +84,35 @@ def debug_log(message: str):
     """Simple debug logger."""
     print(f"[DEBUG] {message}")
 
-def markdown_to_plain(md_text: str) -> str:
+def stored_turn_messages(turn) -> list:
+    """
+    Convert a stored turn back into chat messages.
+    """
+    messages = [{"role": "user", "content": turn.prompt}]
+    if turn.reasoning:
+        messages.append({"role": "assistant", "content": turn.reasoning, "metadata": {"title": "💭 Reasoning"}})
+    if turn.answer:
+        messages.append({"role": "assistant", "content": markdown_to_html(turn.answer).strip()})
+    if turn.note:
+        messages.append({"role": "assistant", "content": turn.note})
+    return messages
+
+def save_turn(session: ChatSession, prompt: str, answer: str, reasoning: str, note: str = "", context=None,
+              model: str = None):
     """
-    Convert Markdown-formatted text to plain text.
+    Append a finished turn to the session's stored conversation.
     """
-    html = mistune.markdown(md_text)
-    soup = BeautifulSoup(html, "html.parser")
-    return soup.get_text()
+    try:
+        if session.conversation_id is None:
+            session.conversation_id = conversation_store.create("gradio")
+        seq = conversation_store.append_turn(session.conversation_id, prompt, answer.strip(),
+                                             reasoning.strip(), note, context, model)
+    except Exception as e:
+        debug_log(f"Could not save turn: {e}")
+        return
+    session.last_turn_seq = seq
+    if session.oldest_seq is None:
+        session.oldest_seq = seq
 
 def typewriter_effect(text: str, speed: float = 0.03) -> str:
     """
@@ -56,107 +130,238 @@ def typewriter_effect(text: str, speed: float = 0.03) -> str:
 # =============================================================================
 # DeepSeek Model Streaming Functions
 # =============================================================================
+#
+# Gradio sends each value a generator yields as a diff against the previous
+# one: text that extends the previous value goes out as an append, anything
+# else as a full replace. Earlier messages are never touched, and the answer
+# is shown as the HTML of its closed markdown blocks followed by the escaped
+# source of the open one, so a frame only appends until a block closes (one
+# replace per block). Chunks that arrive between frames are coalesced into one
+# update (at most STREAM_FPS per second).
 
-def stream_deepseek(prompt: str):
+def stream_deepseek(prompt: str, session: ChatSession, bypass_cache: bool = False):
     """
     Generator that calls the DeepSeek model via Ollama and yields incremental updates
     as a list of message dictionaries (using "role" and "content").
+    Cached answers are replayed through the same path unless `bypass_cache` is set.
     """
-    global latest_response, process_handle
     debug_log(f"Starting DeepSeek for prompt: {prompt}")
+    conversation = session.conversation
+    model = router.route(prompt)
+    # Passages from the local document folder (if configured) go into the model's prompt
+    # and skip near-duplicate matching, where the passages would dominate the comparison
+    model_prompt, sources = augment(prompt)
+    trace = RequestTrace("gradio", model)
+    cancel_token = session.cancel_token = CancelToken()
+    cancel_token.on_cancel(lambda: stop_reading(session))
+    process_handle = session.process_handle = response_cache.generate(
+        backend, bypass=bypass_cache, standalone=not (conversation.turns or sources),
+        cancel_token=cancel_token, **conversation.request(model_prompt, model))
+    ticket = None
+    completed = False
+    status = "cancelled"
+    note = "🛑 Chat stopped."
+    # deepseek-r1 reasoning goes to its own collapsible message; only the answer is rendered
+    parser = ThinkStreamParser()
+    if process_handle.cached:
+        if process_handle.similarity:
+            debug_log(f"Serving cached answer to a similar prompt ({process_handle.similarity:.2f}).")
+        else:
+            debug_log("Serving response from cache.")
+    else:
+        try:
+            trace.queued()
+            ticket = scheduler.submit(session.client_id, model, cancel_token=cancel_token)
+        except RateLimitExceeded as e:
+            debug_log(f"Rate limited: {e}")
+            trace.finish("rate_limited")
+            yield [{"role": "assistant", "content": f"⚠️ {e}"}]
+            return
     try:
-        process_handle = subprocess.Popen(
-            ["ollama", "run", "deepseek-r1:8b"],
-            stdin=subprocess.PIPE,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            bufsize=1
-        )
-        # Send the prompt
-        process_handle.stdin.write(prompt + "\n")
-        process_handle.stdin.flush()
-        process_handle.stdin.close()
-        accumulated = ""
-        # Initially yield the user's message only
-        yield [{"role": "user", "content": prompt}]
-        for line in iter(process_handle.stdout.readline, ""):
-            accumulated += line
-            partial = markdown_to_plain(accumulated)
-            # Yield updated conversation with partial response
+        # Wait for a generation slot, reporting queue position meanwhile
+        while ticket and not ticket.wait(timeout=1.0):
+            if ticket.cancelled:
+                return
+            smaller = router.fallback(ticket)
+            if smaller:
+                # Queued past the latency target: move to the smaller model
+                ticket.release()
+                model = smaller
+                trace.rerouted(model)
+                process_handle = session.process_handle = response_cache.generate(
+                    backend, bypass=True, standalone=not (conversation.turns or sources),
+                    cancel_token=cancel_token, **conversation.request(model_prompt, model))
+                ticket = scheduler.submit(session.client_id, model, cancel_token=cancel_token)
             yield [
                 {"role": "user", "content": prompt},
-                {"role": "assistant", "content": partial}
+                {"role": "assistant", "content": describe_wait(ticket)}
             ]
-            time.sleep(0.03)
-        latest_response = markdown_to_plain(accumulated.strip())
-        debug_log("DeepSeek streaming complete.")
-        yield [
-            {"role": "user", "content": prompt},
-            {"role": "assistant", "content": latest_response}
-        ]
+        if ticket:
+            trace.admitted()
+        # Closed markdown blocks are converted to HTML once (and cached, so the
+        # plain text for speech below reuses their parse); the open block is
+        # shown as escaped source until it closes
+        renderer = IncrementalMarkdownRenderer(markdown_to_html, open_block_to_text)
+        reasoning_title = {"title": "💭 Reasoning"}
+        sources_note = [{"role": "assistant", "content": "\n".join(sources),
+                         "metadata": {"title": "📚 Sources"}}] if sources else []
+        frame_interval = 1.0 / STREAM_FPS if STREAM_FPS > 0 else 0.0
+        last_frame = 0.0
+        with session.lock:
+            session.streaming = True
+            session.partial_response = ""
+        # Initially yield the user's message only
+        yield [{"role": "user", "content": prompt}]
+        for chunk in process_handle:
+            trace.token()
+            for channel, text in parser.feed(chunk):
+                if channel != ANSWER:
+                    continue
+                with session.lock:
+                    session.partial_response = parser.answer
+                    if session.utterance:
+                        # Reading along: completed sentences are spoken immediately
+                        speech.feed(text, session.utterance)
+                renderer.append(text)
+            if cancel_token.cancelled:
+                return
+            now = time.perf_counter()
+            if now - last_frame < frame_interval:
+                continue  # Coalesced into the next frame
+            last_frame = now
+            # Yield updated conversation with partial reasoning and response
+            partial = renderer.render()
+            trace.add_render(time.perf_counter() - now)
+            messages = [{"role": "user", "content": prompt}] + sources_note
+            if parser.reasoning:
+                messages.append({"role": "assistant", "content": parser.reasoning.strip(),
+                                 "metadata": reasoning_title})
+            if partial:
+                messages.append({"role": "assistant", "content": partial})
+            yield messages
+        for channel, text in parser.flush():
+            if channel == ANSWER:
+                renderer.append(text)
+        if cancel_token.cancelled:
+            return
+        answer_html = renderer.finish().strip()
+        session.latest_response = markdown_to_plain(parser.answer).strip()
+        with session.lock:
+            session.partial_response = parser.answer
+            if session.utterance:
+                speech.flush(session.utterance)
+        conversation.add_turn(prompt, parser.answer, process_handle.context, model)
+        completed = True
+        status = "ok"
+        note = ""
+        trace.finish(status, process_handle)
+        debug_log(f"DeepSeek streaming complete ({trace.summary()}).")
+        messages = [{"role": "user", "content": prompt}] + sources_note
+        if parser.reasoning:
+            messages.append({"role": "assistant", "content": parser.reasoning.strip(),
+                             "metadata": reasoning_title})
+        messages.append({"role": "assistant", "content": answer_html})
+        yield messages
     except Exception as e:
+        status = "error"
+        note = f"❌ Error: {e}"
         debug_log(f"Error streaming response: {e}")
         yield [{"role": "assistant", "content": f"❌ Error: {e}"}]
+    finally:
+        session.streaming = False
+        trace.finish(status, process_handle)
+        router.record(trace, status)
+        if completed or parser.answer:
+            save_turn(session, prompt, parser.answer, parser.reasoning, note,
+                      process_handle.context if completed else None, model)
+        if not completed:
+            # Stopped, failed or abandoned by the client: release everything now
+            cancel_token.cancel()
+        if ticket:
+            ticket.release()
 
-def stream_chat_with_ai(prompt: str):
+def stream_chat_with_ai(prompt: str, session: ChatSession, bypass_cache: bool = False):
     """
     Generator to stream the chat interaction.
-    It appends the user's message to the chat history and then yields updates
-    from the DeepSeek streaming function.
+    It appends the user's message to the session's chat history and then yields
+    updates from the DeepSeek streaming function.
     """
-    global chat_history
+    chat_history = session.chat_history
     if not prompt.strip():
         yield chat_history
         return
-    # Append user's message to global history (in message dictionary format)
+    # Append user's message to the session history (in message dictionary format)
     chat_history.append({"role": "user", "content": prompt})
+    base = len(chat_history)
     yield chat_history
     # Stream the AI response and update the chat history dynamically
-    for messages in stream_deepseek(prompt):
-        # Replace any previous assistant message if exists in the last item.
-        if chat_history and chat_history[-1]["role"] == "assistant":
-            chat_history[-1] = messages[-1]
-        else:
-            chat_history.append(messages[-1])
+    for messages in stream_deepseek(prompt, session, bypass_cache):
+        # Replace this turn's assistant messages (reasoning and answer) in place
+        chat_history[base:] = [m for m in messages if m["role"] != "user"]
         yield chat_history
 
 # =============================================================================
 # Chat Control Functions
 # =============================================================================
 
-def stop_chat() -> str:
+def stop_chat(session: ChatSession) -> list:
     """
-    Stop the ongoing AI generation (if any).
+    Stop this session's ongoing AI generation (if any).
     """
-    global process_handle, chat_history
     debug_log("Stop chat requested.")
-    if process_handle:
-        try:
-            process_handle.terminate()
-            chat_history.append({"role": "system", "content": "🛑 Chat stopped."})
-            return "\n".join([f"{m['role']}: {m['content']}" for m in chat_history])
-        except Exception as e:
-            debug_log(f"Error stopping chat: {e}")
-            return f"❌ Error: {e}"
-    return "No active process to stop."
+    if session.cancel_token and not session.cancel_token.cancelled:
+        # Closes the stream, frees the scheduler slot and silences TTS
+        session.cancel_token.cancel()
+        session.chat_history.append({"role": "assistant", "content": "🛑 Chat stopped."})
+    return session.chat_history
 
-def clear_chat() -> str:
+def clear_chat(session: ChatSession) -> list:
     """
-    Clear the chat history.
+    Clear the session's chat history.
     """
-    global chat_history
-    chat_history = []
+    session.chat_history.clear()
+    session.conversation.clear()
+    # The stored conversation is kept; the next message starts a new one
+    session.conversation_id = session.oldest_seq = session.last_turn_seq = None
     debug_log("Chat history cleared.")
-    return ""
+    return session.chat_history
 
-def copy_response() -> str:
+def open_conversation(conversation_id, session: ChatSession) -> list:
+    """
+    Reopen this browser's stored conversation, loading only its latest page.
+    """
+    if not conversation_id or session.chat_history or not conversation_store.exists(conversation_id):
+        return session.chat_history
+    turns = conversation_store.resume(conversation_id, session.conversation)
+    session.conversation_id = conversation_id
+    if turns:
+        session.oldest_seq = turns[0].seq
+        session.last_turn_seq = turns[-1].seq
+        session.latest_response = markdown_to_plain(turns[-1].answer).strip()
+    session.chat_history = [m for turn in turns for m in stored_turn_messages(turn)]
+    debug_log(f"Reopened conversation {conversation_id} ({len(turns)} turns).")
+    return session.chat_history
+
+def load_earlier(session: ChatSession) -> list:
+    """
+    Prepend the previous page of stored turns to the chat display.
+    """
+    if session.conversation_id is None or session.oldest_seq is None:
+        return session.chat_history
+    turns = conversation_store.load_page(session.conversation_id, before=session.oldest_seq)
+    if turns:
+        session.oldest_seq = turns[0].seq
+        session.chat_history[:0] = [m for turn in turns for m in stored_turn_messages(turn)]
+    return session.chat_history
+
+def copy_response(session: ChatSession) -> str:
     """
     Copy the latest AI response to the clipboard.
     """
-    global latest_response
+    latest_response = session.latest_response
     if latest_response:
         try:
+            import pyperclip
             pyperclip.copy(latest_response)
             debug_log("Response copied to clipboard.")
             return "✅ Response copied to clipboard!"
@@ -165,17 +370,30 @@ def copy_response() -> str:
             return f"❌ Error: {e}"
     return "⚠️ No response to copy."
 
-def regenerate_last_response() -> str:
+def regenerate_last_response(session: ChatSession):
     """
-    Regenerate the last AI response.
-    (For simplicity, this calls chat_with_ai using latest_response as prompt.)
+    Regenerate the last AI response by re-sending the last user message.
     """
-    global latest_response
     debug_log("Regenerate response requested.")
-    if latest_response:
-        new_response = chat_with_ai(latest_response)
-        return new_response
-    return "⚠️ No previous response to regenerate."
+    chat_history = session.chat_history
+    user_turns = [i for i, m in enumerate(chat_history) if m["role"] == "user"]
+    if not user_turns:
+        yield chat_history
+        return
+    last = user_turns[-1]
+    prompt = chat_history[last]["content"]
+    del chat_history[last:]
+    # Drop the turn being regenerated so it isn't sent back as context
+    conversation = session.conversation
+    if conversation.turns and conversation.turns[-1][0] == prompt:
+        conversation.pop_turn()
+        if session.conversation_id and session.last_turn_seq:
+            conversation_store.retract_turn(session.conversation_id, session.last_turn_seq)
+            if session.oldest_seq == session.last_turn_seq:
+                session.oldest_seq = None
+            session.last_turn_seq = None
+    # Always sample a fresh answer instead of replaying the cached one
+    yield from stream_chat_with_ai(prompt, session, bypass_cache=True)
 
 # =============================================================================
 # Voice and Audio Functions
@@ -183,94 +401,70 @@ def regenerate_last_response() -> str:
 
 def voice_input() -> str:
     """
-    Capture voice input using SpeechRecognition and return the recognized text.
+    Capture voice input and return the recognized text.
     """
     debug_log("Voice input triggered.")
-    try:
-        with sr.Microphone() as source:
-            recognizer.adjust_for_ambient_noise(source, duration=1)
-            audio = recognizer.listen(source, timeout=5, phrase_time_limit=10)
-            text = recognizer.recognize_google(audio)
-            debug_log(f"Voice recognized: {text}")
-            return text
-    except sr.UnknownValueError:
-        debug_log("Speech not recognized.")
-        return "❌ Couldn't recognize speech."
-    except sr.RequestError:
-        debug_log("Speech service unavailable.")
-        return "❌ Speech service unavailable."
-    except Exception as e:
-        debug_log(f"Voice input error: {e}")
-        return f"❌ Error: {str(e)}"
-
-def speak_response() -> str:
-    """
-    Convert the latest AI response to speech using pyttsx3.
-    """
-    global latest_response, is_muted
-    if latest_response and not is_muted:
-        def speak_text():
-            try:
-                local_engine = pyttsx3.init()
-                local_engine.setProperty('rate', 150)
-                local_engine.say(latest_response)
-                local_engine.runAndWait()
-                debug_log("TTS finished.")
-            except Exception as e:
-                debug_log(f"TTS error: {e}")
-        threading.Thread(target=speak_text, daemon=True).start()
+    text = speech_input.recognize_prompt()
+    debug_log(f"Voice input: {text}")
+    return text
+
+def speak_response(session: ChatSession) -> str:
+    """
+    Read the latest AI response aloud. If a response is still streaming, speech
+    starts with the sentences received so far and follows the stream.
+    """
+    if session.is_muted:
+        debug_log("Speaker is muted.")
+        return "⚠️ Speaker is muted."
+    with session.lock:
+        if session.streaming:
+            session.utterance = speech.begin()
+            speech.feed(session.partial_response, session.utterance)
+            return "🔊 Speaking the response..."
+    if session.latest_response:
+        session.utterance = speech.speak(session.latest_response)
         return "🔊 Speaking the response..."
-    else:
-        debug_log("No response to speak or speaker is muted.")
-        return "⚠️ No response to speak or speaker is muted."
+    debug_log("No response to speak.")
+    return "⚠️ No response to speak."
 
-def toggle_speaker() -> str:
+def toggle_speaker(session: ChatSession) -> str:
     """
     Toggle the speaker state (mute/unmute) and stop TTS if muting.
     """
-    global is_muted, tts_engine
-    is_muted = not is_muted
-    if is_muted:
-        try:
-            tts_engine.stop()
-        except Exception as e:
-            debug_log(f"TTS stop error: {e}")
+    session.is_muted = not session.is_muted
+    if session.is_muted:
+        stop_reading(session)
         debug_log("Speaker muted.")
         return "🔇 Speaker Muted"
     else:
         debug_log("Speaker unmuted.")
         return "🔊 Speaker On"
 
-def start_reading() -> str:
+def start_reading(session: ChatSession) -> str:
     """
     Start reading the latest response (TTS).
     """
-    global latest_response
-    if latest_response:
+    if session.latest_response:
         debug_log("Starting TTS reading.")
-        return speak_response()
+        return speak_response(session)
     return "⚠️ No response available to read."
 
-def stop_reading() -> str:
+def stop_reading(session: ChatSession) -> str:
     """
     Stop TTS reading.
     """
-    global tts_engine
-    try:
-        tts_engine.stop()
+    if session.utterance:
+        session.utterance = None
+        speech.stop()
         debug_log("TTS reading stopped.")
-        return "⏹ TTS stopped."
-    except Exception as e:
-        debug_log(f"TTS stop error: {e}")
-        return f"❌ Error stopping TTS: {e}"
+    return "⏹ TTS stopped."
 
-def restart_reading() -> str:
+def restart_reading(session: ChatSession) -> str:
     """
-    Restart TTS reading.
+    Restart TTS reading from the beginning of the latest response.
     """
-    stop_reading()
-    time.sleep(0.1)
-    return start_reading()
+    stop_reading(session)
+    return start_reading(session)
 
 
 with gr.Blocks(theme=gr.themes.Soft()) as ui:
@@ -278,7 +472,13 @@ with gr.Blocks(theme=gr.themes.Soft()) as ui:
     
 
     
+    # Per-session conversation state
+    session_state = gr.State(ChatSession())
+    # Stored conversation id, remembered by the browser across reloads and restarts
+    conversation_key = gr.BrowserState(None, storage_key="deepseek_conversation_id")
+
     # Use Chatbot component with 'messages' type for better UX
+    earlier_btn = gr.Button("⬆️ Load Earlier Messages", size="sm")
     chat_display = gr.Chatbot(label="Conversation", type="messages")
     
     with gr.Row():
@@ -289,6 +489,8 @@ with gr.Blocks(theme=gr.themes.Soft()) as ui:
     with gr.Row():
         mic_btn = gr.Button("🎙️ Voice Input")
         tts_btn = gr.Button("🔊 Speak Response")
+        stop_tts_btn = gr.Button("⏹ Stop Reading")
+        restart_tts_btn = gr.Button("🔁 Restart Reading")
         toggle_speaker_btn = gr.Button("Toggle Speaker")
         copy_btn = gr.Button("📋 Copy Output")
         regen_btn = gr.Button("🔄 Regenerate")
@@ -296,22 +498,39 @@ with gr.Blocks(theme=gr.themes.Soft()) as ui:
         stop_btn = gr.Button("🛑 Stop Chat")
     
     # Button interactions:
-    # For sending, we use our streaming function (which yields message lists)
-    send_btn.click(fn=stream_chat_with_ai, inputs=prompt_input, outputs=chat_display)
-    clear_btn.click(fn=clear_chat, inputs=None, outputs=chat_display)
-    regen_btn.click(fn=regenerate_last_response, inputs=None, outputs=chat_display)
-    stop_btn.click(fn=stop_chat, inputs=None, outputs=chat_display)
+    # For sending, we use our streaming function (which yields message lists).
+    # Generations share one concurrency group; quick controls never wait behind them.
+    send_event = send_btn.click(fn=stream_chat_with_ai, inputs=[prompt_input, session_state], outputs=chat_display,
+                                concurrency_limit=MAX_CONCURRENT_STREAMS, concurrency_id="generate")
+    regen_event = regen_btn.click(fn=regenerate_last_response, inputs=session_state, outputs=chat_display,
+                                  concurrency_limit=MAX_CONCURRENT_STREAMS, concurrency_id="generate")
+    clear_event = clear_btn.click(fn=clear_chat, inputs=session_state, outputs=chat_display, concurrency_limit=None)
+    stop_event = stop_btn.click(fn=stop_chat, inputs=session_state, outputs=chat_display,
+                                cancels=[send_event, regen_event], concurrency_limit=None)
+    earlier_btn.click(fn=load_earlier, inputs=session_state, outputs=chat_display, concurrency_limit=None)
+    # Remember which stored conversation this browser is on
+    for event in (send_event, regen_event, clear_event, stop_event):
+        event.then(fn=lambda session: session.conversation_id, inputs=session_state, outputs=conversation_key)
     mic_btn.click(fn=voice_input, inputs=None, outputs=prompt_input)
-    tts_btn.click(fn=speak_response, inputs=None, outputs=None)
-    toggle_speaker_btn.click(fn=toggle_speaker, inputs=None, outputs=None)
-    copy_btn.click(fn=copy_response, inputs=None, outputs=None)
+    tts_btn.click(fn=speak_response, inputs=session_state, outputs=None, concurrency_limit=None)
+    stop_tts_btn.click(fn=stop_reading, inputs=session_state, outputs=None, concurrency_limit=None)
+    restart_tts_btn.click(fn=restart_reading, inputs=session_state, outputs=None, concurrency_limit=None)
+    toggle_speaker_btn.click(fn=toggle_speaker, inputs=session_state, outputs=None, concurrency_limit=None)
+    copy_btn.click(fn=copy_response, inputs=session_state, outputs=None, concurrency_limit=None)
     
-    # Load handler to update the chat display when the app loads
-    ui.load(fn=lambda: chat_display, inputs=None, outputs=chat_display)
+    # Load handler: reopen this browser's conversation when the app loads
+    ui.load(fn=open_conversation, inputs=[conversation_key, session_state], outputs=chat_display)
+
+ui.queue(max_size=MAX_QUEUE_SIZE, default_concurrency_limit=MAX_CONCURRENT_STREAMS)
 
 # =============================================================================
 # Launch the Application on Localhost
 # =============================================================================
 
 if __name__ == "__main__":
+    # Prometheus-style latency metrics next to the Gradio server
+    start_metrics_server()
+    # Load the model while the UI starts, so the first message doesn't wait for it
+    start_warm_up(backend, *router.models)
+    get_document_index()   # Index CHATBOT_DOCS (if set) in the background
     ui.launch(server_name="127.0.0.1", server_port=7860, share=True)
@@ -0,0 +1,98 @@
+import re
+
+# =============================================================================
+# Conversation Context
+# =============================================================================
+#
+# Builds multi-turn prompts under a token budget. While the conversation fits,
+# the token `context` returned by Ollama's /api/generate is passed back with
+# the next prompt, so the model continues from its cached state instead of
+# re-reading the whole conversation. Once the budget is exceeded, older turns
+# are compacted or dropped and the prompt is rebuilt from text.
+
+THINK_PATTERN = re.compile(r"<think>.*?(?:</think>|$)", re.DOTALL)
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count (about four characters per token)."""
+    return len(text) // 4 + 1
+
+
+def strip_reasoning(text: str) -> str:
+    """Drop deepseek-r1 `<think>` sections, which aren't worth resending."""
+    return THINK_PATTERN.sub("", text).strip()
+
+
+class ConversationContext:
+    """
+    Prior turns of one conversation plus the model's returned context.
+    `budget_tokens` should match the model's context window (num_ctx);
+    `reserve_tokens` is left free for the reply.
+    """
+
+    def __init__(self, budget_tokens: int = 2048, reserve_tokens: int = 512,
+                 compact_chars: int = 600):
+        self.budget_tokens = budget_tokens
+        self.reserve_tokens = reserve_tokens
+        self.compact_chars = compact_chars
+        self.turns = []        # List of (user, assistant) pairs
+        self.context = None    # Token context returned for the latest turn
+        self.model = None      # Model that returned `context` (it is only valid for that model)
+
+    @property
+    def prompt_budget(self) -> int:
+        return max(self.budget_tokens - self.reserve_tokens, 0)
+
+    def request(self, prompt: str, model: str = None) -> dict:
+        """
+        Return keyword arguments for `OllamaBackend.generate` for the next turn.
+        Passing `model` routes the request to it; the saved context is only
+        reused if that model produced it.
+        """
+        if self.context and (model is None or model == self.model) \
+                and len(self.context) + estimate_tokens(prompt) <= self.prompt_budget:
+            request = {"prompt": prompt, "context": self.context}
+        else:
+            request = {"prompt": self.build_prompt(prompt)}
+        if model is not None:
+            request["model"] = model
+        return request
+
+    def build_prompt(self, prompt: str) -> str:
+        """Render retained turns plus the new prompt as one text prompt."""
+        remaining = self.prompt_budget - estimate_tokens(prompt)
+        history = []
+        for index, (user, assistant) in enumerate(reversed(self.turns)):
+            # Keep the most recent turn intact; shorten older answers.
+            answer = strip_reasoning(assistant)
+            if index > 0 and len(answer) > self.compact_chars:
+                answer = answer[:self.compact_chars].rstrip() + " …"
+            entry = f"User: {user}\nAssistant: {answer}\n\n"
+            cost = estimate_tokens(entry)
+            if cost > remaining:
+                break
+            history.append(entry)
+            remaining -= cost
+        if not history:
+            return prompt
+        history.reverse()
+        return "".join(history) + f"User: {prompt}\nAssistant:"
+
+    def add_turn(self, prompt: str, response: str, context=None, model: str = None):
+        """Record a finished turn and the context the model returned for it."""
+        self.turns.append((prompt, response))
+        self.context = context or None
+        self.model = model if context else None
+
+    def pop_turn(self):
+        """Remove and return the latest turn, e.g. before regenerating it."""
+        if not self.turns:
+            return None
+        # The stored context includes the popped turn, so it can't be reused.
+        self.context = None
+        return self.turns.pop()
+
+    def clear(self):
+        """Forget all turns."""
+        self.turns = []
+        self.context = None
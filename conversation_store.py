@@ -0,0 +1,173 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from collections import namedtuple
+
+# =============================================================================
+# Conversation Store
+# =============================================================================
+#
+# Keeps every conversation on disk so it survives restarts. Turns are only
+# ever appended (regenerating an answer retracts the old turn with a flag
+# instead of rewriting it), one row per finished turn. Reopening a
+# conversation reads just the most recent page of turns; older pages are
+# fetched on demand through the (conversation, seq) primary key, so startup
+# time and memory don't depend on how long the conversation is.
+
+DEFAULT_DATA_DIR = os.environ.get(
+    "CHATBOT_DATA_DIR", os.path.join(os.path.expanduser("~"), ".local", "share", "deepseek_chatbot"))
+PAGE_SIZE = 20
+
+# One stored turn; `note` marks stopped or failed turns
+StoredTurn = namedtuple("StoredTurn", "seq prompt answer reasoning note created_at")
+
+
+class ConversationStore:
+    """SQLite-backed, append-only store of conversations and their turns. Thread-safe."""
+
+    def __init__(self, path: str = None):
+        if path is None:
+            os.makedirs(DEFAULT_DATA_DIR, exist_ok=True)
+            path = os.path.join(DEFAULT_DATA_DIR, "conversations.sqlite3")
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                frontend TEXT NOT NULL,
+                title TEXT NOT NULL DEFAULT '',
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                last_seq INTEGER NOT NULL DEFAULT 0,
+                context TEXT,
+                model TEXT
+            );
+            CREATE INDEX IF NOT EXISTS conversations_recent ON conversations (frontend, updated_at);
+            CREATE TABLE IF NOT EXISTS turns (
+                conversation_id TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                prompt TEXT NOT NULL,
+                answer TEXT NOT NULL,
+                reasoning TEXT NOT NULL DEFAULT '',
+                note TEXT NOT NULL DEFAULT '',
+                created_at REAL NOT NULL,
+                retracted INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (conversation_id, seq)
+            ) WITHOUT ROWID;
+        """)
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(conversations)")]
+        if "model" not in columns:
+            self._db.execute("ALTER TABLE conversations ADD COLUMN model TEXT")
+        self._db.commit()
+
+    def create(self, frontend: str, title: str = "") -> str:
+        """Start a new conversation and return its id."""
+        conversation_id = uuid.uuid4().hex
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT INTO conversations (id, frontend, title, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (conversation_id, frontend, title[:80], now, now))
+            self._db.commit()
+        return conversation_id
+
+    def append_turn(self, conversation_id: str, prompt: str, answer: str, reasoning: str = "",
+                    note: str = "", context=None, model: str = None) -> int:
+        """
+        Append a finished turn and return its sequence number. `context` is
+        the context returned by `model`, kept only for the latest turn.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT last_seq, title FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+            if row is None:
+                raise KeyError(conversation_id)
+            seq, title = row[0] + 1, row[1] or prompt[:80]
+            self._db.execute(
+                "INSERT INTO turns (conversation_id, seq, prompt, answer, reasoning, note, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (conversation_id, seq, prompt, answer, reasoning, note, now))
+            self._db.execute(
+                "UPDATE conversations SET last_seq = ?, title = ?, updated_at = ?, context = ?, model = ? "
+                "WHERE id = ?",
+                (seq, title, now, json.dumps(context) if context else None,
+                 model if context else None, conversation_id))
+            self._db.commit()
+        return seq
+
+    def retract_turn(self, conversation_id: str, seq: int):
+        """Hide a turn, e.g. one whose answer is being regenerated."""
+        with self._lock:
+            self._db.execute("UPDATE turns SET retracted = 1 WHERE conversation_id = ? AND seq = ?",
+                             (conversation_id, seq))
+            # The saved context includes the retracted turn
+            self._db.execute("UPDATE conversations SET context = NULL, model = NULL WHERE id = ?", (conversation_id,))
+            self._db.commit()
+
+    def load_page(self, conversation_id: str, before: int = None, limit: int = PAGE_SIZE) -> list:
+        """The `limit` turns preceding sequence number `before` (default: the latest), oldest first."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT seq, prompt, answer, reasoning, note, created_at FROM turns "
+                "WHERE conversation_id = ? AND seq < ? AND retracted = 0 ORDER BY seq DESC LIMIT ?",
+                (conversation_id, before if before is not None else 1 << 62, limit)).fetchall()
+        return [StoredTurn(*row) for row in reversed(rows)]
+
+    def has_older(self, conversation_id: str, before: int) -> bool:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT 1 FROM turns WHERE conversation_id = ? AND seq < ? AND retracted = 0 LIMIT 1",
+                (conversation_id, before)).fetchone()
+        return row is not None
+
+    def latest(self, frontend: str):
+        """Id of the most recently updated conversation of a front-end, or None."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id FROM conversations WHERE frontend = ? ORDER BY updated_at DESC LIMIT 1",
+                (frontend,)).fetchone()
+        return row[0] if row else None
+
+    def exists(self, conversation_id: str) -> bool:
+        with self._lock:
+            row = self._db.execute("SELECT 1 FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+        return row is not None
+
+    def resume(self, conversation_id: str, conversation, limit: int = PAGE_SIZE) -> list:
+        """
+        Load the latest page into a ConversationContext (turns plus the saved
+        model context, with the model that returned it) and return it for display.
+        """
+        turns = self.load_page(conversation_id, limit=limit)
+        with self._lock:
+            row = self._db.execute("SELECT context, model FROM conversations WHERE id = ?",
+                                   (conversation_id,)).fetchone()
+        conversation.clear()
+        for turn in turns:
+            if turn.answer:
+                conversation.add_turn(turn.prompt, turn.answer)
+        if row and row[0] and turns and not turns[-1].note:
+            conversation.context = json.loads(row[0])
+            conversation.model = row[1]
+        return turns
+
+
+_default_store = None
+_default_lock = threading.Lock()
+
+
+def get_conversation_store() -> ConversationStore:
+    """Process-wide conversation store shared by every front-end in this process."""
+    global _default_store
+    with _default_lock:
+        if _default_store is None:
+            _default_store = ConversationStore()
+        return _default_store
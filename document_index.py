@@ -0,0 +1,584 @@
+import bisect
+import hashlib
+import heapq
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from array import array
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from operator import itemgetter
+
+try:
+    import fcntl
+except ImportError:   # Windows: updates are only serialized within one process
+    fcntl = None
+
+from conversation_store import DEFAULT_DATA_DIR
+
+# =============================================================================
+# Local Document Retrieval
+# =============================================================================
+#
+# Lets the bot answer from a folder of local documents (CHATBOT_DOCS): text,
+# markdown and PDFs (text extracted with pypdf when it is installed). Files
+# are split into passages of about PASSAGE_WORDS words and indexed into an
+# on-disk BM25 inverted index. The top passages for a prompt are placed in
+# the prompt with their source files, so the answer can cite them.
+#
+# The index is a set of immutable segment files plus a JSON manifest of the
+# indexed files. Segments are memory-mapped and looked up through an
+# on-disk hash table of terms, so opening even a large index reads almost
+# nothing. A background thread rescans the folder every WATCH_INTERVAL
+# seconds. New and changed files go into a new segment. Passages of changed
+# and deleted files are just dropped from the manifest, and sparse or small
+# segments are merged from time to time.
+#
+# Several processes (e.g. the Gradio and Tk front-ends) may share one
+# index_dir. Every update, manifest write and orphan cleanup happens under an
+# exclusive lock on index_dir/lock, after reloading the manifest if another
+# process has committed since. Segment names therefore never collide, and
+# files another process is still writing are never taken for orphans.
+#
+# Each term's postings are stored in descending order of their BM25
+# term-frequency weight, quantized to a byte. A query reads at most
+# MAX_POSTINGS of each term's best postings across all segments. Retrieval
+# therefore stays in the low milliseconds on millions of passages, in pure
+# Python with no network or GPU. Only the weakest matches of very common
+# terms are skipped, and those barely move the ranking.
+
+DOCS_DIR = os.environ.get("CHATBOT_DOCS", "")
+INDEX_DIR = os.environ.get("CHATBOT_INDEX_DIR", os.path.join(DEFAULT_DATA_DIR, "doc_index"))
+TOP_K = int(os.environ.get("CHATBOT_RAG_TOP_K", "4"))
+EXTENSIONS = (".txt", ".md", ".markdown", ".pdf")
+PASSAGE_WORDS = 120
+SEGMENT_PASSAGES = 100_000   # Passages per segment (bounds memory while indexing)
+MAX_SEGMENTS = 16            # More than this and small segments are merged
+MAX_POSTINGS = 2000          # Postings read per query term, best first
+WATCH_INTERVAL = 30.0        # Seconds between folder rescans
+K1, B = 1.2, 0.75            # BM25 parameters
+
+MAGIC = b"BM25SEG1"
+HEADER = struct.Struct("<8sIIIQQQ")     # magic, passages, terms, table slots, table/postings/passage offsets
+SLOT = struct.Struct("<QQI")            # term hash, postings offset, document frequency
+PASSAGE = struct.Struct("<QII")         # text offset, text bytes, length in terms
+
+TOKEN = re.compile(r"\w+")
+STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have he her his i if in into is it its me my no not of "
+    "on or our she so than that the their them then there these they this to was we were what when "
+    "which who will with you your".split())
+
+# One retrieved passage; `source` is relative to the documents folder
+Passage = namedtuple("Passage", "source text score")
+
+
+def tokenize(text: str) -> list:
+    """Lowercased index terms of `text`, without stopwords."""
+    return [t for t in TOKEN.findall(text.lower()) if t not in STOPWORDS and len(t) < 64]
+
+
+def term_hash(term: str) -> int:
+    """Stable 64-bit key of a term (0 marks an empty hash-table slot)."""
+    return int.from_bytes(hashlib.blake2b(term.encode("utf-8"), digest_size=8).digest(), "little") or 1
+
+
+def read_document(path: str) -> str:
+    """Text of a document; PDFs need pypdf (imported on first use)."""
+    if path.lower().endswith(".pdf"):
+        from pypdf import PdfReader
+        return "\n\n".join(page.extract_text() or "" for page in PdfReader(path).pages)
+    with open(path, encoding="utf-8", errors="replace") as f:
+        return f.read()
+
+
+def split_passages(text: str, words: int = PASSAGE_WORDS) -> list:
+    """Passages of about `words` words, split at paragraph breaks where possible."""
+    passages, current = [], []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph_words = paragraph.split()
+        if current and len(current) + len(paragraph_words) > words:
+            passages.append(" ".join(current))
+            current = []
+        current += paragraph_words
+        while len(current) >= words:
+            passages.append(" ".join(current[:words]))
+            current = current[words:]
+    if current:
+        passages.append(" ".join(current))
+    return passages
+
+
+# ---- Segment files ---------------------------------------------------------
+
+class _SegmentBuilder:
+    """Collects passages in memory and writes them out as one segment file."""
+
+    def __init__(self):
+        self.texts = []
+        self.lengths = []
+        self.postings = {}        # term -> array of passage, term frequency pairs (compact while building)
+
+    def __len__(self):
+        return len(self.texts)
+
+    def add(self, passages) -> int:
+        """Add a file's passages; returns the segment-local id of the first."""
+        first = len(self.texts)
+        for text in passages:
+            pid = len(self.texts)
+            counts = Counter(tokenize(text))
+            self.texts.append(text)
+            self.lengths.append(sum(counts.values()))
+            for term, tf in counts.items():
+                entries = self.postings.get(term)
+                if entries is None:
+                    entries = self.postings[term] = array("I")
+                entries.append(pid)
+                entries.append(tf)
+        return first
+
+    def write(self, path: str):
+        avgdl = (sum(self.lengths) / len(self.lengths)) or 1.0
+        slots = 1 << max(4, (2 * len(self.postings)).bit_length())
+        table = bytearray(SLOT.size * slots)
+        postings = bytearray()
+        table_offset = HEADER.size
+        postings_offset = table_offset + len(table)
+        for term, entries in self.postings.items():
+            # Quantized BM25 term weight; postings are stored best first
+            impacts = [(round(255 * tf / (tf + K1 * (1 - B + B * self.lengths[pid] / avgdl))) or 1, pid)
+                       for pid, tf in zip(entries[::2], entries[1::2])]
+            impacts.sort(key=lambda entry: -entry[0])
+            key = term_hash(term)
+            slot = key & (slots - 1)
+            while SLOT.unpack_from(table, slot * SLOT.size)[0]:
+                slot = (slot + 1) & (slots - 1)
+            SLOT.pack_into(table, slot * SLOT.size, key, postings_offset + len(postings), len(impacts))
+            postings += array("I", (pid for _, pid in impacts)).tobytes()
+            postings += bytes(impact for impact, _ in impacts)
+            postings += bytes(-len(postings) % 4)   # Keep the next term's ids aligned
+        passages_offset = postings_offset + len(postings)
+        text_offset = passages_offset + PASSAGE.size * len(self.texts)
+        passage_table = bytearray()
+        blob = bytearray()
+        for text, length in zip(self.texts, self.lengths):
+            data = text.encode("utf-8")
+            passage_table += PASSAGE.pack(text_offset + len(blob), len(data), length)
+            blob += data
+        header = HEADER.pack(MAGIC, len(self.texts), len(self.postings), slots,
+                             table_offset, postings_offset, passages_offset)
+        temporary = path + ".tmp"
+        with open(temporary, "wb") as f:
+            for part in (header, table, postings, passage_table, blob):
+                f.write(part)
+        os.replace(temporary, path)
+
+
+class _Segment:
+    """Read-only, memory-mapped segment file."""
+
+    def __init__(self, path: str, name: str):
+        self.name = name
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._view = memoryview(self._map)
+        (magic, self.passages, self.terms, self.slots, table_offset, _,
+         self.passages_offset) = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path}: not an index segment")
+        self._table_offset = table_offset
+
+    def lookup(self, key: int):
+        """(postings offset, document frequency) of a term hash, or None."""
+        mask = self.slots - 1
+        slot = key & mask
+        while True:
+            found, offset, df = SLOT.unpack_from(self._map, self._table_offset + slot * SLOT.size)
+            if found == key:
+                return offset, df
+            if not found:
+                return None
+            slot = (slot + 1) & mask
+
+    def postings(self, offset: int, df: int, limit: int):
+        """Passage ids and impacts of a term's `limit` best postings (zero-copy)."""
+        count = min(df, limit)
+        ids = self._view[offset:offset + 4 * count].cast("I")
+        impacts = self._view[offset + 4 * df:offset + 4 * df + count]
+        return ids, impacts
+
+    def text(self, pid: int) -> str:
+        offset, size, _ = PASSAGE.unpack_from(self._map, self.passages_offset + pid * PASSAGE.size)
+        return self._map[offset:offset + size].decode("utf-8")
+
+
+class _SegmentView:
+    """A segment plus which of its passages are live and the file each came from."""
+
+    def __init__(self, segment: _Segment, files):
+        self.segment = segment
+        ranges = sorted((entry["first"], entry["count"], path) for path, entry in files)
+        self.starts = [first for first, _, _ in ranges]
+        self.ends = [first + count for first, count, _ in ranges]
+        self.paths = [path for _, _, path in ranges]
+        self.live = sum(count for _, count, _ in ranges)
+
+    def source(self, pid: int):
+        """Source file of a live passage, or None for a passage of a changed or deleted file."""
+        index = bisect.bisect_right(self.starts, pid) - 1
+        if index >= 0 and pid < self.ends[index]:
+            return self.paths[index]
+        return None
+
+
+# ---- Index -----------------------------------------------------------------
+
+class DocumentIndex:
+    """
+    BM25 index of the documents under `docs_dir`, kept in `index_dir`.
+    `search` is thread-safe and never waits for an update in progress.
+    """
+
+    def __init__(self, docs_dir: str = DOCS_DIR, index_dir: str = INDEX_DIR):
+        self.docs_dir = os.path.abspath(docs_dir)
+        self.index_dir = index_dir
+        self._manifest_path = os.path.join(index_dir, "manifest.json")
+        self._lock_path = os.path.join(index_dir, "lock")
+        self._update_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._watcher = None
+        self._pdf_warned = False
+        os.makedirs(index_dir, exist_ok=True)
+        with self._locked():
+            self._stamp = self._manifest_stamp()
+            self._manifest = self._load_manifest()
+            self._views = self._open_views(self._manifest)
+            self._remove_orphans()
+
+    # ---- Manifest ----------------------------------------------------------
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive access to index_dir, against other threads and (with fcntl) other processes."""
+        with self._update_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(self._lock_path, "a") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _manifest_stamp(self):
+        """Identity of the manifest file on disk (replaced, never rewritten in place)."""
+        try:
+            stat = os.stat(self._manifest_path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+    def _reload(self):
+        """Switch to the manifest another process committed since ours (call with the lock held)."""
+        stamp = self._manifest_stamp()
+        if stamp != self._stamp:
+            manifest = self._load_manifest()
+            self._manifest, self._views = manifest, self._open_views(manifest)
+            self._stamp = stamp
+
+    def _load_manifest(self) -> dict:
+        try:
+            with open(self._manifest_path, encoding="utf-8") as f:
+                manifest = json.load(f)
+            if manifest.get("docs_dir") == self.docs_dir:
+                return manifest
+            print(f"[DEBUG] Document index was built for {manifest.get('docs_dir')}; rebuilding")
+        except (OSError, ValueError):
+            pass
+        return {"docs_dir": self.docs_dir, "next_segment": 0, "segments": [], "files": {}}
+
+    def _save_manifest(self, manifest: dict):
+        temporary = self._manifest_path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+        os.replace(temporary, self._manifest_path)
+        self._stamp = self._manifest_stamp()
+
+    def _open_views(self, manifest: dict) -> list:
+        by_segment = {name: [] for name in manifest["segments"]}
+        for path, entry in manifest["files"].items():
+            if entry["segment"]:
+                by_segment[entry["segment"]].append((path, entry))
+        views = []
+        for name in manifest["segments"]:
+            old = next((v for v in getattr(self, "_views", ()) if v.segment.name == name), None)
+            segment = old.segment if old else _Segment(os.path.join(self.index_dir, name), name)
+            views.append(_SegmentView(segment, by_segment[name]))
+        return views
+
+    def _remove_orphans(self):
+        """Delete segment files no longer in the manifest (they may have been mapped when dropped)."""
+        live = set(self._manifest["segments"])
+        for name in os.listdir(self.index_dir):
+            if name.endswith((".seg", ".seg.tmp")) and name not in live:
+                try:
+                    os.remove(os.path.join(self.index_dir, name))
+                except OSError:
+                    pass   # Still mapped on Windows; removed on a later run
+
+    # ---- Updates -----------------------------------------------------------
+
+    def _scan(self) -> dict:
+        """Relative path -> [mtime_ns, size] of every indexable file."""
+        found = {}
+        for root, dirs, files in os.walk(self.docs_dir):
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            for name in files:
+                if not name.lower().endswith(EXTENSIONS):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                found[os.path.relpath(path, self.docs_dir)] = [stat.st_mtime_ns, stat.st_size]
+        return found
+
+    def _passages(self, relative: str) -> list:
+        try:
+            return split_passages(read_document(os.path.join(self.docs_dir, relative)))
+        except ImportError:
+            if not self._pdf_warned:
+                self._pdf_warned = True
+                print("[DEBUG] pypdf is not installed; skipping PDF documents")
+        except Exception as e:
+            print(f"[DEBUG] Could not index {relative}: {e}")
+        return []
+
+    def refresh(self) -> dict:
+        """Bring the index up to date with the folder; returns counts of what changed."""
+        with self._locked():
+            started = time.perf_counter()
+            self._reload()
+            manifest = json.loads(json.dumps(self._manifest))   # Edited copy; searches use the old one
+            files = manifest["files"]
+            found = self._scan()
+            removed = [path for path in files if path not in found]
+            changed = [path for path, stat in found.items()
+                       if path not in files or files[path]["stat"] != stat]
+            for path in removed + changed:
+                files.pop(path, None)
+            writer = _Writer(self, manifest)
+            for path in changed:
+                writer.add(path, found[path], self._passages(path))
+            writer.flush()
+            self._compact(manifest, writer)
+            if not (removed or changed or writer.rewritten):
+                return {"added": 0, "removed": 0, "seconds": 0.0}
+            self._commit(manifest)
+            counts = {"added": len(changed), "removed": len(removed),
+                      "seconds": round(time.perf_counter() - started, 2)}
+            print(f"[DEBUG] Document index updated: {counts}")
+            return counts
+
+    def _compact(self, manifest: dict, writer):
+        """Merge sparse or small segments once there are too many, or drop empty ones."""
+        live = Counter()
+        for entry in manifest["files"].values():
+            live[entry["segment"]] += entry["count"]
+        sizes = {view.segment.name: view.segment.passages for view in self._views}
+        sizes.update(writer.sizes)
+        merge = [name for name in manifest["segments"] if live[name] == 0 or live[name] < sizes[name] // 2]
+        if len(manifest["segments"]) - len(merge) > MAX_SEGMENTS:
+            small = sorted((name for name in manifest["segments"] if name not in merge), key=lambda n: live[n])
+            merge += small[:len(manifest["segments"]) - len(merge) - MAX_SEGMENTS + 1]
+        if not merge or (len(merge) == 1 and 0 < live[merge[0]] == sizes[merge[0]]):
+            return
+        segments = {view.segment.name: view.segment for view in self._views}
+        for path, entry in sorted(manifest["files"].items()):
+            if entry["segment"] in merge:
+                segment = segments.get(entry["segment"]) or writer.open(entry["segment"])
+                passages = [segment.text(pid) for pid in range(entry["first"], entry["first"] + entry["count"])]
+                writer.add(path, entry["stat"], passages)
+        writer.flush()
+        manifest["segments"] = [name for name in manifest["segments"] if name not in merge]
+        writer.rewritten = True
+
+    def _commit(self, manifest: dict):
+        self._save_manifest(manifest)
+        views = self._open_views(manifest)
+        self._manifest, self._views = manifest, views   # Swapped together for searches in flight
+        self._remove_orphans()
+
+    def watch(self, interval: float = WATCH_INTERVAL):
+        """Index the folder now and then keep rescanning it on a daemon thread."""
+        def run():
+            while not self._stop.is_set():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"[DEBUG] Document index update failed: {e}")
+                self._stop.wait(interval)
+
+        if self._watcher is None:
+            self._watcher = threading.Thread(target=run, name="doc-index", daemon=True)
+            self._watcher.start()
+
+    def close(self):
+        self._stop.set()
+
+    # ---- Search ------------------------------------------------------------
+
+    @property
+    def passages(self) -> int:
+        return sum(view.live for view in self._views)
+
+    def search(self, query: str, k: int = TOP_K) -> list:
+        """The `k` best live passages for `query`, best first."""
+        views = self._views
+        total = sum(view.live for view in views)
+        terms = set(tokenize(query))
+        if not total or not terms:
+            return []
+        scores = {}
+        current = scores.get
+        for term in terms:
+            key = term_hash(term)
+            found = [(number, hit) for number, view in enumerate(views) if (hit := view.segment.lookup(key))]
+            df = sum(segment_df for _, (_, segment_df) in found)
+            if not df:
+                continue
+            # BM25 idf times the dequantized term-frequency weight, per impact byte
+            weight = math.log(1 + (total - df + 0.5) / (df + 0.5)) * (K1 + 1) / 255
+            contribution = [weight * impact for impact in range(256)]
+            for number, (offset, segment_df) in found:
+                # Each segment's share of the budget, by its share of the postings
+                limit = max(1, MAX_POSTINGS * segment_df // df)
+                ids, impacts = views[number].segment.postings(offset, segment_df, limit)
+                base = number << 32   # Score key: segment number and passage id
+                for pid, impact in zip(ids, impacts):
+                    hit = base | pid
+                    scores[hit] = current(hit, 0.0) + contribution[impact]
+        results = []
+        for hit, score in _ranked(scores, k + 16):
+            number, pid = hit >> 32, hit & 0xFFFFFFFF
+            source = views[number].source(pid)
+            if source is None:
+                continue   # Passage of a changed or deleted file
+            results.append(Passage(source, views[number].segment.text(pid), score))
+            if len(results) >= k:
+                break
+        return results
+
+
+def _ranked(scores: dict, first: int):
+    """Score items best first; only the top `first` are ranked unless more are needed."""
+    top = heapq.nlargest(first, scores.items(), key=itemgetter(1))
+    yield from top
+    if len(top) < len(scores):
+        # Many of the best passages belonged to changed or deleted files
+        yield from sorted(scores.items(), key=itemgetter(1), reverse=True)[len(top):]
+
+
+class _Writer:
+    """Adds files to new segments of a manifest being edited."""
+
+    def __init__(self, index: DocumentIndex, manifest: dict):
+        self.index = index
+        self.manifest = manifest
+        self.builder = _SegmentBuilder()
+        self.pending = []         # (path, entry) of files in the builder
+        self.sizes = {}           # New segment -> passages
+        self.rewritten = False
+        self._opened = {}
+
+    def add(self, path: str, stat, passages):
+        if len(self.builder) + len(passages) > SEGMENT_PASSAGES and len(self.builder):
+            self.flush()
+        first = self.builder.add(passages)
+        self.pending.append((path, {"stat": stat, "first": first, "count": len(passages)}))
+
+    def flush(self):
+        if not len(self.builder):
+            for path, entry in self.pending:   # Files without any text
+                entry["segment"] = None
+                self.manifest["files"][path] = entry
+            self.pending = []
+            return
+        name = f"{self.manifest['next_segment']:06d}.seg"
+        self.manifest["next_segment"] += 1
+        self.builder.write(os.path.join(self.index.index_dir, name))
+        self.manifest["segments"].append(name)
+        self.sizes[name] = len(self.builder)
+        for path, entry in self.pending:
+            entry["segment"] = name
+            self.manifest["files"][path] = entry
+        self.builder = _SegmentBuilder()
+        self.pending = []
+
+    def open(self, name: str) -> _Segment:
+        if name not in self._opened:
+            self._opened[name] = _Segment(os.path.join(self.index.index_dir, name), name)
+        return self._opened[name]
+
+
+def build_prompt(prompt: str, passages) -> str:
+    """The prompt with retrieved passages and their sources placed before it."""
+    if not passages:
+        return prompt
+    excerpts = "\n\n".join(f"[{n}] {p.source}:\n{p.text}" for n, p in enumerate(passages, 1))
+    return ("Excerpts from local documents (cite them by number if you use them):\n\n"
+            f"{excerpts}\n\nQuestion: {prompt}")
+
+
+_default_index = None
+_default_lock = threading.Lock()
+
+
+def get_document_index():
+    """Process-wide index of CHATBOT_DOCS, kept up to date in the background; None if unset."""
+    global _default_index
+    if not DOCS_DIR:
+        return None
+    with _default_lock:
+        if _default_index is None:
+            _default_index = DocumentIndex()
+            _default_index.watch()
+        return _default_index
+
+
+def augment(prompt: str, k: int = TOP_K):
+    """
+    (prompt for the model, source files used): the prompt with its top-k
+    passages when a document folder is configured, otherwise unchanged.
+    """
+    index = get_document_index()
+    if index is None:
+        return prompt, []
+    started = time.perf_counter()
+    passages = index.search(prompt, k)
+    if passages:
+        print(f"[DEBUG] Retrieved {len(passages)} passages in "
+              f"{(time.perf_counter() - started) * 1000:.1f} ms")
+    sources = list(dict.fromkeys(p.source for p in passages))
+    return build_prompt(prompt, passages), sources
+
+
+if __name__ == "__main__":
+    # Index a folder and query it:  python document_index.py DOCS_DIR "question"
+    index = DocumentIndex(sys.argv[1]) if len(sys.argv) > 1 else DocumentIndex()
+    print(index.refresh(), f"{index.passages} passages")
+    for query in sys.argv[2:]:
+        started = time.perf_counter()
+        hits = index.search(query)
+        print(f"{query!r}: {(time.perf_counter() - started) * 1000:.2f} ms")
+        for hit in hits:
+            print(f"  {hit.score:6.2f}  {hit.source}: {hit.text[:100]}")
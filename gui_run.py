@@ -1,14 +1,26 @@
-import subprocess
 import threading
+import time
 import tkinter as tk
 from tkinter import scrolledtext, Toplevel, messagebox
-import speech_recognition as sr
-import pyttsx3
-import time
-import pyperclip  # For Copy Output functionality
 
-import mistune
-from bs4 import BeautifulSoup
+from backend_pool import make_backend
+from cancellation import CancelToken
+from chat_view import VirtualChatView
+from conversation_context import ConversationContext
+from conversation_store import StoredTurn, get_conversation_store
+from document_index import augment, get_document_index
+from markdown_render import configure_tk_tags, markdown_to_plain
+from metrics import RequestTrace
+from model_router import get_router
+from ollama_backend import start_warm_up
+from response_cache import get_response_cache
+from scheduler import describe_wait, get_scheduler
+from stt_worker import get_speech_input
+from think_parser import REASONING, ThinkStreamParser
+from tk_render import TkRenderQueue, sources_line
+from tts_worker import get_speech_pipeline
+
+FRONTEND = "desktop"  # Conversation store and metrics label
 
 class DeepSeekChatbot:
     def __init__(self, root):
@@ -30,6 +42,15 @@ class DeepSeekChatbot:
         self.chat_history = scrolledtext.ScrolledText(root, width=75, height=20, font=("Arial", 12), bg="#34495e", fg="white")
         self.chat_history.pack(pady=10, fill=tk.Y, expand=True)
         self.chat_history.config(state=tk.DISABLED)  # Read-only
+        self.chat_history.tag_config("user", foreground="Pink")
+        self.chat_history.tag_config("think", foreground="gray")
+        self.chat_history.tag_config("bot", foreground="lightgreen")
+        self.chat_history.tag_config("error", foreground="red")
+        configure_tk_tags(self.chat_history)   # Bold, code and headings in rendered answers
+        # Streamed text is written once per frame from the Tk main loop
+        self.render = TkRenderQueue(self.chat_history, animate=True)
+        # Only a bounded window of turns stays in the widget; the rest re-render on scroll
+        self.view = VirtualChatView(self.chat_history, self.render, load_older=self.fetch_older)
 
         # User Input Frame
         self.user_input_frame = tk.Frame(root, bg="#34495e")
@@ -65,40 +86,50 @@ class DeepSeekChatbot:
         self.regenerate_btn = tk.Button(self.button_frame, text="Regenerate", command=self.regenerate_response, font=("Arial", 12), bg="#28a745", fg="white")
         self.regenerate_btn.pack(side=tk.LEFT, padx=5)
 
-        self.process = None  # Store the subprocess instance
+        self.earlier_btn = tk.Button(self.button_frame, text="Load Earlier", command=self.load_earlier, font=("Arial", 12), bg="#6c757d", fg="white")
+        self.earlier_btn.pack(side=tk.LEFT, padx=5)
+
+        self.backend = make_backend()  # One Ollama host, or a balanced pool (OLLAMA_HOSTS)
+        self.router = get_router()  # Picks a deepseek-r1 size per prompt
+        start_warm_up(self.backend, *self.router.models)  # Models load while the window opens
+        get_document_index()  # Local documents (CHATBOT_DOCS) are indexed in the background
+        self.stream = None  # Store the active generation stream
+        self.conversation = ConversationContext()  # Prior turns sent with each prompt
+        self.scheduler = get_scheduler()  # Caps concurrent generations per model
+        self.cancel_token = None  # Cancels the current generation end to end
+        self.response_cache = get_response_cache()  # Replays answers to repeated prompts
         self.latest_response = ""  # Reset before new response
         self.is_muted = False  # Track mute state
-        self.speech_thread = None  # Store the speech thread
+        self.speech = get_speech_pipeline()  # Persistent TTS engine on its own thread
+        self.speech_input = get_speech_input()  # Streaming speech recognition on one microphone stream
+        self.conversation_store = get_conversation_store()  # Conversations survive restarts
+        self.conversation_id = self.conversation_store.latest(FRONTEND)
+        self.reopen_conversation()
 
     def toggle_speaker(self):
         """Toggle between mute and speaker functionality."""
         if self.is_muted:
             self.speaker_btn.config(text="🔊")
             self.is_muted = False
+            self.speech.unmute()
             if self.latest_response:
                 self.start_reading()  # Start reading
         else:
             self.speaker_btn.config(text="🔇")
             self.is_muted = True
-            self.stop_reading()  # Stop reading
+            self.speech.mute()  # Stop reading and drop queued sentences
 
 
     def start_reading(self):
         """Start reading the latest response immediately."""
         if self.latest_response:
-            self.is_speaking = True  # Set flag to indicate speech is active
-            self.speaker_btn.config(text="🔇")  # Change button icon
             print("paContinue")  # Signal reading start
-            self.speech_thread = threading.Thread(target=self.speak_output, daemon=True)
-            self.speech_thread.start()
+            self.speak_output()
 
     def stop_reading(self):
         """Immediately stop reading the output."""
-        if self.speech_thread and self.speech_thread.is_alive():
-            print("paAbort")  # Signal reading stopped
-            self.is_speaking = False  # Reset flag
-            self.speaker_btn.config(text="🔊")  # Change button icon
-            self.speech_thread.join(timeout=0.1)  # Attempt immediate stop
+        print("paAbort")  # Signal reading stopped
+        self.speech.stop()
 
     def restart_reading(self):
         """Restart the reading process."""
@@ -106,104 +137,221 @@ class DeepSeekChatbot:
         self.start_reading()  # Start again
         print("paComplete")  # Signal completion of restart
 
-    def markdown_to_plain(md_text):
-        html = mistune.markdown(md_text)
-        soup = BeautifulSoup(html, "html.parser")
-        return soup.get_text()
-
-
-    def run_deepseek(self, prompt):
-        """Run DeepSeek model and process the output."""
-        self.status_button.config(text="Generating...", bg="Red")
-        self.send_btn.config(state=tk.DISABLED)
+    def reopen_conversation(self):
+        """Show the latest page of the last conversation; older pages load on demand."""
+        if self.conversation_id is None:
+            return
+        turns = self.conversation_store.resume(self.conversation_id, self.conversation)
+        if turns:
+            self.latest_response = markdown_to_plain(turns[-1].answer).strip()
+            self.view.set_turns(turns)
+
+    def load_earlier(self):
+        """Render the previous page of turns (scrolling to the top does the same)."""
+        self.render.flush()
+        self.view.page_up()
+
+    def fetch_older(self, before):
+        """Stored turns preceding `before`, for the chat view."""
+        if self.conversation_id is None:
+            return []
+        return self.conversation_store.load_page(self.conversation_id, before=before)
+
+    def save_turn(self, prompt, parser, status, context=None, model=None):
+        """Append a finished (or stopped) turn to the stored conversation; returns its seq."""
+        if status == "error" or not (status == "ok" or parser.answer):
+            return None
         try:
-            self.process = subprocess.Popen(
-                ["ollama", "run", "deepseek-r1:1.5b"],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True,
-                bufsize=1
-            )
-
-            # Send user input to DeepSeek
-            self.process.stdin.write(prompt + "\n")
-            self.process.stdin.flush()
-            self.process.stdin.close()
-
-            # Enable chat history update
-            self.chat_history.config(state=tk.NORMAL)
-            self.chat_history.insert(tk.END, f"\n🧑‍💻 You: {prompt}\n", "user")
-            self.chat_history.tag_config("user", foreground="Pink")
-
-            # Read output in real-time
-            response = ""
-            for line in iter(self.process.stdout.readline, ""):
-                response += line
-                self.typewriter_effect((line), "bot")
-
+            if self.conversation_id is None:
+                self.conversation_id = self.conversation_store.create(FRONTEND)
+            seq = self.conversation_store.append_turn(
+                self.conversation_id, prompt, parser.answer.strip(), parser.reasoning.strip(),
+                "" if status == "ok" else "🛑 Chat stopped.", context, model)
+            return seq
+        except Exception as e:
+            print(f"[DEBUG] Could not save turn: {e}")
+            return None
+
+    def run_deepseek(self, prompt, bypass_cache=False, cancel_token=None):
+        """Run DeepSeek model and process the output (worker thread; Tk calls go through the render queue)."""
+        ui = self.render.call
+        ui(self.status_button.config, text="Generating...", bg="Red")
+        ui(self.send_btn.config, state=tk.DISABLED)
+        if cancel_token is None:
+            cancel_token = self.cancel_token = CancelToken()
+        ticket = None
+        model = self.router.route(prompt)
+        trace = RequestTrace(FRONTEND, model)
+        parser = ThinkStreamParser()
+        render_start = self.render.render_seconds
+        status = "ok"
+        note = ""
+        ui(self.view.begin_live)
+        self.render.write(f"\n🧑‍💻 You: {prompt}\n", "user")
+        # Passages from the local document folder (if configured) go into the model's prompt
+        # and skip near-duplicate matching, where the passages would dominate the comparison
+        model_prompt, sources = augment(prompt)
+        if sources:
+            self.render.write(sources_line(sources), "think")
+        try:
+            # Send user input to DeepSeek (cached answers are replayed)
+            self.stream = self.response_cache.generate(
+                self.backend, bypass=bypass_cache, standalone=not (self.conversation.turns or sources),
+                cancel_token=cancel_token, **self.conversation.request(model_prompt, model))
+
+            # Wait for a free generation slot
+            if not self.stream.cached:
+                trace.queued()
+                ticket = self.scheduler.submit("desktop", model, cancel_token=cancel_token)
+                while not ticket.wait(timeout=1.0):
+                    if ticket.cancelled:
+                        return
+                    smaller = self.router.fallback(ticket)
+                    if smaller:
+                        # Queued past the latency target: move to the smaller model
+                        ticket.release()
+                        model = smaller
+                        trace.rerouted(model)
+                        self.stream = self.response_cache.generate(
+                            self.backend, bypass=True, standalone=not (self.conversation.turns or sources),
+                            cancel_token=cancel_token, **self.conversation.request(model_prompt, model))
+                        ticket = self.scheduler.submit("desktop", model, cancel_token=cancel_token)
+                    ui(self.status_button.config, text=describe_wait(ticket))
+                trace.admitted()
+                ui(self.status_button.config, text="Generating...")
+
+            # Read output in real-time, speaking each sentence as it completes
+            utterance = None if self.is_muted else self.speech.begin(on_start=trace.tts_started)
+            if utterance:
+                cancel_token.on_cancel(lambda: self.speech.cancel(utterance))
+            # Reasoning is shown dimmed; only the answer is spoken
+            for chunk in self.stream:
+                trace.token()
+                for channel, text in parser.feed(chunk):
+                    self.show_stream_text(channel, text, utterance, cancel_token)
+            for channel, text in parser.flush():
+                self.show_stream_text(channel, text, utterance, cancel_token)
+            if cancel_token.cancelled:
+                # stop_chat has already reset the UI; keep the partial turn only
+                self.conversation.add_turn(prompt, parser.answer)
+                return
+            if utterance:
+                self.speech.flush(utterance)
+
+            self.latest_response = markdown_to_plain(parser.answer).strip()  # Answer only, for speech and clipboard
+            self.conversation.add_turn(prompt, parser.answer, self.stream.context, model)
+            self.render.write("\n", "bot")
+            ui(self.status_button.config, text="Idle", bg="#28a745")
 
-            self.latest_response = response.strip()  # Store response for speech output
-            self.chat_history.insert(tk.END, "\n", "bot")
+        except Exception as e:
+            status = "error"
+            note = f"❌ Error: {e}"
+            self.render.write(f"\n{note}\n", "error")
+            ui(self.status_button.config, text="Error", bg="#dc3545")
+        finally:
+            if ticket:
+                ticket.release()
+            if cancel_token.cancelled:
+                status = "cancelled"
+                note = "🛑 Chat stopped."
+            seq = self.save_turn(prompt, parser, status, self.stream.context if status == "ok" else None,
+                                 model)
+            # Hand the drawn turn to the view model, so it can be evicted and re-rendered
+            ui(self.view.finish_live, StoredTurn(seq, prompt, parser.answer.strip(), parser.reasoning.strip(),
+                                                 note, time.time()), sources)
+            ui(self.finish_trace, trace, status, self.stream, render_start)
+            ui(self.reset_buttons, cancel_token)
+
+    def reset_buttons(self, cancel_token):
+        """Re-enable Send and disable Stop once a generation has ended, unless another has started."""
+        if self.cancel_token is cancel_token:
+            self.cancel_token = None
+            self.send_btn.config(state=tk.NORMAL)
+            self.stop_btn.config(state=tk.DISABLED)
 
+    def finish_trace(self, trace, status, stream, render_start):
+        """Record request metrics; queued behind the response, so it runs once it is drawn."""
+        trace.add_render(self.render.render_seconds - render_start)
+        trace.finish(status, stream)
+        self.router.record(trace, status)
 
-            self.chat_history.tag_config("bot", foreground="lightgreen")
-            self.chat_history.config(state=tk.DISABLED)
-            self.status_button.config(text="Idle", bg="#28a745")
-            self.send_btn.config(state=tk.NORMAL)
+    def show_stream_text(self, channel, text, utterance, cancel_token):
+        """Queue one parsed piece of the stream for display."""
+        if cancel_token.cancelled:
+            return
+        if channel == REASONING:
+            self.render.write(text, "think")
+            return
+        if utterance:
+            self.speech.feed(text, utterance)
+        self.render.write(text, "bot")
 
-        except Exception as e:
-            self.chat_history.insert(tk.END, f"\n❌ Error: {e}\n", "error")
-            self.chat_history.tag_config("error", foreground="red")
-            self.status_button.config(text="Error", bg="#dc3545")
-
-    def typewriter_effect(self, text, tag):
-        """Simulates typewriter effect for bot responses"""
-        for char in text:
-            self.chat_history.insert(tk.END, char, tag)
-            self.chat_history.update()
-            time.sleep(0.03)  # Adjust speed for typewriter effect
-        self.chat_history.see(tk.END)
+    def generating(self):
+        """Whether a generation is running (until it ends or is stopped)."""
+        return self.cancel_token is not None and not self.cancel_token.cancelled
 
     def start_chat(self):
         """Start the chatbot interaction"""
         prompt = self.prompt_entry.get().strip()
-        if not prompt:
+        if not prompt or self.generating():
             return
 
         self.prompt_entry.delete(0, tk.END)  # Clear input field
+        self.start_generation(prompt)
+
+    def start_generation(self, prompt, bypass_cache=False):
+        """Answer `prompt` on a worker thread; Send and Regenerate both start here."""
         self.send_btn.config(state=tk.DISABLED)
         self.stop_btn.config(state=tk.NORMAL)
+        # Set before the thread starts, so Stop always reaches this generation
+        self.cancel_token = CancelToken()
 
         # Run DeepSeek in a separate thread
-        threading.Thread(target=self.run_deepseek, args=(prompt,), daemon=True).start()
+        threading.Thread(target=self.run_deepseek, args=(prompt, bypass_cache, self.cancel_token),
+                         daemon=True).start()
 
     def stop_chat(self):
         """Stop the chat if still generating"""
-        if self.process:
-            self.process.terminate()
+        if self.cancel_token and not self.cancel_token.cancelled:
+            # Closes the stream, frees the scheduler slot and silences TTS
+            self.cancel_token.cancel()
+            self.render.flush()  # Show what already arrived before the notice
             self.chat_history.config(state=tk.NORMAL)
             self.chat_history.insert(tk.END, "\n🛑 Chat stopped.\n", "error")
             self.chat_history.config(state=tk.DISABLED)
+            self.status_button.config(text="Idle", bg="#28a745")
             self.stop_btn.config(state=tk.DISABLED)
             self.send_btn.config(state=tk.NORMAL)
 
     def clear_chat(self):
         """Clear the chat history"""
-        self.chat_history.config(state=tk.NORMAL)
-        self.chat_history.delete(1.0, tk.END)
-        self.chat_history.config(state=tk.DISABLED)
+        self.render.flush()
+        self.view.clear()
+        self.conversation.clear()
+        # The stored conversation is kept; the next message starts a new one
+        self.conversation_id = None
 
     def copy_output(self):
         """Copy the latest response to clipboard"""
         if self.latest_response:
+            import pyperclip
             pyperclip.copy(self.latest_response)
             messagebox.showinfo("Copied", "Response copied to clipboard.")
 
     def regenerate_response(self):
-        """Regenerate the last response"""
-        if self.latest_response:
-            threading.Thread(target=self.run_deepseek, args=(self.latest_response,), daemon=True).start()
+        """Answer the last prompt again, sampling a fresh answer instead of replaying the cached one"""
+        if self.generating():
+            return
+        self.render.flush()
+        turn = self.view.pop_turn()
+        if turn is None:
+            return
+        # Drop the turn being regenerated so it isn't sent back as context
+        if self.conversation.turns and self.conversation.turns[-1][0] == turn.prompt:
+            self.conversation.pop_turn()
+        if self.conversation_id and turn.seq:
+            self.conversation_store.retract_turn(self.conversation_id, turn.seq)
+        self.start_generation(turn.prompt, bypass_cache=True)
 
     def start_voice_input(self):
         """Opens a listening window & converts speech to text"""
@@ -217,56 +365,22 @@ class DeepSeekChatbot:
 
     def voice_to_text(self, listen_window):
         """Convert speech to text & update input box"""
-        recognizer = sr.Recognizer()
-        with sr.Microphone() as source:
-            try:
-                # Update UI to indicate listening
-                self.prompt_entry.delete(0, tk.END)
-                self.prompt_entry.insert(0, "🎙️ Listening...")
-                listen_window.update()
-
-                # Adjust for ambient noise (helps in noisy environments)
-                recognizer.adjust_for_ambient_noise(source, duration=1)
-
-                # Capture audio with a timeout
-                audio = recognizer.listen(source, timeout=5, phrase_time_limit=10)
-
-                # Convert speech to text
-                text = recognizer.recognize_google(audio)
-                self.prompt_entry.delete(0, tk.END)
-                self.prompt_entry.insert(0, text)
-
-            except sr.UnknownValueError:
-                text = "❌ Couldn't recognize speech."
-            except sr.RequestError:
-                text = "❌ Speech service unavailable."
-            except sr.WaitTimeoutError:
-                text = "❌ No speech detected. Try again."
-            except Exception as e:
-                text = f"❌ Error: {str(e)}"
-
-                self.root.after(0, self.prompt_entry.delete, 0, tk.END)
-                self.root.after(0, self.prompt_entry.insert, 0, text)
-
-            except Exception as e:
-                self.prompt_entry.delete(0, tk.END)
-                self.prompt_entry.insert(0, f"❌ Error: {e}")
-
-        # Ensure the listening window is closed after operation
-        listen_window.destroy()
+        self.root.after(0, self.set_prompt, "🎙️ Listening...")
+        # Interim results appear in the input box while the user is still speaking
+        text = self.speech_input.recognize_prompt(
+            on_partial=lambda partial: self.root.after(0, self.set_prompt, partial))
+        self.root.after(0, self.set_prompt, text)
+        self.root.after(0, listen_window.destroy)
+
+    def set_prompt(self, text):
+        """Replace the contents of the input box"""
+        self.prompt_entry.delete(0, tk.END)
+        self.prompt_entry.insert(0, text)
 
     def speak_output(self):
         """Convert latest response to speech without UI lag"""
         if self.latest_response and not self.is_muted:  # Check if not muted
-            def speak_text():
-                engine = pyttsx3.init()
-                engine.setProperty('rate', 150)  # Adjust speech speed
-                engine.say(self.latest_response)
-                engine.runAndWait()
-
-            # Run speech synthesis in a separate thread
-            self.speech_thread = threading.Thread(target=speak_text, daemon=True)
-            self.speech_thread.start()
+            self.speech.speak(self.latest_response)
 
 # Run the GUI
 if __name__ == "__main__":
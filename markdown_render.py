@@ -0,0 +1,352 @@
+import html
+import threading
+from functools import lru_cache
+
+from stream_render import FENCES
+
+# =============================================================================
+# Markdown Rendering
+# =============================================================================
+#
+# One markdown parse for every front-end. Text is split into blocks at blank
+# lines outside fenced code, except where the next line is indented and so
+# continues a list item. This is the same rule the streaming renderer uses.
+# mistune parses each block once into its AST, and the tree is rendered to
+# whichever target is asked for:
+#
+#   PLAIN  plain text, for speech and the clipboard
+#   HTML   for the Gradio chatbot
+#   TK     (text, tags) spans for a Tk Text widget (see TK_TAGS)
+#
+# Parsed blocks and rendered outputs are kept in LRU caches keyed on the
+# block source. A streamed answer is then rendered for display and turned
+# into speakable text without being parsed twice, and redrawing old turns
+# costs nothing. mistune is imported on first use, so it doesn't slow down
+# startup. Raw HTML in an answer is shown as text, and links only keep
+# http, https and mailto targets.
+
+PLAIN, HTML, TK = "plain", "html", "tk"
+CACHE_SIZE = 2048            # Blocks kept per cache
+LINK_SCHEMES = ("http:", "https:", "mailto:")
+
+# Tk tag names used in TK spans; configure them with `configure_tk_tags`
+TK_TAGS = ("md_bold", "md_italic", "md_code", "md_link", "md_quote", "md_h1", "md_h2", "md_h3")
+
+_markdown = None
+_markdown_lock = threading.Lock()
+
+
+# ---- Parsing ---------------------------------------------------------------
+#
+# Blocks are mistune AST nodes: dicts with a "type", plus "children",
+# "raw" (text, code) and "attrs" (heading level, list start, link url, ...).
+# The cached trees are shared, so the renderers only ever read them.
+
+def split_blocks(text: str) -> list:
+    """Markdown source split at blank lines outside fenced code (not before indented lines)."""
+    blocks, current, in_fence, ended = [], [], False, False
+    for line in text.splitlines(keepends=True):
+        stripped = line.strip()
+        if ended and stripped and not line[0].isspace():
+            blocks.append("".join(current))
+            current, ended = [], False
+        current.append(line)
+        if stripped.startswith(FENCES):
+            in_fence = not in_fence
+            ended = False
+        elif not stripped and not in_fence:
+            ended = bool("".join(current).strip())
+        elif stripped:
+            ended = False   # Indented: the block goes on
+    if "".join(current).strip():
+        blocks.append("".join(current))
+    return blocks
+
+
+def _parse(source: str) -> list:
+    global _markdown
+    if _markdown is None:
+        with _markdown_lock:
+            if _markdown is None:
+                import mistune
+                _markdown = mistune.create_markdown(renderer=None, plugins=["table", "strikethrough"])
+    return _markdown(source)
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def parse_block(source: str) -> list:
+    """Parse one markdown block into a list of mistune AST block nodes."""
+    return _parse(source)
+
+
+def _safe_url(url: str):
+    """`url` if it is an http, https or mailto link, otherwise None."""
+    return url if url.strip().lower().startswith(LINK_SCHEMES) else None
+
+
+def _list_markers(node) -> list:
+    attrs = node.get("attrs", {})
+    if not attrs.get("ordered"):
+        return None
+    start = attrs.get("start", 1)
+    return [f"{start + n}. " for n in range(len(node["children"]))]
+
+
+def _rows(table):
+    """(cells, is_header) for every row of a table node."""
+    for part in table["children"]:
+        if part["type"] == "table_head":
+            yield part["children"], True
+        else:
+            for row in part["children"]:
+                yield row["children"], False
+
+
+# ---- Targets ---------------------------------------------------------------
+
+def _inline_plain(nodes) -> str:
+    out = []
+    for node in nodes:
+        kind = node["type"]
+        if kind in ("softbreak", "linebreak"):
+            out.append("\n")
+        elif "children" in node:
+            out.append(_inline_plain(node["children"]))
+        else:
+            out.append(node.get("raw", ""))
+    return "".join(out)
+
+
+def _plain(blocks, indent: str = "") -> str:
+    out = []
+    for node in blocks:
+        kind = node["type"]
+        if kind in ("paragraph", "heading", "block_text"):
+            out.append(indent + _inline_plain(node["children"]).replace("\n", "\n" + indent) + "\n\n")
+        elif kind == "block_code":
+            out.append(node["raw"].rstrip("\n") + "\n\n")
+        elif kind == "block_quote":
+            out.append(_plain(node["children"], indent))
+        elif kind == "list":
+            markers = _list_markers(node) or ["- "] * len(node["children"])
+            for marker, item in zip(markers, node["children"]):
+                # One line per paragraph or nested list, indented under the marker
+                parts = [_plain([child], indent + "  ").strip("\n") for child in item["children"]]
+                text = "\n".join(part for part in parts if part)
+                out.append(f"{indent}{marker}{text[len(indent) + 2:]}\n")
+            out.append("\n" if not indent else "")
+        elif kind == "table":
+            for cells, _ in _rows(node):
+                out.append(indent + " | ".join(_inline_plain(cell["children"]) for cell in cells) + "\n")
+            out.append("\n")
+        elif kind == "thematic_break":
+            out.append(indent + "---\n\n")
+        elif kind == "block_html":
+            out.append(node["raw"].rstrip("\n") + "\n\n")
+    return "".join(out)
+
+
+def _inline_html(nodes) -> str:
+    out = []
+    for node in nodes:
+        kind = node["type"]
+        if kind == "text" or kind == "inline_html":
+            out.append(html.escape(node["raw"], quote=False))
+        elif kind == "codespan":
+            out.append(f"<code>{html.escape(node['raw'], quote=False)}</code>")
+        elif kind == "strong":
+            out.append(f"<strong>{_inline_html(node['children'])}</strong>")
+        elif kind == "emphasis":
+            out.append(f"<em>{_inline_html(node['children'])}</em>")
+        elif kind == "strikethrough":
+            out.append(f"<del>{_inline_html(node['children'])}</del>")
+        elif kind == "softbreak":
+            out.append("\n")
+        elif kind == "linebreak":
+            out.append("<br />\n")
+        elif kind in ("link", "image"):
+            url = _safe_url(node["attrs"]["url"])
+            label = _inline_html(node["children"])
+            out.append(f'<a href="{html.escape(url)}">{label}</a>' if url else label)
+        elif "children" in node:
+            out.append(_inline_html(node["children"]))
+        else:
+            out.append(html.escape(node.get("raw", ""), quote=False))
+    return "".join(out)
+
+
+def _html(blocks) -> str:
+    out = []
+    for node in blocks:
+        kind = node["type"]
+        if kind == "heading":
+            level = node["attrs"]["level"]
+            out.append(f"<h{level}>{_inline_html(node['children'])}</h{level}>\n")
+        elif kind == "paragraph":
+            out.append(f"<p>{_inline_html(node['children'])}</p>\n")
+        elif kind == "block_text":
+            out.append(_inline_html(node["children"]))
+        elif kind == "block_quote":
+            out.append(f"<blockquote>\n{_html(node['children'])}</blockquote>\n")
+        elif kind == "block_code":
+            info = node.get("attrs", {}).get("info", "").split()
+            language = f' class="language-{html.escape(info[0])}"' if info else ""
+            out.append(f"<pre><code{language}>{html.escape(node['raw'], quote=False)}</code></pre>\n")
+        elif kind == "list":
+            items = "".join(f"<li>{_html(item['children'])}</li>\n" for item in node["children"])
+            attrs = node["attrs"]
+            if not attrs.get("ordered"):
+                out.append(f"<ul>\n{items}</ul>\n")
+            else:
+                start = f' start="{attrs["start"]}"' if attrs.get("start", 1) != 1 else ""
+                out.append(f"<ol{start}>\n{items}</ol>\n")
+        elif kind == "table":
+            rows = []
+            for cells, header in _rows(node):
+                tag = "th" if header else "td"
+                rows.append("<tr>" + "".join(
+                    f"<{tag}{_align(cell)}>{_inline_html(cell['children'])}</{tag}>" for cell in cells) + "</tr>\n")
+            out.append(f"<table>\n{''.join(rows)}</table>\n")
+        elif kind == "thematic_break":
+            out.append("<hr />\n")
+        elif kind == "block_html":
+            out.append(f"<p>{html.escape(node['raw'].strip(), quote=False)}</p>\n")
+    return "".join(out)
+
+
+def _align(cell) -> str:
+    align = cell["attrs"].get("align")
+    return f' style="text-align:{align}"' if align else ""
+
+
+def _inline_tk(nodes, tags=()) -> list:
+    spans = []
+    for node in nodes:
+        kind = node["type"]
+        if kind == "codespan":
+            spans.append((node["raw"], tags + ("md_code",)))
+        elif kind in ("softbreak", "linebreak"):
+            spans.append(("\n", tags))
+        elif kind == "strong":
+            spans += _inline_tk(node["children"], tags + ("md_bold",))
+        elif kind == "emphasis":
+            spans += _inline_tk(node["children"], tags + ("md_italic",))
+        elif kind in ("link", "image"):
+            spans += _inline_tk(node["children"], tags + ("md_link",))
+        elif "children" in node:
+            spans += _inline_tk(node["children"], tags)
+        else:
+            spans.append((node.get("raw", ""), tags))
+    return spans
+
+
+def _tk(blocks, indent: str = "", tags=()) -> tuple:
+    spans = []
+    for node in blocks:
+        kind = node["type"]
+        if kind == "heading":
+            spans += _inline_tk(node["children"], tags + (f"md_h{min(node['attrs']['level'], 3)}",))
+            spans.append(("\n\n", ()))
+        elif kind == "paragraph":
+            spans += _inline_tk(node["children"], tags)
+            spans.append(("\n" if indent else "\n\n", ()))
+        elif kind == "block_text":
+            spans += _inline_tk(node["children"], tags)
+            spans.append(("\n", ()))
+        elif kind == "block_quote":
+            spans += _tk(node["children"], indent, tags + ("md_quote",))
+        elif kind == "block_code":
+            spans.append((node["raw"], ("md_code",)))
+            if not indent:
+                spans.append(("\n", ()))
+        elif kind == "list":
+            markers = _list_markers(node) or ["• "] * len(node["children"])
+            for marker, item in zip(markers, node["children"]):
+                spans.append((f"{indent}  {marker}", ()))
+                for number, child in enumerate(item["children"]):
+                    if number and child["type"] not in ("list", "blank_line"):
+                        spans.append((indent + "    ", ()))   # Later paragraphs line up with the first
+                    spans += _tk([child], indent + "    ", tags)
+            if not indent:
+                spans.append(("\n", ()))
+        elif kind == "table":
+            for cells, header in _rows(node):
+                for number, cell in enumerate(cells):
+                    if number:
+                        spans.append((" | ", ()))
+                    spans += _inline_tk(cell["children"], tags + (("md_bold",) if header else ()))
+                spans.append(("\n", ()))
+            spans.append(("\n", ()))
+        elif kind == "thematic_break":
+            spans.append(("―" * 20 + "\n\n", ()))
+        elif kind == "block_html":
+            spans.append((node["raw"].rstrip("\n") + "\n\n", tags))
+    return tuple(spans)
+
+
+TARGETS = {PLAIN: _plain, HTML: _html, TK: _tk}
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def render_block(source: str, target: str):
+    """One block rendered to `target` (cached; the parse is shared by every target)."""
+    return TARGETS[target](parse_block(source))
+
+
+def render(text: str, target: str, cache: bool = True):
+    """
+    Render markdown text to `target`: a string for PLAIN and HTML, a tuple of
+    (text, tags) spans for TK. Use `cache=False` for text that is still
+    growing, such as the open block of a stream, so it doesn't evict
+    finished blocks from the caches.
+    """
+    if cache:
+        parts = [render_block(block, target) for block in split_blocks(text)]
+    else:
+        parts = [TARGETS[target](_parse(block)) for block in split_blocks(text)]
+    return tuple(span for part in parts for span in part) if target == TK else "".join(parts)
+
+
+def markdown_to_plain(md_text: str) -> str:
+    """Plain text of a markdown answer, for speech and the clipboard."""
+    return render(md_text, PLAIN)
+
+
+def markdown_to_html(md_text: str) -> str:
+    return render(md_text, HTML)
+
+
+def open_block_to_text(md_text: str) -> str:
+    """
+    Escaped source of a block that is still streaming, shown after the HTML of
+    the closed blocks. It only grows by appending, unlike a re-render.
+    """
+    return html.escape(md_text, quote=False)
+
+
+def markdown_to_tk_runs(md_text: str, tag: str = None) -> list:
+    """
+    Flat [text, tags, text, tags, ...] runs for Text.insert, with `tag` added
+    to every span and trailing blank lines removed.
+    """
+    spans = list(render(md_text, TK))
+    while spans and not spans[-1][0].strip():
+        spans.pop()
+    if spans:
+        spans[-1] = (spans[-1][0].rstrip("\n"), spans[-1][1])
+    runs = []
+    for text, tags in spans:
+        runs += [text, ((tag,) if tag else ()) + tags]
+    return runs
+
+
+def configure_tk_tags(widget, family: str = "Arial", size: int = 12):
+    """Configure the TK_TAGS on a Text widget whose base font is `family` `size`."""
+    widget.tag_config("md_bold", font=(family, size, "bold"))
+    widget.tag_config("md_italic", font=(family, size, "italic"))
+    widget.tag_config("md_code", font=("Courier", size), background="#2c3e50")
+    widget.tag_config("md_link", underline=True)
+    widget.tag_config("md_quote", lmargin1=20, lmargin2=20, font=(family, size, "italic"))
+    widget.tag_config("md_h1", font=(family, size + 6, "bold"))
+    widget.tag_config("md_h2", font=(family, size + 4, "bold"))
+    widget.tag_config("md_h3", font=(family, size + 2, "bold"))
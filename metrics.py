@@ -0,0 +1,257 @@
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# =============================================================================
+# Request Latency Metrics
+# =============================================================================
+#
+# Each generation gets a RequestTrace that records where its time went:
+# queue wait, backend connect, model load and prefill (as reported by
+# Ollama), time to first token, inter-token latency, tokens/sec, UI render
+# time and time until speech starts. Traces are aggregated into histograms,
+# served in the Prometheus text format by `start_metrics_server`, and, if
+# CHATBOT_METRICS_FILE is set, appended as one JSON line per request.
+
+DEFAULT_METRICS_PORT = int(os.environ.get("CHATBOT_METRICS_PORT", "7861"))
+METRICS_FILE = os.environ.get("CHATBOT_METRICS_FILE")
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1.0)
+RATE_BUCKETS = (1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 250)
+
+HISTOGRAMS = {
+    "chatbot_queue_wait_seconds": ("Time spent waiting for a generation slot.", LATENCY_BUCKETS),
+    "chatbot_backend_connect_seconds": ("TCP connect to the Ollama server (0 for pooled connections).", LATENCY_BUCKETS),
+    "chatbot_model_load_seconds": ("Model load time reported by Ollama.", LATENCY_BUCKETS),
+    "chatbot_prefill_seconds": ("Prompt evaluation time reported by Ollama.", LATENCY_BUCKETS),
+    "chatbot_time_to_first_token_seconds": ("Request start to first streamed token.", LATENCY_BUCKETS),
+    "chatbot_inter_token_seconds": ("Gap between consecutive streamed tokens.", TOKEN_BUCKETS),
+    "chatbot_tokens_per_second": ("Generation speed per request.", RATE_BUCKETS),
+    "chatbot_render_seconds": ("Time spent rendering a response in the UI.", LATENCY_BUCKETS),
+    "chatbot_tts_start_seconds": ("Request start to the first spoken sentence.", LATENCY_BUCKETS),
+    "chatbot_request_seconds": ("Total request time.", LATENCY_BUCKETS),
+}
+REQUESTS_TOTAL = "chatbot_requests_total"
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the Prometheus style."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)   # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    escaped = (f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+               for k, v in labels)
+    return "{" + ",".join(escaped) + "}"
+
+
+class MetricsRegistry:
+    """Thread-safe histograms and counters, rendered as Prometheus text."""
+
+    def __init__(self, jsonl_path: str = None):
+        self.jsonl_path = jsonl_path
+        self._lock = threading.Lock()
+        self._histograms = {}   # (name, labels) -> Histogram
+        self._counters = {}     # (name, labels) -> value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(HISTOGRAMS[name][1])
+            histogram.observe(value)
+
+    def inc(self, name: str, amount: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def write_record(self, record: dict):
+        """Append one request record to the JSONL file, if one is configured."""
+        if not self.jsonl_path:
+            return
+        line = json.dumps(record, separators=(",", ":")) + "\n"
+        with self._lock:
+            try:
+                with open(self.jsonl_path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"[DEBUG] Could not write metrics record: {e}")
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+            seen = set()
+            for (name, labels), histogram in histograms:
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# HELP {name} {HISTOGRAMS[name][0]}")
+                    lines.append(f"# TYPE {name} histogram")
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum:.6f}")
+                lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+            for (name, labels), value in counters:
+                if name not in seen:
+                    seen.add(name)
+                    lines.append(f"# TYPE {name} counter")
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+class RequestTrace:
+    """
+    Timing spans for one generation. Call the hooks as the request
+    progresses, then `finish()` once it has been displayed.
+    """
+
+    def __init__(self, frontend: str, model: str, registry: MetricsRegistry = None):
+        self.registry = registry or get_metrics()
+        self.labels = {"frontend": frontend, "model": model}
+        self.start = time.perf_counter()
+        self.spans = {}
+        self.tokens = 0
+        self.render_seconds = 0.0
+        self.cached = False
+        self._queued_at = None
+        self._last_token = None
+        self._finished = False
+
+    def _since_start(self) -> float:
+        return time.perf_counter() - self.start
+
+    def _record(self, span: str, name: str, seconds: float):
+        self.spans[span] = round(seconds, 6)
+        self.registry.observe(name, seconds, **self.labels)
+
+    def rerouted(self, model: str):
+        """The request moved to another model before it started generating."""
+        self.labels["model"] = model
+
+    def queued(self):
+        self._queued_at = time.perf_counter()
+
+    def admitted(self):
+        if self._queued_at is not None:
+            self._record("queue_wait", "chatbot_queue_wait_seconds", time.perf_counter() - self._queued_at)
+
+    def token(self):
+        """Call once per streamed chunk."""
+        now = time.perf_counter()
+        if self._last_token is None:
+            self._record("ttft", "chatbot_time_to_first_token_seconds", now - self.start)
+        else:
+            self.registry.observe("chatbot_inter_token_seconds", now - self._last_token, **self.labels)
+        self._last_token = now
+        self.tokens += 1
+
+    def add_render(self, seconds: float):
+        self.render_seconds += seconds
+
+    def tts_started(self):
+        # Speech may start after the request has finished, so this is observed directly
+        self._record("tts_start", "chatbot_tts_start_seconds", self._since_start())
+
+    def finish(self, status: str = "ok", stream=None):
+        """Record the totals; `stream` contributes connect and Ollama server timings."""
+        if self._finished:
+            return
+        self._finished = True
+        total = self._since_start()
+        if stream is not None:
+            self.cached = bool(getattr(stream, "cached", False))
+            connect = (getattr(stream, "timings", None) or {}).get("connect")
+            if connect is not None:
+                self._record("connect", "chatbot_backend_connect_seconds", connect)
+            final = getattr(stream, "final", None) or {}
+            if final.get("load_duration"):
+                self._record("model_load", "chatbot_model_load_seconds", final["load_duration"] / 1e9)
+            if final.get("prompt_eval_duration"):
+                self._record("prefill", "chatbot_prefill_seconds", final["prompt_eval_duration"] / 1e9)
+        if self.render_seconds:
+            self._record("render", "chatbot_render_seconds", self.render_seconds)
+        rate = self._tokens_per_second(stream)
+        if rate:
+            self.spans["tokens_per_second"] = round(rate, 2)
+            self.registry.observe("chatbot_tokens_per_second", rate, **self.labels)
+        self._record("total", "chatbot_request_seconds", total)
+        self.registry.inc(REQUESTS_TOTAL, status=status, cached=str(self.cached).lower(), **self.labels)
+        self.registry.write_record(dict(self.labels, status=status, cached=self.cached,
+                                        tokens=self.tokens, time=time.time(), **self.spans))
+
+    def _tokens_per_second(self, stream):
+        final = getattr(stream, "final", None) or {}
+        if final.get("eval_count") and final.get("eval_duration"):
+            return final["eval_count"] / (final["eval_duration"] / 1e9)   # Ollama's own measurement
+        if self.tokens > 1 and "ttft" in self.spans and self._last_token is not None:
+            elapsed = self._last_token - self.start - self.spans["ttft"]
+            if elapsed > 0:
+                return (self.tokens - 1) / elapsed
+        return None
+
+    def summary(self) -> str:
+        return ", ".join(f"{k}={v}" for k, v in self.spans.items())
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_metrics_server(port: int = DEFAULT_METRICS_PORT, host: str = "127.0.0.1",
+                         registry: MetricsRegistry = None) -> ThreadingHTTPServer:
+    """Serve /metrics on a daemon thread."""
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry or get_metrics()})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    print(f"[DEBUG] Metrics at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+
+_default_registry = None
+_default_lock = threading.Lock()
+
+
+def get_metrics() -> MetricsRegistry:
+    """Process-wide metrics registry."""
+    global _default_registry
+    with _default_lock:
+        if _default_registry is None:
+            _default_registry = MetricsRegistry(jsonl_path=METRICS_FILE)
+        return _default_registry
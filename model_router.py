@@ -0,0 +1,133 @@
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+
+from conversation_context import estimate_tokens
+from metrics import get_metrics
+from scheduler import get_scheduler
+
+# =============================================================================
+# Model Routing
+# =============================================================================
+#
+# Picks a deepseek-r1 size per request instead of hardcoding one per app.
+# Short chit-chat goes to the smallest model. Long prompts, code and
+# reasoning-heavy requests go to larger ones, but only while that model's
+# expected latency stays within the target. The estimate is its queue wait
+# plus its measured generation time. Otherwise the request steps down to a
+# smaller model. A request that has waited in the queue past its share of
+# the target also falls back to the next smaller model.
+#
+# Per-model statistics (time to first token, tokens/sec, generation time)
+# are updated from every finished request trace, so decisions follow what
+# the hardware actually delivers.
+
+DEFAULT_MODELS = tuple(m.strip() for m in os.environ.get(
+    "CHATBOT_MODELS", "deepseek-r1:1.5b,deepseek-r1:8b").split(",") if m.strip())   # Smallest first
+LATENCY_TARGET = float(os.environ.get("CHATBOT_LATENCY_TARGET", "30"))   # Seconds per response
+QUEUE_SHARE = 0.5            # Part of the target a request may spend queued before falling back
+LONG_PROMPT_TOKENS = 60      # Prompts longer than this count as complex
+SMOOTHING = 0.2              # Weight of the newest sample in the moving averages
+
+COMPLEX_PATTERN = re.compile(
+    r"```|\b(?:explain|prove|derive|compare|analy[sz]e|design|implement|debug|refactor|optimi[sz]e|"
+    r"algorithm|calculate|solve|translate|summari[sz]e|step[- ]by[- ]step|code|function|why)\b",
+    re.IGNORECASE)
+
+# Moving averages for one model
+ModelStats = namedtuple("ModelStats", "requests ttft tokens_per_second generation_seconds")
+
+
+def complexity(prompt: str) -> int:
+    """Number of signals that the prompt needs a larger model (0 for chit-chat)."""
+    score = 0
+    if estimate_tokens(prompt) > LONG_PROMPT_TOKENS:
+        score += 1
+    if COMPLEX_PATTERN.search(prompt):
+        score += 1
+    if prompt.count("\n") >= 2:
+        score += 1
+    return score
+
+
+class ModelRouter:
+    """Chooses a model per request and learns per-model latency. Thread-safe."""
+
+    def __init__(self, models=DEFAULT_MODELS, latency_target: float = LATENCY_TARGET,
+                 scheduler=None, registry=None):
+        if not models:
+            raise ValueError("at least one model is required")
+        self.models = tuple(models)
+        self.latency_target = latency_target
+        self.scheduler = scheduler or get_scheduler()
+        self.registry = registry or get_metrics()
+        self._lock = threading.Lock()
+        self._stats = {}   # model -> ModelStats
+
+    def route(self, prompt: str) -> str:
+        """Largest model the prompt calls for that is expected to meet the latency target."""
+        wanted = min(complexity(prompt), len(self.models) - 1)
+        for index in range(wanted, -1, -1):
+            model = self.models[index]
+            if index == 0 or self.expected_seconds(model) <= self.latency_target:
+                reason = "load" if index < wanted else ("complex" if index else "simple")
+                self.registry.inc("chatbot_routed_total", model=model, reason=reason)
+                return model
+        return self.models[0]
+
+    def fallback(self, ticket):
+        """Next smaller model once a queued ticket has waited too long, or None."""
+        if ticket.admitted or ticket.model not in self.models:
+            return None
+        index = self.models.index(ticket.model)
+        waited = time.monotonic() - ticket.submitted_at
+        if index == 0 or waited < self.latency_target * QUEUE_SHARE:
+            return None
+        model = self.models[index - 1]
+        self.registry.inc("chatbot_routed_total", model=model, reason="timeout")
+        return model
+
+    def expected_seconds(self, model: str) -> float:
+        """Queue wait plus measured generation time; unmeasured models are assumed fast."""
+        with self._lock:
+            stats = self._stats.get(model)
+        return self.scheduler.expected_wait(model) + (stats.generation_seconds if stats else 0.0)
+
+    def record(self, trace, status: str = "ok"):
+        """Learn from a finished RequestTrace; only complete, uncached generations count."""
+        spans = trace.spans
+        model = trace.labels.get("model")
+        if status != "ok" or trace.cached or model not in self.models or "ttft" not in spans \
+                or "total" not in spans:
+            return
+        generation = spans["total"] - spans.get("queue_wait", 0.0)
+        with self._lock:
+            stats = self._stats.get(model)
+            if stats is None:
+                self._stats[model] = ModelStats(1, spans["ttft"], spans.get("tokens_per_second", 0.0), generation)
+                return
+            average = lambda old, new: old + SMOOTHING * (new - old)
+            self._stats[model] = ModelStats(
+                stats.requests + 1,
+                average(stats.ttft, spans["ttft"]),
+                average(stats.tokens_per_second, spans.get("tokens_per_second", stats.tokens_per_second)),
+                average(stats.generation_seconds, generation))
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+_default_router = None
+_default_lock = threading.Lock()
+
+
+def get_router() -> ModelRouter:
+    """Process-wide model router shared by every front-end in this process."""
+    global _default_router
+    with _default_lock:
+        if _default_router is None:
+            _default_router = ModelRouter()
+        return _default_router
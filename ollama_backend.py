@@ -0,0 +1,299 @@
+import http.client
+import json
+import os
+import socket
+import threading
+import time
+from urllib.parse import urlsplit
+
+# =============================================================================
+# Ollama HTTP Backend
+# =============================================================================
+#
+# Talks to a running Ollama server over its streaming REST API instead of
+# spawning `ollama run <model>` for every prompt. Connections are kept alive
+# and pooled, and every request carries a `keep_alive` so the model stays
+# resident between turns. At launch, `start_warm_up` loads the model in the
+# background with a one-token prompt, so the first real message doesn't pay
+# for loading it.
+
+DEFAULT_HOST = os.environ.get("OLLAMA_HOST", "http://127.0.0.1:11434")
+DEFAULT_MODEL = "deepseek-r1:8b"
+DEFAULT_KEEP_ALIVE = "30m"
+WARM_UP = os.environ.get("CHATBOT_WARM_UP", "1") != "0"
+WARM_UP_PROMPT = "Hi"
+
+
+class OllamaError(Exception):
+    """Raised when the Ollama server rejects or fails a request."""
+
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        self.status = status  # HTTP status of the rejected request, if any
+
+
+def _split_host(host: str):
+    """Return (hostname, port) for an Ollama host URL or bare host:port."""
+    if "://" not in host:
+        host = "http://" + host
+    parts = urlsplit(host)
+    return parts.hostname or "127.0.0.1", parts.port or 11434
+
+
+class ConnectionPool:
+    """
+    A small LIFO pool of keep-alive HTTP connections to one Ollama server.
+    Connections are created on demand; at most `maxsize` idle ones are kept.
+    """
+
+    def __init__(self, host: str = DEFAULT_HOST, maxsize: int = 4, timeout: float = 300.0):
+        self.host = host
+        self.hostname, self.port = _split_host(host)
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Return an idle connection, or a new one if none is available."""
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        conn = http.client.HTTPConnection(self.hostname, self.port, timeout=self.timeout)
+        return conn, False
+
+    def release(self, conn, reusable: bool = True):
+        """Give a connection back to the pool, closing it if it can't be reused."""
+        if reusable:
+            with self._lock:
+                if len(self._idle) < self.maxsize:
+                    self._idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        """Close every idle connection."""
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+class GenerationStream:
+    """
+    Iterable over the text chunks of one streamed generation.
+    After iteration finishes, `final` holds the last status object sent by the
+    server (token counts, durations and, for /api/generate, the `context`),
+    and `timings["connect"]` the TCP connect time (0 for a pooled connection).
+    `close()` may be called from any thread to abort the request; cancelling
+    `cancel_token` does the same.
+    """
+
+    def __init__(self, pool: ConnectionPool, path: str, payload: dict, field: str,
+                 cancel_token=None):
+        self._pool = pool
+        self._path = path
+        self._payload = payload
+        self._field = field
+        self._conn = None
+        self._closed = False
+        self.done = False
+        self.final = {}
+        self.timings = {}
+        if cancel_token is not None:
+            cancel_token.on_cancel(self.close)
+
+    @property
+    def context(self):
+        """Token context returned by /api/generate, for reuse on the next turn."""
+        return self.final.get("context")
+
+    def _open(self):
+        """Send the request, retrying once if a pooled connection has gone stale."""
+        body = json.dumps(self._payload).encode("utf-8")
+        headers = {"Content-Type": "application/json", "Connection": "keep-alive"}
+        while True:
+            conn, reused = self._pool.acquire()
+            # Published before connecting so close() can abort a slow model load.
+            self._conn = conn
+            try:
+                if conn.sock is None:
+                    started = time.perf_counter()
+                    conn.connect()
+                    self.timings["connect"] = time.perf_counter() - started
+                else:
+                    self.timings["connect"] = 0.0
+                conn.request("POST", self._path, body=body, headers=headers)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                self._conn = None
+                conn.close()
+                if reused and not self._closed:
+                    continue
+                raise
+            except Exception:
+                self._conn = None
+                conn.close()
+                raise
+            break
+        if self._closed:
+            # Cancelled while connecting; don't wait for the first token.
+            self.close()
+        if response.status != 200:
+            detail = response.read().decode("utf-8", "replace")
+            self._pool.release(conn, reusable=not response.will_close)
+            self._conn = None
+            try:
+                detail = json.loads(detail).get("error", detail)
+            except ValueError:
+                pass
+            raise OllamaError(f"Ollama returned HTTP {response.status}: {detail}", response.status)
+        return response
+
+    def _field_text(self, obj: dict) -> str:
+        if self._field == "message":
+            return (obj.get("message") or {}).get("content", "")
+        return obj.get(self._field, "")
+
+    def __iter__(self):
+        if self._closed:
+            return
+        try:
+            response = self._open()
+        except (OSError, http.client.HTTPException):
+            if self._closed:
+                return
+            raise
+        try:
+            while not self._closed:
+                line = response.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line:
+                    continue
+                obj = json.loads(line)
+                if "error" in obj:
+                    raise OllamaError(obj["error"])
+                text = self._field_text(obj)
+                if obj.get("done"):
+                    self.final = obj
+                    self.done = True
+                if text:
+                    yield text
+                if self.done:
+                    break
+            if not self.done and not self._closed:
+                raise ConnectionResetError("Ollama closed the connection mid-response")
+        except (OSError, ValueError, http.client.HTTPException):
+            if not self._closed:
+                raise
+        finally:
+            self._finish(response)
+
+    def _finish(self, response):
+        conn, self._conn = self._conn, None
+        if conn is None:
+            return
+        # Only a fully drained response leaves the connection reusable.
+        reusable = self.done and not self._closed
+        if reusable:
+            response.read()
+            reusable = not response.will_close
+        self._pool.release(conn, reusable=reusable)
+
+    def close(self):
+        """Abort the generation; Ollama stops generating once the socket closes."""
+        self._closed = True
+        conn = self._conn
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+class OllamaBackend:
+    """
+    Streaming client for an Ollama server, shared by all the front-ends.
+    """
+
+    def __init__(self, model: str = DEFAULT_MODEL, host: str = DEFAULT_HOST,
+                 keep_alive=DEFAULT_KEEP_ALIVE, pool_size: int = 4,
+                 timeout: float = 300.0, options: dict = None):
+        self.model = model
+        self.host = host
+        self.keep_alive = keep_alive
+        self.options = dict(options or {})
+        self.pool = ConnectionPool(host, maxsize=pool_size, timeout=timeout)
+
+    def _payload(self, model, options, extra):
+        payload = {
+            "model": model or self.model,
+            "stream": True,
+            "keep_alive": self.keep_alive,
+        }
+        merged = dict(self.options)
+        merged.update(options or {})
+        if merged:
+            payload["options"] = merged
+        payload.update({k: v for k, v in extra.items() if v is not None})
+        return payload
+
+    def generate(self, prompt: str, model: str = None, context=None,
+                 options: dict = None, cancel_token=None, **extra) -> GenerationStream:
+        """Stream a completion from /api/generate."""
+        payload = self._payload(model, options, extra)
+        payload["prompt"] = prompt
+        if context:
+            payload["context"] = context
+        return GenerationStream(self.pool, "/api/generate", payload, "response", cancel_token)
+
+    def chat(self, messages: list, model: str = None, options: dict = None,
+             cancel_token=None, **extra) -> GenerationStream:
+        """Stream an assistant reply from /api/chat."""
+        payload = self._payload(model, options, extra)
+        payload["messages"] = messages
+        return GenerationStream(self.pool, "/api/chat", payload, "message", cancel_token)
+
+    def loaded_models(self, timeout: float = 2.0) -> set:
+        """Names of the models resident in the server's memory (/api/ps); raises if it is unreachable."""
+        conn = http.client.HTTPConnection(self.pool.hostname, self.pool.port, timeout=timeout)
+        try:
+            conn.request("GET", "/api/ps")
+            response = conn.getresponse()
+            body = response.read()
+        finally:
+            conn.close()
+        if response.status != 200:
+            raise OllamaError(f"Ollama returned HTTP {response.status} for /api/ps", response.status)
+        return {m.get("name") or m.get("model") for m in json.loads(body).get("models", [])}
+
+    def warm_up(self, model: str = None) -> float:
+        """Load the model and generate one token; returns the seconds it took."""
+        started = time.perf_counter()
+        for _ in self.generate(WARM_UP_PROMPT, model=model, options={"num_predict": 1}):
+            pass
+        return time.perf_counter() - started
+
+    def close(self):
+        """Close pooled connections."""
+        self.pool.close()
+
+
+def start_warm_up(backend: OllamaBackend, *models: str):
+    """Warm models (default: the backend's) up one by one on a daemon thread; CHATBOT_WARM_UP=0 disables it."""
+    if not WARM_UP:
+        return None
+
+    def run():
+        for model in models or (backend.model,):
+            try:
+                seconds = backend.warm_up(model)
+                print(f"[DEBUG] Model {model} warmed up in {seconds:.1f}s")
+            except Exception as e:
+                print(f"[DEBUG] Model warm-up failed for {model}: {e}")
+
+    thread = threading.Thread(target=run, name="model-warm-up", daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,298 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from similarity_cache import SimilarPromptIndex
+from think_parser import CLOSE_TAG, OPEN_TAG, split_reasoning
+
+# =============================================================================
+# Response Cache
+# =============================================================================
+#
+# Persists finished answers in SQLite, keyed by model, normalized prompt,
+# conversation context and sampling options. A hit is replayed as a stream of
+# chunks, so the front-ends render it exactly like a live generation.
+# deepseek-r1 reasoning is stored apart from the answer.
+# Entries expire after `ttl` seconds and the least recently used ones are
+# evicted once the entry or byte limits are exceeded.
+#
+# Optionally, standalone prompts (first turns, no conversation context) are
+# also indexed by wording, so a near-duplicate question can reuse the answer
+# of an earlier one. Set CHATBOT_SIMILARITY_THRESHOLD (e.g. 0.85) to enable.
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "CHATBOT_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "deepseek_chatbot"))
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_TTL = 7 * 24 * 3600.0
+REPLAY_CHUNK_CHARS = 24
+SIMILARITY_THRESHOLD = os.environ.get("CHATBOT_SIMILARITY_THRESHOLD")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapse whitespace and case so trivially different prompts share a key."""
+    return " ".join(prompt.split()).casefold()
+
+
+def make_key(model: str, prompt: str, context=None, options: dict = None) -> str:
+    """Stable cache key for one generation request."""
+    material = json.dumps({
+        "model": model,
+        "prompt": normalize_prompt(prompt),
+        "context": context or None,
+        "options": options or {},
+    }, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(material.encode("utf-8")).hexdigest()
+
+
+class ReplayStream:
+    """A cached answer, streamed back with the same interface as GenerationStream."""
+
+    cached = True
+
+    def __init__(self, response: str, context=None, reasoning: str = "", similarity: float = None,
+                 cancel_token=None):
+        self.response = response
+        self.reasoning = reasoning
+        self.similarity = similarity  # Set when served for a near-duplicate prompt
+        self.final = {"done": True, "context": context} if context else {"done": True}
+        self.done = False
+        self.timings = {}
+        self._closed = False
+        if cancel_token is not None:
+            cancel_token.on_cancel(self.close)
+
+    @property
+    def context(self):
+        return self.final.get("context")
+
+    def __iter__(self):
+        if self.reasoning and not self._closed:
+            yield f"{OPEN_TAG}\n{self.reasoning}\n{CLOSE_TAG}\n\n"
+        text = self.response
+        for start in range(0, len(text), REPLAY_CHUNK_CHARS):
+            if self._closed:
+                return
+            yield text[start:start + REPLAY_CHUNK_CHARS]
+        self.done = True
+
+    def close(self):
+        self._closed = True
+
+
+class RecordingStream:
+    """Wraps a live stream and stores the answer once it finishes cleanly."""
+
+    cached = False
+
+    def __init__(self, stream, cache, key: str, model: str, prompt: str, standalone: bool = False):
+        self.stream = stream
+        self.cache = cache
+        self.key = key
+        self.model = model
+        self.prompt = prompt
+        self.standalone = standalone
+
+    @property
+    def final(self):
+        return self.stream.final
+
+    @property
+    def context(self):
+        return self.stream.context
+
+    @property
+    def done(self):
+        return self.stream.done
+
+    @property
+    def timings(self):
+        return self.stream.timings
+
+    def __iter__(self):
+        chunks = []
+        for chunk in self.stream:
+            chunks.append(chunk)
+            yield chunk
+        if self.stream.done:
+            reasoning, answer = split_reasoning("".join(chunks))
+            self.cache.put(self.key, self.model, self.prompt, answer, self.stream.context,
+                           standalone=self.standalone, reasoning=reasoning)
+
+    def close(self):
+        self.stream.close()
+
+
+class ResponseCache:
+    """
+    SQLite-backed answer cache with TTL and LRU eviction. With a
+    `similarity_threshold`, standalone prompts are also matched by wording.
+    """
+
+    def __init__(self, path: str = None, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_MAX_BYTES, ttl: float = DEFAULT_TTL,
+                 similarity_threshold: float = None):
+        if path is None:
+            os.makedirs(DEFAULT_CACHE_DIR, exist_ok=True)
+            path = os.path.join(DEFAULT_CACHE_DIR, "responses.sqlite3")
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        if path != ":memory:":
+            self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                model TEXT NOT NULL,
+                prompt TEXT NOT NULL,
+                response TEXT NOT NULL,
+                context TEXT,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL,
+                standalone INTEGER NOT NULL DEFAULT 0,
+                reasoning TEXT NOT NULL DEFAULT ''
+            )""")
+        columns = [row[1] for row in self._db.execute("PRAGMA table_info(responses)")]
+        if "standalone" not in columns:
+            self._db.execute("ALTER TABLE responses ADD COLUMN standalone INTEGER NOT NULL DEFAULT 0")
+        if "reasoning" not in columns:
+            self._db.execute("ALTER TABLE responses ADD COLUMN reasoning TEXT NOT NULL DEFAULT ''")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+        self._db.commit()
+
+        self.similar = None
+        if similarity_threshold:
+            self.similar = SimilarPromptIndex(threshold=similarity_threshold)
+            # Index existing prompts in the background; lookups just miss until then.
+            rows = self._db.execute(
+                "SELECT model, prompt, key FROM responses WHERE standalone = 1").fetchall()
+            threading.Thread(target=self._index_rows, args=(rows,), daemon=True).start()
+
+    def _index_rows(self, rows):
+        for model, prompt, key in rows:
+            self.similar.add(model, prompt, key)
+
+    def get(self, key: str):
+        """Return (response, context, reasoning) for a fresh entry, or None."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response, context, reasoning, created_at FROM responses WHERE key = ?",
+                (key,)).fetchone()
+            if row is None:
+                return None
+            response, context, reasoning, created_at = row
+            if self.ttl and now - created_at > self.ttl:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                return None
+            self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+            self._db.commit()
+        return response, json.loads(context) if context else None, reasoning
+
+    def put(self, key: str, model: str, prompt: str, response: str, context=None,
+            standalone: bool = False, reasoning: str = ""):
+        """Store an answer (and its reasoning) and evict entries beyond the configured limits."""
+        if not response.strip():
+            return
+        now = time.time()
+        encoded_context = json.dumps(context) if context else None
+        size = len(response.encode("utf-8")) + len(reasoning.encode("utf-8")) + len(encoded_context or "")
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses (key, model, prompt, response, context, size, "
+                "created_at, last_used, standalone, reasoning) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, model, prompt, response, encoded_context, size, now, now, int(standalone), reasoning))
+            self._evict(now)
+            self._db.commit()
+        if standalone and self.similar is not None:
+            self.similar.add(model, prompt, key)
+
+    def _evict(self, now):
+        victims = []
+        if self.ttl:
+            victims += self._db.execute(
+                "SELECT key, model FROM responses WHERE created_at < ?", (now - self.ttl,)).fetchall()
+            self._db.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        count, total = self._db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses").fetchone()
+        if count > self.max_entries or total > self.max_bytes:
+            lru = []
+            for key, model, size in self._db.execute(
+                    "SELECT key, model, size FROM responses ORDER BY last_used"):
+                if count <= self.max_entries and total <= self.max_bytes:
+                    break
+                lru.append((key, model))
+                count -= 1
+                total -= size
+            self._db.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key, _ in lru])
+            victims += lru
+        if self.similar is not None:
+            for key, model in victims:
+                self.similar.discard(model, key)
+
+    def clear(self):
+        """Drop every cached answer."""
+        with self._lock:
+            self._db.execute("DELETE FROM responses")
+            self._db.commit()
+        if self.similar is not None:
+            self.similar.clear()
+
+    def lookup_similar(self, model: str, prompt: str):
+        """Return (response, context, reasoning, similarity) for a near-duplicate prompt, or None."""
+        if self.similar is None:
+            return None
+        match = self.similar.query(model, prompt)
+        if match is None:
+            return None
+        similarity, key = match
+        hit = self.get(key)
+        if hit is None:
+            return None
+        return hit + (similarity,)
+
+    def generate(self, backend, prompt: str, context=None, options: dict = None,
+                 bypass: bool = False, standalone: bool = False, cancel_token=None, **extra):
+        """
+        Like `backend.generate`, but served from the cache when possible.
+        With `bypass=True` a fresh sample is always generated (and then cached).
+        `standalone` marks a prompt that doesn't depend on earlier turns, which
+        makes it eligible for near-duplicate matching.
+        """
+        merged = dict(backend.options)
+        merged.update(options or {})
+        model = extra.get("model") or backend.model
+        key = make_key(model, prompt, context, merged)
+        if not bypass:
+            hit = self.get(key)
+            if hit is not None:
+                return ReplayStream(*hit, cancel_token=cancel_token)
+            if standalone and not context and not merged:
+                similar = self.lookup_similar(model, prompt)
+                if similar is not None:
+                    return ReplayStream(*similar, cancel_token=cancel_token)
+        stream = backend.generate(prompt, context=context, options=options,
+                                  cancel_token=cancel_token, **extra)
+        return RecordingStream(stream, self, key, model, prompt, standalone=standalone and not merged)
+
+
+_default_cache = None
+_default_lock = threading.Lock()
+
+
+def get_response_cache() -> ResponseCache:
+    """Process-wide response cache shared by every front-end in this process."""
+    global _default_cache
+    with _default_lock:
+        if _default_cache is None:
+            threshold = float(SIMILARITY_THRESHOLD) if SIMILARITY_THRESHOLD else None
+            _default_cache = ResponseCache(similarity_threshold=threshold)
+        return _default_cache
@@ -1,12 +1,25 @@
-import subprocess
 import threading
+import time
 import tkinter as tk
 from tkinter import scrolledtext, messagebox, Toplevel
-import pyttsx3
-import speech_recognition as sr
-import time
-import pyperclip
-import markdown
+
+from backend_pool import make_backend
+from cancellation import CancelToken
+from chat_view import VirtualChatView
+from conversation_context import ConversationContext
+from conversation_store import StoredTurn, get_conversation_store
+from document_index import augment, get_document_index
+from markdown_render import configure_tk_tags, markdown_to_plain
+from metrics import RequestTrace
+from model_router import get_router
+from ollama_backend import start_warm_up
+from response_cache import get_response_cache
+from scheduler import describe_wait, get_scheduler
+from stt_worker import get_speech_input
+from think_parser import REASONING, ThinkStreamParser
+from tk_render import TkRenderQueue, sources_line
+
+FRONTEND = "assistant"  # Conversation store and metrics label
 
 class PersonalizedAssistant:
     def __init__(self, root):
@@ -27,6 +40,15 @@ class PersonalizedAssistant:
         self.chat_history = scrolledtext.ScrolledText(root, width=90, height=25, font=("Arial", 12), bg="#34495e", fg="white")
         self.chat_history.pack(padx=10, pady=5)
         self.chat_history.config(state=tk.DISABLED)
+        self.chat_history.tag_config("user", foreground="lightblue")
+        self.chat_history.tag_config("think", foreground="gray")
+        self.chat_history.tag_config("bot", foreground="lightgreen")
+        self.chat_history.tag_config("error", foreground="red")
+        configure_tk_tags(self.chat_history)   # Bold, code and headings in rendered answers
+        # Streamed text is written once per frame from the Tk main loop
+        self.render = TkRenderQueue(self.chat_history, animate=True)
+        # Only a bounded window of turns stays in the widget; the rest re-render on scroll
+        self.view = VirtualChatView(self.chat_history, self.render, load_older=self.fetch_older)
 
         # User Input Frame
         self.user_input_frame = tk.Frame(root, bg="#34495e")
@@ -38,6 +60,9 @@ class PersonalizedAssistant:
         self.send_btn = tk.Button(self.user_input_frame, text="Send", command=self.start_chat, font=("Arial", 12), bg="#007acc", fg="white")
         self.send_btn.pack(side=tk.LEFT, padx=5)
 
+        self.stop_btn = tk.Button(self.user_input_frame, text="Stop", command=self.stop_chat, font=("Arial", 12), bg="#d9534f", fg="white", state=tk.DISABLED)
+        self.stop_btn.pack(side=tk.LEFT, padx=5)
+
         # Mic Input Button 🎙️
         self.mic_btn = tk.Button(self.user_input_frame, text="🎙️", command=self.start_voice_input, font=("Arial", 12), bg="#ff9900", fg="white")
         self.mic_btn.pack(side=tk.LEFT, padx=5)
@@ -46,55 +71,155 @@ class PersonalizedAssistant:
         self.copy_btn = tk.Button(self.user_input_frame, text="Copy Output", command=self.copy_output, font=("Arial", 12), bg="#ffc107", fg="white")
         self.copy_btn.pack(side=tk.LEFT, padx=5)
 
-        self.process = None
+        self.earlier_btn = tk.Button(self.user_input_frame, text="Load Earlier", command=self.load_earlier, font=("Arial", 12), bg="#6c757d", fg="white")
+        self.earlier_btn.pack(side=tk.LEFT, padx=5)
+
+        self.backend = make_backend()
+        self.router = get_router()  # Picks a deepseek-r1 size per prompt
+        start_warm_up(self.backend, *self.router.models)
+        get_document_index()  # Local documents (CHATBOT_DOCS) are indexed in the background
+        self.stream = None
+        self.conversation = ConversationContext()
+        self.scheduler = get_scheduler()
+        self.response_cache = get_response_cache()
+        self.cancel_token = None
         self.latest_response = ""
+        self.conversation_store = get_conversation_store()
+        self.speech_input = get_speech_input()
+        self.conversation_id = self.conversation_store.latest(FRONTEND)
+        self.reopen_conversation()
+
+    def reopen_conversation(self):
+        """Show the latest page of the last conversation; older pages load on demand."""
+        if self.conversation_id is None:
+            return
+        turns = self.conversation_store.resume(self.conversation_id, self.conversation)
+        if turns:
+            self.latest_response = markdown_to_plain(turns[-1].answer).strip()
+            self.view.set_turns(turns)
+
+    def load_earlier(self):
+        """Render the previous page of turns (scrolling to the top does the same)."""
+        self.render.flush()
+        self.view.page_up()
+
+    def fetch_older(self, before):
+        """Stored turns preceding `before`, for the chat view."""
+        if self.conversation_id is None:
+            return []
+        return self.conversation_store.load_page(self.conversation_id, before=before)
+
+    def save_turn(self, prompt, parser, status, context=None, model=None):
+        """Append a finished (or stopped) turn to the stored conversation; returns its seq."""
+        if status == "error" or not (status == "ok" or parser.answer):
+            return None
+        try:
+            if self.conversation_id is None:
+                self.conversation_id = self.conversation_store.create(FRONTEND)
+            seq = self.conversation_store.append_turn(
+                self.conversation_id, prompt, parser.answer.strip(), parser.reasoning.strip(),
+                "" if status == "ok" else "🛑 Chat stopped.", context, model)
+            return seq
+        except Exception as e:
+            print(f"[DEBUG] Could not save turn: {e}")
+            return None
 
     def run_deepseek(self, prompt):
-        """Run DeepSeek model and process the output."""
-        self.status_button.config(text="Generating...", bg="#ffc107")
-        self.send_btn.config(state=tk.DISABLED)
+        """Run DeepSeek model and process the output (worker thread; Tk calls go through the render queue)."""
+        ui = self.render.call
+        ui(self.status_button.config, text="Generating...", bg="#ffc107")
+        ui(self.send_btn.config, state=tk.DISABLED)
+        cancel_token = self.cancel_token = CancelToken()
+        ticket = None
+        model = self.router.route(prompt)
+        trace = RequestTrace(FRONTEND, model)
+        parser = ThinkStreamParser()
+        render_start = self.render.render_seconds
+        status = "ok"
+        note = ""
+        ui(self.view.begin_live)
+        self.render.write(f"\n🧑‍💻 You: {prompt}\n", "user")
+        # Passages from the local document folder (if configured) go into the model's prompt
+        # and skip near-duplicate matching, where the passages would dominate the comparison
+        model_prompt, sources = augment(prompt)
+        if sources:
+            self.render.write(sources_line(sources), "think")
         try:
-            self.process = subprocess.Popen(
-                ["ollama", "run", "deepseek-r1:8b"],
-                stdin=subprocess.PIPE,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                text=True
-            )
-
-            self.process.stdin.write(prompt + "\n")
-            self.process.stdin.flush()
-            self.process.stdin.close()
-
-            # Update chat history
-            self.chat_history.config(state=tk.NORMAL)
-            self.chat_history.insert(tk.END, f"\n🧑‍💻 You: {prompt}\n", "user")
-            self.chat_history.tag_config("user", foreground="lightblue")
+            self.stream = self.response_cache.generate(
+                self.backend, standalone=not (self.conversation.turns or sources),
+                cancel_token=cancel_token, **self.conversation.request(model_prompt, model))
+            if not self.stream.cached:
+                trace.queued()
+                ticket = self.scheduler.submit("desktop", model, cancel_token=cancel_token)
+                while not ticket.wait(timeout=1.0):
+                    if ticket.cancelled:
+                        return
+                    smaller = self.router.fallback(ticket)
+                    if smaller:
+                        # Queued past the latency target: move to the smaller model
+                        ticket.release()
+                        model = smaller
+                        trace.rerouted(model)
+                        self.stream = self.response_cache.generate(
+                            self.backend, bypass=True, standalone=not (self.conversation.turns or sources),
+                            cancel_token=cancel_token, **self.conversation.request(model_prompt, model))
+                        ticket = self.scheduler.submit("desktop", model, cancel_token=cancel_token)
+                    ui(self.status_button.config, text=describe_wait(ticket))
+                trace.admitted()
+                ui(self.status_button.config, text="Generating...")
 
-            response = ""
-            for line in iter(self.process.stdout.readline, ""):
-                response += line
-                self.typewriter_effect(line, "bot")
+            # Reasoning is shown dimmed, the answer in the bot colour
+            for chunk in self.stream:
+                trace.token()
+                for channel, text in parser.feed(chunk):
+                    self.show_stream_text(channel, text, cancel_token)
+            for channel, text in parser.flush():
+                self.show_stream_text(channel, text, cancel_token)
+            if cancel_token.cancelled:
+                self.conversation.add_turn(prompt, parser.answer)
+                return
 
-            self.latest_response = response.strip()  # Store response for speech output
-            self.chat_history.insert(tk.END, "\n", "bot")
-            self.chat_history.tag_config("bot", foreground="lightgreen")
-            self.chat_history.config(state=tk.DISABLED)
-            self.status_button.config(text="Idle", bg="#28a745")
-            self.send_btn.config(state=tk.NORMAL)
+            self.latest_response = markdown_to_plain(parser.answer).strip()  # Answer only, for the clipboard
+            self.conversation.add_turn(prompt, parser.answer, self.stream.context, model)
+            self.render.write("\n", "bot")
+            ui(self.status_button.config, text="Idle", bg="#28a745")
 
         except Exception as e:
-            self.chat_history.insert(tk.END, f"\n❌ Error: {e}\n", "error")
-            self.chat_history.tag_config("error", foreground="red")
-            self.status_button.config(text="Error", bg="#dc3545")
-
-    def typewriter_effect(self, text, tag):
-        """Simulate typewriter effect for bot responses"""
-        for char in text:
-            self.chat_history.insert(tk.END, char, tag)
-            self.chat_history.update()
-            time.sleep(0.03)
-        self.chat_history.see(tk.END)
+            status = "error"
+            note = f"❌ Error: {e}"
+            self.render.write(f"\n{note}\n", "error")
+            ui(self.status_button.config, text="Error", bg="#dc3545")
+        finally:
+            if ticket:
+                ticket.release()
+            if cancel_token.cancelled:
+                status = "cancelled"
+                note = "🛑 Chat stopped."
+            seq = self.save_turn(prompt, parser, status, self.stream.context if status == "ok" else None,
+                                 model)
+            # Hand the drawn turn to the view model, so it can be evicted and re-rendered
+            ui(self.view.finish_live, StoredTurn(seq, prompt, parser.answer.strip(), parser.reasoning.strip(),
+                                                 note, time.time()), sources)
+            ui(self.finish_trace, trace, status, self.stream, render_start)
+            ui(self.reset_buttons, cancel_token)
+
+    def reset_buttons(self, cancel_token):
+        """Re-enable Send and disable Stop once a generation has ended, unless another has started"""
+        if self.cancel_token is cancel_token:
+            self.send_btn.config(state=tk.NORMAL)
+            self.stop_btn.config(state=tk.DISABLED)
+
+    def finish_trace(self, trace, status, stream, render_start):
+        """Record request metrics once the response has been drawn"""
+        trace.add_render(self.render.render_seconds - render_start)
+        trace.finish(status, stream)
+        self.router.record(trace, status)
+
+    def show_stream_text(self, channel, text, cancel_token):
+        """Queue one parsed piece of the stream for display"""
+        if cancel_token.cancelled:
+            return
+        self.render.write(text, "think" if channel == REASONING else "bot")
 
     def start_chat(self):
         """Start the chat interaction"""
@@ -104,11 +229,25 @@ class PersonalizedAssistant:
 
         self.prompt_entry.delete(0, tk.END)
         self.send_btn.config(state=tk.DISABLED)
+        self.stop_btn.config(state=tk.NORMAL)
         threading.Thread(target=self.run_deepseek, args=(prompt,), daemon=True).start()
 
+    def stop_chat(self):
+        """Stop the current generation and release everything it holds"""
+        if self.cancel_token and not self.cancel_token.cancelled:
+            self.cancel_token.cancel()
+            self.render.flush()  # Show what already arrived before the notice
+            self.chat_history.config(state=tk.NORMAL)
+            self.chat_history.insert(tk.END, "\n🛑 Chat stopped.\n", "error")
+            self.chat_history.config(state=tk.DISABLED)
+            self.status_button.config(text="Idle", bg="#28a745")
+            self.stop_btn.config(state=tk.DISABLED)
+            self.send_btn.config(state=tk.NORMAL)
+
     def copy_output(self):
         """Copy the latest response to clipboard"""
         if self.latest_response:
+            import pyperclip
             pyperclip.copy(self.latest_response)
             messagebox.showinfo("Copied", "Response copied to clipboard.")
 
@@ -123,34 +262,17 @@ class PersonalizedAssistant:
 
     def voice_to_text(self, listen_window):
         """Convert speech to text and update the input field"""
-        recognizer = sr.Recognizer()
-        with sr.Microphone() as source:
-            try:
-                self.prompt_entry.delete(0, tk.END)
-                self.prompt_entry.insert(0, "🎙️ Listening...")
-                listen_window.update()
-
-                recognizer.adjust_for_ambient_noise(source, duration=1)
-                audio = recognizer.listen(source, timeout=5, phrase_time_limit=10)
-
-                text = recognizer.recognize_google(audio)
-                self.prompt_entry.delete(0, tk.END)
-                self.prompt_entry.insert(0, text)
-
-            except sr.UnknownValueError:
-                self.prompt_entry.delete(0, tk.END)
-                self.prompt_entry.insert(0, "❌ Couldn't recognize speech.")
-            except sr.RequestError:
-                self.prompt_entry.delete(0, tk.END)
-                self.prompt_entry.insert(0, "❌ Speech service unavailable.")
-            except sr.WaitTimeoutError:
-                self.prompt_entry.delete(0, tk.END)
-                self.prompt_entry.insert(0, "❌ No speech detected. Try again.")
-            except Exception as e:
-                self.prompt_entry.delete(0, tk.END)
-                self.prompt_entry.insert(0, f"❌ Error: {e}")
-
-        listen_window.destroy()
+        self.root.after(0, self.set_prompt, "🎙️ Listening...")
+        # Interim results appear in the input box while the user is still speaking
+        text = self.speech_input.recognize_prompt(
+            on_partial=lambda partial: self.root.after(0, self.set_prompt, partial))
+        self.root.after(0, self.set_prompt, text)
+        self.root.after(0, listen_window.destroy)
+
+    def set_prompt(self, text):
+        """Replace the contents of the input box"""
+        self.prompt_entry.delete(0, tk.END)
+        self.prompt_entry.insert(0, text)
 
 # Run the assistant
 if __name__ == "__main__":
@@ -0,0 +1,227 @@
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
+
+# =============================================================================
+# Generation Scheduler
+# =============================================================================
+#
+# Sits between the front-ends and the backend. Each model gets a fixed number
+# of generation slots; further requests wait in a queue ordered by priority
+# and then round-robin across clients, so one busy client can't starve the
+# rest. Clients are also rate limited, and waiting requests can report their
+# queue position and an estimated wait.
+
+DEFAULT_MAX_CONCURRENT = 2     # Generation slots per model
+DEFAULT_RATE_LIMIT = 20        # Requests per client ...
+DEFAULT_RATE_WINDOW = 60.0     # ... per this many seconds
+DEFAULT_DURATION = 20.0        # Assumed seconds per generation before any are measured
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a client submits more requests than its rate limit allows."""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class Ticket:
+    """A request's place in the scheduler, from submission until release."""
+
+    def __init__(self, scheduler, client_id, model, priority, seq):
+        self.scheduler = scheduler
+        self.client_id = client_id
+        self.model = model
+        self.priority = priority
+        self.seq = seq
+        self.submitted_at = time.monotonic()
+        self.started_at = None
+        self.admitted = False
+        self.cancelled = False
+        self.released = False
+
+    def position(self) -> int:
+        """1-based queue position, or 0 once admitted."""
+        return self.scheduler.position(self)
+
+    def estimated_wait(self) -> float:
+        """Estimated seconds until this ticket gets a slot."""
+        return self.scheduler.estimated_wait(self)
+
+    def wait(self, timeout: float = None) -> bool:
+        """Block until admitted; False on timeout or cancellation."""
+        return self.scheduler.wait(self, timeout)
+
+    def release(self):
+        """Leave the queue, or free the slot if already admitted."""
+        self.scheduler.release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.scheduler.release(self)
+
+
+class GenerationScheduler:
+    """
+    Admission control for generations. `max_concurrent` is the default slot
+    count per model; `model_limits` overrides it for individual models.
+    """
+
+    def __init__(self, max_concurrent: int = DEFAULT_MAX_CONCURRENT, model_limits: dict = None,
+                 rate_limit: int = DEFAULT_RATE_LIMIT, rate_window: float = DEFAULT_RATE_WINDOW):
+        self.max_concurrent = max_concurrent
+        self.model_limits = dict(model_limits or {})
+        self.rate_limit = rate_limit
+        self.rate_window = rate_window
+        self._cond = threading.Condition()
+        self._seq = itertools.count()
+        self._waiting = defaultdict(list)       # model -> queued tickets
+        self._running = defaultdict(int)        # model -> admitted tickets
+        self._durations = {}                    # model -> moving average seconds
+        self._history = defaultdict(deque)      # client -> recent submit times
+
+    def limit(self, model: str) -> int:
+        return self.model_limits.get(model, self.max_concurrent)
+
+    # -------------------------------------------------------------------------
+    # Submission and admission
+    # -------------------------------------------------------------------------
+
+    def submit(self, client_id, model: str, priority: int = 0, cancel_token=None) -> Ticket:
+        """
+        Queue a request. Higher `priority` runs first. Raises RateLimitExceeded
+        if the client is over its limit. Cancelling `cancel_token` releases the
+        ticket, whether it is still queued or already running.
+        """
+        now = time.monotonic()
+        with self._cond:
+            self._check_rate(client_id, now)
+            ticket = Ticket(self, client_id, model, priority, next(self._seq))
+            self._waiting[model].append(ticket)
+            self._dispatch(model)
+        if cancel_token is not None:
+            cancel_token.on_cancel(ticket.release)
+        return ticket
+
+    def _check_rate(self, client_id, now):
+        if not self.rate_limit:
+            return
+        history = self._history[client_id]
+        while history and now - history[0] >= self.rate_window:
+            history.popleft()
+        if len(history) >= self.rate_limit:
+            raise RateLimitExceeded(self.rate_window - (now - history[0]))
+        history.append(now)
+
+    def _ordered(self, model):
+        """Waiting tickets in admission order: priority, then round-robin by client."""
+        rounds = defaultdict(int)
+        keyed = []
+        for ticket in self._waiting[model]:
+            keyed.append((-ticket.priority, rounds[ticket.client_id], ticket.seq, ticket))
+            rounds[ticket.client_id] += 1
+        keyed.sort(key=lambda item: item[:3])
+        return [item[3] for item in keyed]
+
+    def _dispatch(self, model):
+        """Admit queued tickets while the model has free slots."""
+        admitted = False
+        while self._waiting[model] and self._running[model] < self.limit(model):
+            ticket = self._ordered(model)[0]
+            self._waiting[model].remove(ticket)
+            ticket.admitted = True
+            ticket.started_at = time.monotonic()
+            self._running[model] += 1
+            admitted = True
+        if admitted:
+            self._cond.notify_all()
+
+    def wait(self, ticket: Ticket, timeout: float = None) -> bool:
+        """Block until the ticket is admitted; False on timeout or cancellation."""
+        with self._cond:
+            return self._cond.wait_for(lambda: ticket.admitted or ticket.cancelled, timeout) \
+                and ticket.admitted
+
+    def release(self, ticket: Ticket):
+        """Finish or cancel a ticket, handing its slot to the next in line."""
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.admitted:
+                self._running[ticket.model] -= 1
+                self._record_duration(ticket.model, time.monotonic() - ticket.started_at)
+            else:
+                ticket.cancelled = True
+                if ticket in self._waiting[ticket.model]:
+                    self._waiting[ticket.model].remove(ticket)
+            self._dispatch(ticket.model)
+            self._cond.notify_all()
+
+    def _record_duration(self, model, seconds):
+        previous = self._durations.get(model)
+        self._durations[model] = seconds if previous is None else 0.8 * previous + 0.2 * seconds
+
+    # -------------------------------------------------------------------------
+    # Reporting
+    # -------------------------------------------------------------------------
+
+    def position(self, ticket: Ticket) -> int:
+        with self._cond:
+            if ticket.admitted or ticket.cancelled:
+                return 0
+            return self._ordered(ticket.model).index(ticket) + 1
+
+    def estimated_wait(self, ticket: Ticket) -> float:
+        with self._cond:
+            if ticket.admitted or ticket.cancelled:
+                return 0.0
+            position = self._ordered(ticket.model).index(ticket) + 1
+            duration = self._durations.get(ticket.model, DEFAULT_DURATION)
+            rounds = (position - 1) // self.limit(ticket.model) + 1
+            return rounds * duration
+
+    def expected_wait(self, model: str) -> float:
+        """Estimated seconds a request submitted now would wait for a slot."""
+        with self._cond:
+            ahead = len(self._waiting[model]) + self._running[model] - self.limit(model) + 1
+            if ahead <= 0:
+                return 0.0
+            duration = self._durations.get(model, DEFAULT_DURATION)
+            return ((ahead - 1) // self.limit(model) + 1) * duration
+
+    def queue_depth(self, model: str = None) -> int:
+        """Number of waiting requests for one model, or for all models."""
+        with self._cond:
+            if model is not None:
+                return len(self._waiting[model])
+            return sum(len(tickets) for tickets in self._waiting.values())
+
+    def running(self, model: str = None) -> int:
+        """Number of admitted generations for one model, or for all models."""
+        with self._cond:
+            if model is not None:
+                return self._running[model]
+            return sum(self._running.values())
+
+
+def describe_wait(ticket: Ticket) -> str:
+    """Short queue status for display, e.g. '⏳ Queued (position 2, ~40s)'."""
+    return f"⏳ Queued (position {ticket.position()}, ~{ticket.estimated_wait():.0f}s)"
+
+
+_default_scheduler = None
+_default_lock = threading.Lock()
+
+
+def get_scheduler() -> GenerationScheduler:
+    """Process-wide scheduler shared by every front-end in this process."""
+    global _default_scheduler
+    with _default_lock:
+        if _default_scheduler is None:
+            _default_scheduler = GenerationScheduler()
+        return _default_scheduler
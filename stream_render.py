@@ -0,0 +1,84 @@
+# =============================================================================
+# Incremental Markdown Rendering
+# =============================================================================
+#
+# Streaming responses used to be re-converted from scratch on every chunk,
+# which is quadratic in response length. This renderer splits the stream into
+# markdown blocks (separated by blank lines outside fenced code, unless the
+# next line is indented and continues a list item), converts each block once
+# when it closes, and only re-renders the trailing open block.
+
+FENCES = ("```", "~~~")
+
+
+class IncrementalMarkdownRenderer:
+    """
+    Feed streamed markdown chunks in; get the rendered text of everything so far.
+    `convert` turns one markdown block into its rendered form
+    (e.g. `markdown_to_html`); `convert_open`, if given, is used instead for
+    the block still being streamed (e.g. a conversion that isn't cached).
+    """
+
+    def __init__(self, convert, convert_open=None):
+        self.convert = convert
+        self.convert_open = convert_open or convert
+        self.rendered = ""         # Rendered output of all closed blocks
+        self._open = ""            # Source of the block still being streamed
+        self._scanned = 0          # Offset in _open up to which lines are scanned
+        self._in_fence = False     # Whether the scan position is inside ``` code
+        self._end = 0              # Offset after a blank line the open block may end at
+        self._tail_source = ""     # Source of the last rendered open block
+        self._tail_render = ""     # Its rendered output
+
+    def feed(self, chunk: str) -> str:
+        """Add a chunk of markdown and return the rendered text so far."""
+        self.append(chunk)
+        return self.render()
+
+    def append(self, chunk: str):
+        """Add a chunk of markdown without rendering the open block (call `render` when displaying)."""
+        self._open += chunk
+        self._close_blocks()
+
+    def _close_blocks(self):
+        """Scan newly completed lines and finalize every block that has ended."""
+        while True:
+            if self._end and len(self._open) > self._end and not self._open[self._end].isspace():
+                # The line after the blank line isn't indented, so the block before it is finished
+                block = self._open[:self._end]
+                self._open = self._open[self._end:]
+                self._scanned -= self._end
+                self._end = 0
+                self.rendered += self.convert(block)
+            newline = self._open.find("\n", self._scanned)
+            if newline < 0:
+                return
+            line = self._open[self._scanned:newline].strip()
+            self._scanned = newline + 1
+            if line.startswith(FENCES):
+                self._in_fence = not self._in_fence
+                self._end = 0
+            elif not line and not self._in_fence:
+                if self._open[:self._scanned].strip():
+                    self._end = self._scanned
+            elif line:
+                self._end = 0   # Indented: the block goes on
+
+    def render(self) -> str:
+        """Return closed blocks plus a fresh render of the open block."""
+        if self._open != self._tail_source:
+            self._tail_source = self._open
+            self._tail_render = self.convert_open(self._open) if self._open.strip() else ""
+        return self.rendered + self._tail_render
+
+    def finish(self) -> str:
+        """Close the trailing block and return the complete rendered text."""
+        if self._open.strip():
+            self.rendered += self.convert(self._open)
+        self._open = ""
+        self._scanned = 0
+        self._in_fence = False
+        self._end = 0
+        self._tail_source = ""
+        self._tail_render = ""
+        return self.rendered
@@ -0,0 +1,350 @@
+import json
+import math
+import os
+import sys
+import threading
+import time
+import wave
+from array import array
+from collections import deque
+from itertools import chain
+
+# =============================================================================
+# Streaming Speech-to-Text
+# =============================================================================
+#
+# Voice input used to build a new recognizer for every button press, spend a
+# second calibrating for ambient noise, record for up to ten seconds and only
+# then upload the audio to Google. Here one microphone stream is kept open
+# for the whole process and its noise calibration is cached. Each 30 ms frame
+# is passed to the recognizer while recording is still going on, and an
+# energy-based voice activity detector ends the utterance shortly after the
+# speaker stops. The result is ready almost as soon as they stop talking.
+#
+# Recognizers are pluggable (see BACKENDS). The default is Vosk, which runs
+# offline and decodes incrementally. Without a Vosk model it falls back to
+# Google recognition on the recorded audio. Audio can come from a WAV file
+# instead of the microphone, so recognition can be tested without a device
+# or network:  python stt_worker.py clip.wav
+
+SAMPLE_RATE = 16000
+FRAME_MS = 30
+CALIBRATION_MS = 300         # Noise measured before listening (only when the cache is stale)
+CALIBRATION_TTL = 300.0      # Seconds a microphone's noise level stays valid
+MIN_ENERGY = 300             # Lowest speech threshold (RMS of 16-bit samples)
+ENERGY_RATIO = 2.5           # Speech threshold as a multiple of the noise level
+START_MS = 90                # Voiced audio needed to start an utterance
+PREROLL_MS = 300             # Audio kept from just before speech starts
+END_SILENCE_MS = 700         # Silence that ends an utterance
+NO_SPEECH_TIMEOUT = 5.0      # Seconds to wait for speech to start
+MAX_PHRASE_SECONDS = 10.0
+
+DEFAULT_BACKEND = os.environ.get("CHATBOT_STT_BACKEND", "auto")
+VOSK_MODEL_PATH = os.environ.get(
+    "CHATBOT_VOSK_MODEL",
+    os.path.join(os.path.expanduser("~"), ".local", "share", "deepseek_chatbot", "vosk-model"))
+
+
+class NoSpeechDetected(Exception):
+    pass
+
+
+class SpeechNotRecognized(Exception):
+    pass
+
+
+class SpeechServiceUnavailable(Exception):
+    pass
+
+
+def frame_rms(frame: bytes) -> float:
+    """Root mean square level of a frame of 16-bit mono PCM."""
+    samples = array("h", frame)
+    if sys.byteorder == "big":
+        samples.byteswap()
+    if not samples:
+        return 0.0
+    return math.sqrt(sum(s * s for s in samples) / len(samples))
+
+
+# ---- Audio sources ---------------------------------------------------------
+
+class MicrophoneSource:
+    """
+    One PyAudio input stream, opened on first use and kept for the process.
+    The stream is paused between utterances, so stale audio is never read.
+    """
+
+    def __init__(self, sample_rate: int = SAMPLE_RATE, frame_ms: int = FRAME_MS):
+        self.sample_rate = sample_rate
+        self.frame_samples = sample_rate * frame_ms // 1000
+        self.noise_rms = None     # Cached calibration
+        self.calibrated_at = 0.0
+        self._audio = None
+        self._stream = None
+
+    @property
+    def needs_calibration(self) -> bool:
+        return self.noise_rms is None or time.monotonic() - self.calibrated_at > CALIBRATION_TTL
+
+    def calibrated(self, noise_rms: float):
+        self.noise_rms = noise_rms
+        self.calibrated_at = time.monotonic()
+
+    def frames(self):
+        """Yield frames of 16-bit mono PCM until the caller stops iterating."""
+        if self._stream is None:
+            import pyaudio
+            self._audio = pyaudio.PyAudio()
+            self._stream = self._audio.open(format=pyaudio.paInt16, channels=1, rate=self.sample_rate,
+                                            input=True, frames_per_buffer=self.frame_samples,
+                                            start=False)
+        self._stream.start_stream()
+        try:
+            while True:
+                yield self._stream.read(self.frame_samples, exception_on_overflow=False)
+        finally:
+            self._stream.stop_stream()
+
+
+class WavSource:
+    """Frames from a 16-bit mono WAV file, read as fast as they are consumed."""
+
+    needs_calibration = True
+
+    def __init__(self, path: str, frame_ms: int = FRAME_MS):
+        self.path = path
+        self.frame_ms = frame_ms
+        self.noise_rms = None
+        with wave.open(path, "rb") as wav:
+            if wav.getsampwidth() != 2 or wav.getnchannels() != 1:
+                raise ValueError(f"{path}: expected 16-bit mono PCM")
+            self.sample_rate = wav.getframerate()
+        self.frame_samples = self.sample_rate * frame_ms // 1000
+
+    def calibrated(self, noise_rms: float):
+        self.noise_rms = noise_rms
+
+    def frames(self):
+        with wave.open(self.path, "rb") as wav:
+            while True:
+                frame = wav.readframes(self.frame_samples)
+                if not frame:
+                    return
+                yield frame
+
+
+# ---- Recognizer backends ---------------------------------------------------
+
+class VoskBackend:
+    """Offline recognition with Vosk; decodes each frame as it is recorded."""
+
+    name = "vosk"
+
+    def __init__(self, model_path: str = VOSK_MODEL_PATH):
+        from vosk import Model, SetLogLevel
+        SetLogLevel(-1)
+        self._model = Model(model_path)   # Loaded once; recognizers per utterance are cheap
+
+    def start(self, sample_rate: int):
+        from vosk import KaldiRecognizer
+        return _VoskUtterance(KaldiRecognizer(self._model, sample_rate))
+
+
+class _VoskUtterance:
+    def __init__(self, recognizer):
+        self._recognizer = recognizer
+        self._text = []
+
+    def accept(self, frame: bytes):
+        if self._recognizer.AcceptWaveform(frame):
+            self._text.append(json.loads(self._recognizer.Result()).get("text", ""))
+
+    def partial(self) -> str:
+        partial = json.loads(self._recognizer.PartialResult()).get("partial", "")
+        return " ".join(t for t in self._text + [partial] if t)
+
+    def result(self) -> str:
+        self._text.append(json.loads(self._recognizer.FinalResult()).get("text", ""))
+        return " ".join(t for t in self._text if t)
+
+
+class GoogleBackend:
+    """Google Web Speech via SpeechRecognition; needs the network, recognizes after recording."""
+
+    name = "google"
+
+    def __init__(self):
+        import speech_recognition as sr
+        self._sr = sr
+        self._recognizer = sr.Recognizer()
+
+    def start(self, sample_rate: int):
+        return _BufferedUtterance(self, sample_rate)
+
+    def recognize(self, pcm: bytes, sample_rate: int) -> str:
+        sr = self._sr
+        try:
+            return self._recognizer.recognize_google(sr.AudioData(pcm, sample_rate, 2))
+        except sr.UnknownValueError:
+            raise SpeechNotRecognized()
+        except sr.RequestError as e:
+            raise SpeechServiceUnavailable(str(e))
+
+
+class _BufferedUtterance:
+    def __init__(self, backend, sample_rate):
+        self._backend = backend
+        self._sample_rate = sample_rate
+        self._frames = []
+
+    def accept(self, frame: bytes):
+        self._frames.append(frame)
+
+    def partial(self) -> str:
+        return ""
+
+    def result(self) -> str:
+        return self._backend.recognize(b"".join(self._frames), self._sample_rate)
+
+
+BACKENDS = {"vosk": VoskBackend, "google": GoogleBackend}
+
+
+def make_backend(name: str = DEFAULT_BACKEND):
+    """Create a recognizer backend; "auto" prefers Vosk when a model is installed."""
+    if name != "auto":
+        return BACKENDS[name]()
+    if os.path.isdir(VOSK_MODEL_PATH):
+        try:
+            return VoskBackend()
+        except Exception as e:
+            print(f"[DEBUG] Vosk unavailable, using Google recognition: {e}")
+    return GoogleBackend()
+
+
+# ---- Listening -------------------------------------------------------------
+
+class SpeechInput:
+    """
+    Voice-activity-detected recognition on one reusable backend and microphone.
+    One utterance is recognized at a time; thread-safe.
+    """
+
+    def __init__(self, backend=None, microphone=None):
+        self._backend = backend
+        self.microphone = microphone or MicrophoneSource()
+        self._lock = threading.Lock()
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            self._backend = make_backend()
+        return self._backend
+
+    def listen(self, source=None, on_partial=None) -> str:
+        """
+        Record one utterance from `source` (default: the microphone) and return
+        its text. `on_partial(text)` receives interim results while recording.
+        """
+        source = source or self.microphone
+        frame_ms = 1000 * source.frame_samples // source.sample_rate
+        with self._lock:
+            utterance = self.backend.start(source.sample_rate)
+            frames = source.frames()
+            try:
+                threshold, calibration = self._threshold(source, frames, frame_ms)
+                # Calibration audio still goes through detection, so speech in it is kept
+                self._record(utterance, chain(calibration, frames), threshold, frame_ms, on_partial)
+            finally:
+                frames.close()
+            text = utterance.result().strip()
+        if not text:
+            raise SpeechNotRecognized()
+        return text
+
+    def _threshold(self, source, frames, frame_ms):
+        """Speech threshold, and the frames read to calibrate it (if any)."""
+        calibration = []
+        if source.needs_calibration:
+            calibration = list(_take(frames, CALIBRATION_MS // frame_ms))
+            levels = [frame_rms(frame) for frame in calibration]
+            source.calibrated(sum(levels) / len(levels) if levels else 0.0)
+        return max(MIN_ENERGY, source.noise_rms * ENERGY_RATIO), calibration
+
+    def _record(self, utterance, frames, threshold, frame_ms, on_partial):
+        preroll = deque(maxlen=PREROLL_MS // frame_ms)
+        start_frames = START_MS // frame_ms
+        end_frames = END_SILENCE_MS // frame_ms
+        wait_frames = int(NO_SPEECH_TIMEOUT * 1000) // frame_ms
+        max_frames = int(MAX_PHRASE_SECONDS * 1000) // frame_ms
+        voiced_run = silent_run = recorded = 0
+        last_partial = ""
+        for count, frame in enumerate(frames):
+            voiced = frame_rms(frame) >= threshold
+            if not recorded:
+                # Waiting for speech: keep a little audio from before it starts
+                preroll.append(frame)
+                voiced_run = voiced_run + 1 if voiced else 0
+                if voiced_run >= start_frames:
+                    for buffered in preroll:
+                        utterance.accept(buffered)
+                    recorded = len(preroll)
+                elif count >= wait_frames:
+                    raise NoSpeechDetected()
+                continue
+            utterance.accept(frame)
+            recorded += 1
+            silent_run = 0 if voiced else silent_run + 1
+            if silent_run >= end_frames or recorded >= max_frames:
+                return
+            if on_partial:
+                partial = utterance.partial()
+                if partial != last_partial:
+                    last_partial = partial
+                    on_partial(partial)
+        if not recorded:
+            raise NoSpeechDetected()
+
+    def recognize_prompt(self, source=None, on_partial=None) -> str:
+        """`listen`, with failures turned into the messages shown in the prompt box."""
+        try:
+            return self.listen(source, on_partial)
+        except NoSpeechDetected:
+            return "❌ No speech detected. Try again."
+        except SpeechNotRecognized:
+            return "❌ Couldn't recognize speech."
+        except SpeechServiceUnavailable:
+            return "❌ Speech service unavailable."
+        except Exception as e:
+            return f"❌ Error: {e}"
+
+
+def _take(iterator, count):
+    for _ in range(count):
+        frame = next(iterator, None)
+        if frame is None:
+            return
+        yield frame
+
+
+_default_input = None
+_default_lock = threading.Lock()
+
+
+def get_speech_input() -> SpeechInput:
+    """Process-wide speech input (there is only one microphone)."""
+    global _default_input
+    with _default_lock:
+        if _default_input is None:
+            _default_input = SpeechInput()
+        return _default_input
+
+
+if __name__ == "__main__":
+    # Transcribe WAV files without a microphone, e.g. to check a Vosk model
+    speech_input = SpeechInput()
+    for path in sys.argv[1:]:
+        started = time.perf_counter()
+        text = speech_input.recognize_prompt(WavSource(path))
+        print(f"{path}: {text} ({time.perf_counter() - started:.2f}s)")
@@ -0,0 +1,151 @@
+import json
+import os
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# The modules live flat in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        self.server.fake._opened(self.connection)
+
+    def do_POST(self):
+        fake = self.server.fake
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        fake.requests.append((self.path, payload))
+        if fake.drop == "before":
+            # Hang up without answering: a connection error for the client
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return
+        if fake.status != 200:
+            body = json.dumps({"error": f"fake error {fake.status}"}).encode()
+            self.send_response(fake.status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        field = "message" if self.path == "/api/chat" else "response"
+        for number, text in enumerate(fake.chunks):
+            if fake.drop == number:
+                self.close_connection = True
+                self.connection.shutdown(socket.SHUT_RDWR)
+                return
+            if number == 1:
+                fake.hold.wait(10)   # Lets a test act between the first and second chunk
+            value = {"role": "assistant", "content": text} if field == "message" else text
+            self._chunk({field: value, "done": False})
+        self._chunk({field: "" if field == "response" else {"role": "assistant", "content": ""},
+                     "done": True, "context": [1, 2, 3], "eval_count": len(fake.chunks)})
+        self.wfile.write(b"0\r\n\r\n")
+
+    def do_GET(self):
+        fake = self.server.fake
+        fake.requests.append((self.path, None))
+        body = json.dumps({"models": [{"name": name} for name in fake.resident]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _chunk(self, obj):
+        line = (json.dumps(obj) + "\n").encode()
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+        self.wfile.flush()
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass   # Clients hanging up mid-stream are part of the tests
+
+
+class FakeOllama:
+    """
+    Local stand-in for an Ollama server streaming NDJSON. Set `status` to
+    fail requests, `drop` to hang up before answering ("before") or before
+    chunk N, and clear `hold` to pause after the first chunk.
+    """
+
+    def __init__(self, chunks=("Hello", ", ", "world")):
+        self.chunks = list(chunks)
+        self.status = 200
+        self.drop = None
+        self.resident = []          # Models reported by /api/ps
+        self.requests = []          # (path, payload) of every request
+        self.connections = 0        # TCP connections accepted
+        self.hold = threading.Event()
+        self.hold.set()
+        self.port = None
+        self._sockets = []
+        self._server = None
+        self.start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def generations(self) -> int:
+        return sum(1 for path, _ in self.requests if path != "/api/ps")
+
+    def _opened(self, connection):
+        self.connections += 1
+        self._sockets.append(connection)
+
+    def start(self):
+        """Listen (again, on the same port once it has been used)."""
+        self._server = _Server(("127.0.0.1", self.port or 0), _Handler)
+        self._server.fake = self
+        self.port = self._server.server_address[1]
+        threading.Thread(target=self._server.serve_forever, args=(0.05,), daemon=True).start()
+
+    def hang_up(self):
+        """Close every open connection, as a restarted server would."""
+        sockets, self._sockets = self._sockets, []
+        for connection in sockets:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def stop(self):
+        """Stop listening and drop open connections: the host is down."""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        self.hang_up()
+
+
+@pytest.fixture
+def fake_ollama():
+    """Factory for local fake Ollama servers, all stopped after the test."""
+    servers = []
+
+    def start(**kwargs):
+        server = FakeOllama(**kwargs)
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.hold.set()
+        server.stop()
@@ -0,0 +1,113 @@
+from collections import Counter
+
+import pytest
+
+from backend_pool import EVICT_AFTER, READMIT_AFTER, make_backend
+from ollama_backend import OllamaError
+
+ENGINES = ["threads", "async"]
+
+
+def start_pool(fake_ollama, count, engine, resident=("m",)):
+    """`count` fake servers with `resident` loaded, and a pool over them (health checked once)."""
+    servers = [fake_ollama(chunks=(f"host{n}",)) for n in range(count)]
+    for server in servers:
+        server.resident = list(resident)
+    pool = make_backend([server.url for server in servers], engine=engine, model="m", health_interval=0)
+    pool.check_health()
+    return servers, pool
+
+
+def answer(pool):
+    return "".join(pool.generate("Hi"))
+
+
+@pytest.fixture(params=ENGINES)
+def engine(request):
+    return request.param
+
+
+def healthy(pool):
+    return [is_healthy for _, is_healthy, _, _ in pool.status()]
+
+
+def test_spreads_requests_over_warm_hosts(fake_ollama, engine):
+    servers, pool = start_pool(fake_ollama, 3, engine)
+    try:
+        answers = Counter(answer(pool) for _ in range(9))
+    finally:
+        pool.close()
+    assert answers == {"host0": 3, "host1": 3, "host2": 3}
+
+
+def test_prefers_the_host_with_the_model_resident(fake_ollama, engine):
+    servers, pool = start_pool(fake_ollama, 3, engine, resident=())
+    servers[2].resident = ["m"]
+    pool.check_health()
+    try:
+        assert {answer(pool) for _ in range(4)} == {"host2"}
+    finally:
+        pool.close()
+
+
+def test_fails_over_and_evicts_a_host_that_goes_down(fake_ollama, engine):
+    servers, pool = start_pool(fake_ollama, 3, engine)
+    try:
+        assert {answer(pool) for _ in range(3)} == {"host0", "host1", "host2"}
+        servers[1].stop()
+        before = servers[1].generations()
+        answers = [answer(pool) for _ in range(9)]
+    finally:
+        pool.close()
+    # Every request is answered by a live host, and the dead one is taken out of rotation
+    assert set(answers) == {"host0", "host2"}
+    assert servers[1].generations() == before
+    assert healthy(pool) == [True, False, True]
+    assert pool.hosts[1].failures >= EVICT_AFTER
+
+
+def test_health_checks_evict_and_readmit_a_host(fake_ollama, engine):
+    servers, pool = start_pool(fake_ollama, 2, engine)
+    try:
+        servers[0].stop()
+        for _ in range(EVICT_AFTER):
+            pool.check_health()
+        assert healthy(pool) == [False, True]
+        assert {answer(pool) for _ in range(4)} == {"host1"}
+
+        servers[0].start()
+        for _ in range(READMIT_AFTER - 1):
+            pool.check_health()
+        assert healthy(pool) == [False, True]
+        pool.check_health()
+        assert healthy(pool) == [True, True]
+        assert {answer(pool) for _ in range(4)} == {"host0", "host1"}
+    finally:
+        pool.close()
+
+
+def test_client_errors_are_raised_without_touching_host_health(fake_ollama, engine):
+    servers, pool = start_pool(fake_ollama, 2, engine)
+    for server in servers:
+        server.status = 404
+    try:
+        for _ in range(EVICT_AFTER + 1):
+            with pytest.raises(OllamaError) as raised:
+                answer(pool)
+            assert raised.value.status == 404
+    finally:
+        pool.close()
+    assert sum(server.generations() for server in servers) == EVICT_AFTER + 1   # Never retried
+    assert healthy(pool) == [True, True]
+    assert [host.failures for host in pool.hosts] == [0, 0]
+
+
+def test_raises_when_every_host_is_down(fake_ollama, engine):
+    servers, pool = start_pool(fake_ollama, 2, engine)
+    for server in servers:
+        server.stop()
+    try:
+        with pytest.raises(OSError):
+            answer(pool)
+    finally:
+        pool.close()
@@ -0,0 +1,101 @@
+import http.client
+
+import pytest
+
+from backend_pool import BackendPool
+from cancellation import CancelToken
+from ollama_backend import OllamaBackend, OllamaError
+
+
+def test_streams_chunks_and_final_status(fake_ollama):
+    server = fake_ollama()
+    backend = OllamaBackend(model="m", host=server.url)
+    stream = backend.generate("Hi", options={"num_predict": 8})
+    assert list(stream) == ["Hello", ", ", "world"]
+    assert stream.done
+    assert stream.context == [1, 2, 3]
+    path, payload = server.requests[0]
+    assert path == "/api/generate"
+    assert payload["prompt"] == "Hi" and payload["model"] == "m" and payload["stream"] is True
+    assert payload["options"] == {"num_predict": 8} and payload["keep_alive"]
+
+
+def test_chat_streams_message_content(fake_ollama):
+    server = fake_ollama()
+    backend = OllamaBackend(model="m", host=server.url)
+    assert "".join(backend.chat([{"role": "user", "content": "Hi"}])) == "Hello, world"
+    assert server.requests[0][0] == "/api/chat"
+
+
+def test_reuses_one_keep_alive_connection(fake_ollama):
+    server = fake_ollama()
+    backend = OllamaBackend(model="m", host=server.url)
+    for _ in range(3):
+        assert "".join(backend.generate("Hi")) == "Hello, world"
+    assert server.connections == 1
+    assert server.generations() == 3
+
+
+def test_reconnects_when_the_pooled_connection_went_stale(fake_ollama):
+    server = fake_ollama()
+    backend = OllamaBackend(model="m", host=server.url)
+    assert "".join(backend.generate("Hi")) == "Hello, world"
+    server.hang_up()
+    assert "".join(backend.generate("Hi")) == "Hello, world"
+    assert server.connections == 2
+
+
+@pytest.mark.parametrize("status", [404, 500])
+def test_http_error_carries_status(fake_ollama, status):
+    server = fake_ollama()
+    server.status = status
+    backend = OllamaBackend(model="m", host=server.url)
+    with pytest.raises(OllamaError) as raised:
+        list(backend.generate("Hi"))
+    assert raised.value.status == status
+    assert f"fake error {status}" in str(raised.value)
+
+
+@pytest.mark.parametrize("failure", ["503", "connection"])
+def test_pool_retries_on_another_host_before_the_first_chunk(fake_ollama, failure):
+    bad, good = fake_ollama(), fake_ollama(chunks=("from", " good"))
+    if failure == "503":
+        bad.status = 503
+    else:
+        bad.drop = "before"
+    pool = BackendPool([bad.url, good.url], model="m", health_interval=0)
+    pool.hosts[0].resident.add("m")   # Preferred, so it is tried first
+    stream = pool.generate("Hi")
+    assert "".join(stream) == "from good"
+    assert stream.host == good.url
+    assert bad.generations() == 1 and good.generations() == 1
+    assert pool.hosts[0].failures == 1
+
+
+def test_pool_does_not_retry_after_the_first_chunk(fake_ollama):
+    bad, good = fake_ollama(), fake_ollama()
+    bad.drop = 1
+    pool = BackendPool([bad.url, good.url], model="m", health_interval=0)
+    pool.hosts[0].resident.add("m")
+    received = []
+    with pytest.raises((OSError, http.client.HTTPException)):
+        for chunk in pool.generate("Hi"):
+            received.append(chunk)
+    assert received == ["Hello"]
+    assert good.generations() == 0
+    assert pool.hosts[0].failures == 0
+
+
+def test_cancelling_closes_the_stream(fake_ollama):
+    server = fake_ollama()
+    server.hold.clear()
+    backend = OllamaBackend(model="m", host=server.url)
+    cancel_token = CancelToken()
+    stream = backend.generate("Hi", cancel_token=cancel_token)
+    chunks = iter(stream)
+    assert next(chunks) == "Hello"
+    cancel_token.cancel()
+    server.hold.set()
+    assert list(chunks) == []
+    assert not stream.done
+    assert backend.pool._idle == []   # The aborted connection is not reused
@@ -0,0 +1,26 @@
+from response_cache import ResponseCache
+from similarity_cache import SimilarPromptIndex
+
+PROMPT = "How do I reverse a list in Python without modifying the original list?"
+
+
+def test_discard_removes_the_prompt_and_its_buckets():
+    index = SimilarPromptIndex()
+    index.add("m", PROMPT, "k1")
+    index.add("m", "What is the capital city of France and why?", "k2")
+    assert len(index) == 2 and index.query("m", PROMPT) == (1.0, "k1")
+    index.discard("m", "k1")
+    assert len(index) == 1
+    assert index.query("m", PROMPT) is None
+    assert all(0 not in entries for entries in index._buckets.values())
+    index.discard("m", "k2")
+    assert len(index) == 0 and not index._buckets
+
+
+def test_clear_forgets_similar_prompts():
+    cache = ResponseCache(":memory:", similarity_threshold=0.85)
+    cache.put("k1", "m", PROMPT, "Use reversed() or slicing.", standalone=True)
+    assert cache.lookup_similar("m", PROMPT) is not None
+    cache.clear()
+    assert len(cache.similar) == 0
+    assert cache.lookup_similar("m", PROMPT) is None
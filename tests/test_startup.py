@@ -0,0 +1,29 @@
+import importlib.util
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from benchmark import ENTRY_POINTS, IMPORT_BUDGET_MS, IMPORT_PROBE, LAZY_MODULES
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_entry_point(module: str, framework: str) -> dict:
+    """Import `module` in a fresh interpreter after its UI framework; returns the probe's report."""
+    probe = IMPORT_PROBE.format(framework=framework, module=module, lazy=LAZY_MODULES)
+    proc = subprocess.run([sys.executable, "-c", probe], capture_output=True, text=True,
+                          cwd=ROOT, timeout=120)
+    assert proc.returncode == 0, proc.stderr
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+@pytest.mark.parametrize("module,framework", sorted(ENTRY_POINTS.items()))
+def test_entry_point_imports_within_budget(module, framework):
+    if importlib.util.find_spec(framework) is None:
+        pytest.skip(f"{framework} is not installed")
+    result = import_entry_point(module, framework)
+    assert result["import_ms"] <= IMPORT_BUDGET_MS, f"{module} took {result['import_ms']:.0f} ms to import"
+    assert result["loaded"] == [], f"{module} imported {', '.join(result['loaded'])} at startup"
@@ -0,0 +1,91 @@
+import math
+import wave
+from array import array
+
+import pytest
+
+from stt_worker import (FRAME_MS, SAMPLE_RATE, NoSpeechDetected, SpeechInput, SpeechNotRecognized,
+                        WavSource)
+
+FRAME_BYTES = SAMPLE_RATE * FRAME_MS // 1000 * 2
+
+
+class StubBackend:
+    """Records every frame the detector accepts; recognizes them as "hello"."""
+
+    def __init__(self):
+        self.accepted = []
+
+    def start(self, sample_rate):
+        return self
+
+    def accept(self, frame):
+        self.accepted.append(frame)
+
+    def partial(self):
+        return ""
+
+    def result(self):
+        return "hello" if self.accepted else ""
+
+
+def pcm(*parts) -> bytes:
+    """16-bit PCM from (kind, milliseconds) parts, kind being "silence" or "tone"."""
+    samples = array("h")
+    for kind, ms in parts:
+        for i in range(SAMPLE_RATE * ms // 1000):
+            samples.append(int(8000 * math.sin(2 * math.pi * 440 * i / SAMPLE_RATE)) if kind == "tone" else 0)
+    return samples.tobytes()
+
+
+def wav_source(tmp_path, audio: bytes) -> WavSource:
+    path = str(tmp_path / "clip.wav")
+    with wave.open(path, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(SAMPLE_RATE)
+        wav.writeframes(audio)
+    return WavSource(path)
+
+
+def listen(source):
+    backend = StubBackend()
+    text = SpeechInput(backend=backend, microphone=source).listen(source)
+    return text, b"".join(backend.accepted)
+
+
+def test_detects_start_and_end_of_speech_with_preroll(tmp_path):
+    audio = pcm(("silence", 600), ("tone", 600), ("silence", 1500))
+    text, recorded = listen(wav_source(tmp_path, audio))
+    assert text == "hello"
+    tone_start, tone_end = audio.index(pcm(("tone", 600))), len(pcm(("silence", 600), ("tone", 600)))
+    start = audio.index(recorded)
+    # The whole tone is recognized, with audio from just before it...
+    assert start < tone_start and start + len(recorded) > tone_end
+    assert tone_start - start >= 3 * FRAME_BYTES
+    # ...and recording stops after the trailing silence, not at the end of the clip
+    assert start + len(recorded) < len(audio)
+
+
+def test_calibration_frames_reach_the_recognizer(tmp_path):
+    # Speech starts right after the 300 ms calibration: the preroll comes from calibration audio
+    audio = pcm(("silence", 300), ("tone", 600), ("silence", 1500))
+    _, recorded = listen(wav_source(tmp_path, audio))
+    assert audio.index(recorded) < len(pcm(("silence", 300)))
+
+
+def test_all_silence_raises_no_speech(tmp_path):
+    source = wav_source(tmp_path, pcm(("silence", 2000)))
+    with pytest.raises(NoSpeechDetected):
+        listen(source)
+    assert SpeechInput(backend=StubBackend()).recognize_prompt(source) == "❌ No speech detected. Try again."
+
+
+def test_empty_recognition_raises_not_recognized(tmp_path):
+    class Unrecognized(StubBackend):
+        def result(self):
+            return " "
+
+    source = wav_source(tmp_path, pcm(("silence", 600), ("tone", 600), ("silence", 1500)))
+    with pytest.raises(SpeechNotRecognized):
+        SpeechInput(backend=Unrecognized(), microphone=source).listen(source)
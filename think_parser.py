@@ -0,0 +1,94 @@
+# =============================================================================
+# Reasoning-Aware Stream Parsing
+# =============================================================================
+#
+# deepseek-r1 streams a `<think>...</think>` reasoning section before its
+# answer. This parser splits the token stream into a reasoning channel and an
+# answer channel as it arrives (tags may be split across chunks), so the
+# front-ends can collapse or skip the reasoning, and speech, clipboard,
+# history and cache can work with the answer alone.
+
+REASONING = "reasoning"
+ANSWER = "answer"
+
+OPEN_TAG = "<think>"
+CLOSE_TAG = "</think>"
+
+
+def _partial_tag_length(text: str, tag: str) -> int:
+    """Length of the longest suffix of `text` that is a proper prefix of `tag`."""
+    for size in range(min(len(tag) - 1, len(text)), 0, -1):
+        if text.endswith(tag[:size]):
+            return size
+    return 0
+
+
+class ThinkStreamParser:
+    """
+    Feed streamed chunks in; get back (channel, text) pieces, where channel is
+    REASONING or ANSWER. `reasoning` and `answer` hold everything seen so far.
+    """
+
+    def __init__(self):
+        self.in_reasoning = False
+        self.reasoning = ""
+        self.answer = ""
+        self._pending = ""
+        self._seen_text = False   # An opening tag only counts before any answer text
+
+    def feed(self, chunk: str) -> list:
+        text = self._pending + chunk
+        self._pending = ""
+        pieces = []
+        while text:
+            if not self.in_reasoning:
+                index = text.find(OPEN_TAG)
+                if self._seen_text or (index >= 0 and text[:index].strip()):
+                    self._emit(pieces, ANSWER, text)
+                    break
+            tag = CLOSE_TAG if self.in_reasoning else OPEN_TAG
+            index = text.find(tag)
+            if index >= 0:
+                self._emit(pieces, REASONING if self.in_reasoning else ANSWER, text[:index])
+                self.in_reasoning = not self.in_reasoning
+                text = text[index + len(tag):]
+                continue
+            keep = _partial_tag_length(text, tag)
+            if keep and (self.in_reasoning or not text[:-keep].strip()):
+                self._pending = text[-keep:]
+                text = text[:-keep]
+            self._emit(pieces, REASONING if self.in_reasoning else ANSWER, text)
+            break
+        return pieces
+
+    def flush(self) -> list:
+        """Emit any held-back partial tag once the stream has ended."""
+        pieces = []
+        text, self._pending = self._pending, ""
+        self._emit(pieces, REASONING if self.in_reasoning else ANSWER, text)
+        return pieces
+
+    def _emit(self, pieces, channel, text):
+        if channel == ANSWER and not self.answer:
+            # Drop the blank lines between `</think>` and the answer
+            text = text.lstrip()
+            if text:
+                self._seen_text = True
+        if not text:
+            return
+        if channel == REASONING:
+            self.reasoning += text
+        else:
+            self.answer += text
+        if pieces and pieces[-1][0] == channel:
+            pieces[-1] = (channel, pieces[-1][1] + text)
+        else:
+            pieces.append((channel, text))
+
+
+def split_reasoning(text: str):
+    """Split a complete response into (reasoning, answer)."""
+    parser = ThinkStreamParser()
+    parser.feed(text)
+    parser.flush()
+    return parser.reasoning.strip(), parser.answer.strip()
@@ -0,0 +1,163 @@
+import math
+import queue
+import time
+import tkinter as tk
+from collections import deque
+
+from markdown_render import markdown_to_tk_runs
+
+# =============================================================================
+# Frame-Paced Tk Rendering
+# =============================================================================
+#
+# Tk widgets may only be touched from the main loop. Worker threads put text
+# and UI calls on a TkRenderQueue; the main loop drains it once per frame via
+# `after`, writing everything that arrived in that frame with a single insert
+# and scrolling at most once. Display speed follows the model, not a timer.
+#
+# With `animate=True` text is revealed a few characters per frame, but the
+# reveal rate grows with the backlog so the animation never falls more than
+# CATCH_UP_FRAMES behind the stream.
+
+FRAME_MS = 16                 # ~60 frames per second
+ANIMATION_CHARS_PER_FRAME = 2  # Minimum reveal speed (~120 chars/s)
+CATCH_UP_FRAMES = 15          # Maximum animation lag (~0.25 s)
+
+
+def sources_line(sources) -> str:
+    """The line listing the documents a prompt was answered from."""
+    return f"📚 Sources: {', '.join(sources)}\n"
+
+
+def stored_turn_runs(turn, sources=()) -> list:
+    """Text/tag runs that redisplay a stored turn (see conversation_store)."""
+    runs = [f"\n🧑‍💻 You: {turn.prompt}\n", "user"]
+    if sources:
+        runs += [sources_line(sources), "think"]
+    if turn.reasoning:
+        runs += [turn.reasoning + "\n\n", "think"]
+    if turn.answer:
+        runs += markdown_to_tk_runs(turn.answer, "bot") + ["\n", "bot"]
+    if turn.note:
+        runs += [f"\n{turn.note}\n", "error"]
+    return runs
+
+
+class TkRenderQueue:
+    """
+    Thread-safe render queue for a Text widget. `write` and `call` may be
+    used from any thread; `flush` only from the Tk main loop.
+    """
+
+    def __init__(self, widget, frame_ms: int = FRAME_MS, animate: bool = False):
+        self.widget = widget
+        self.frame_ms = frame_ms
+        self.animate = animate
+        self._inbox = queue.SimpleQueue()
+        self._pending = deque()   # [text, tag] segments and (fn, args, kwargs) calls, in order
+        self._pending_chars = 0
+        self.render_seconds = 0.0   # Total time spent drawing, for latency metrics
+        self.widget.after(self.frame_ms, self._tick)
+
+    def write(self, text: str, tag: str = None):
+        """Append text to the widget on the next frame."""
+        if text:
+            self._inbox.put((text, tag))
+
+    def call(self, fn, *args, **kwargs):
+        """Run a Tk call on the main loop, after all text written before it."""
+        self._inbox.put((fn, args, kwargs))
+
+    def flush(self):
+        """Apply everything queued so far immediately (main loop only)."""
+        self._collect()
+        self._render(self._pending_chars)
+
+    def insert_now(self, runs, index=tk.END):
+        """Insert text/tag runs immediately, e.g. re-rendered history (main loop only)."""
+        self._insert(runs, index)
+
+    def delete_now(self, start, end=tk.END):
+        """Delete a range of text immediately (main loop only)."""
+        widget = self.widget
+        disabled = str(widget.cget("state")) == tk.DISABLED
+        if disabled:
+            widget.config(state=tk.NORMAL)
+        widget.delete(start, end)
+        if disabled:
+            widget.config(state=tk.DISABLED)
+
+    def _tick(self):
+        try:
+            self._collect()
+            if self._pending:
+                if self.animate:
+                    budget = max(ANIMATION_CHARS_PER_FRAME,
+                                 math.ceil(self._pending_chars / CATCH_UP_FRAMES))
+                else:
+                    budget = self._pending_chars
+                self._render(budget)
+        except Exception as e:
+            print(f"[DEBUG] Render error: {e}")
+        self.widget.after(self.frame_ms, self._tick)
+
+    def _collect(self):
+        """Move new items from the thread-safe inbox, merging adjacent text of the same tag."""
+        pending = self._pending
+        while True:
+            try:
+                item = self._inbox.get_nowait()
+            except queue.Empty:
+                return
+            if callable(item[0]):
+                pending.append(item)
+                continue
+            text, tag = item
+            self._pending_chars += len(text)
+            if pending and isinstance(pending[-1], list) and pending[-1][1] == tag:
+                pending[-1][0] += text
+            else:
+                pending.append([text, tag])
+
+    def _render(self, budget: int):
+        """Insert up to `budget` characters (running queued calls in order), then scroll once."""
+        started = time.perf_counter()
+        widget = self.widget
+        follow = widget.yview()[1] >= 0.999   # Only autoscroll if already at the bottom
+        runs = []
+        pending = self._pending
+        while pending:
+            item = pending[0]
+            if isinstance(item, list):
+                if budget <= 0:
+                    break
+                text, tag = item
+                piece = text[:budget]
+                runs += [piece, tag or ()]
+                budget -= len(piece)
+                self._pending_chars -= len(piece)
+                if len(piece) < len(text):
+                    item[0] = text[len(piece):]
+                    break
+                pending.popleft()
+            else:
+                self._insert(runs)
+                runs = []
+                pending.popleft()
+                fn, args, kwargs = item
+                fn(*args, **kwargs)
+        self._insert(runs)
+        if follow:
+            widget.see(tk.END)
+        self.render_seconds += time.perf_counter() - started
+
+    def _insert(self, runs, index=tk.END):
+        if not runs:
+            return
+        widget = self.widget
+        disabled = str(widget.cget("state")) == tk.DISABLED
+        if disabled:
+            widget.config(state=tk.NORMAL)
+        widget.insert(index, *runs)
+        if disabled:
+            widget.config(state=tk.DISABLED)
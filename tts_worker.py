@@ -0,0 +1,196 @@
+import queue
+import re
+import threading
+
+# =============================================================================
+# Streaming Text-to-Speech
+# =============================================================================
+#
+# One long-lived pyttsx3 engine runs on a dedicated worker thread (the engine
+# isn't thread-safe, and initializing it per response is slow). Responses are
+# fed in as they stream; each sentence is queued and spoken as soon as it is
+# complete, while the rest of the response is still being generated.
+
+DEFAULT_RATE = 150
+
+SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+|\n+")
+MARKDOWN_NOISE = re.compile(r"```\w*|[*_#`>|]+|^\s*[-+]\s+", re.MULTILINE)
+STOP = object()              # Queued by begin(): silence the engine on the worker thread
+
+
+def speakable(text: str) -> str:
+    """Strip markdown symbols that would otherwise be read aloud."""
+    return " ".join(MARKDOWN_NOISE.sub("", text).split())
+
+
+class SentenceSplitter:
+    """Accumulates streamed text and returns sentences as they complete."""
+
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text: str) -> list:
+        self.buffer += text
+        parts = SENTENCE_END.split(self.buffer)
+        self.buffer = parts.pop()
+        return [s for s in (speakable(p) for p in parts) if s]
+
+    def flush(self) -> list:
+        rest, self.buffer = speakable(self.buffer), ""
+        return [rest] if rest else []
+
+
+class SpeechPipeline:
+    """
+    Sentence-level TTS on one persistent engine.
+    Each `begin()` starts a new utterance and silences the previous one;
+    `feed`/`flush` calls carrying an older utterance id are ignored.
+    """
+
+    def __init__(self, rate: int = DEFAULT_RATE):
+        self.rate = rate
+        self.muted = False
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._utterance = 0
+        self._splitter = SentenceSplitter()
+        self._on_start = None
+        self._engine = None
+        self._thread = None
+        self._speaking = None     # Utterance of the sentence being spoken (worker thread only)
+
+    def _ensure_worker(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="tts-worker", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        """Worker thread: owns the engine and speaks queued sentences in order."""
+        try:
+            import pyttsx3
+            self._engine = pyttsx3.init()
+            self._engine.setProperty("rate", self.rate)
+            # Called on this thread during runAndWait(), so a stale sentence is cut off mid-way
+            self._engine.connect("started-word", self._on_word)
+        except Exception as e:
+            print(f"[DEBUG] TTS engine unavailable: {e}")
+            self._engine = None
+        while True:
+            item = self._queue.get()
+            if item is STOP:
+                self._interrupt()
+                continue
+            utterance, sentence = item
+            with self._lock:
+                current = utterance == self._utterance and not self.muted
+                on_start = self._on_start if current else None
+                if current:
+                    self._on_start = None
+            if not current or self._engine is None:
+                continue
+            if on_start:
+                on_start()
+            self._speaking = utterance
+            try:
+                self._engine.say(sentence)
+                self._engine.runAndWait()
+            except Exception as e:
+                print(f"[DEBUG] TTS error: {e}")
+            finally:
+                self._speaking = None
+
+    def _on_word(self, name, location, length):
+        with self._lock:
+            stale = self._speaking != self._utterance or self.muted
+        if stale:
+            self._interrupt()
+
+    def begin(self, on_start=None) -> int:
+        """
+        Start a new utterance, cutting off whatever is being spoken.
+        `on_start` is called when its first sentence starts playing.
+        """
+        with self._lock:
+            self._utterance += 1
+            self._splitter = SentenceSplitter()
+            self._on_start = on_start
+            self._drain()
+            if self._thread is not None:
+                self._queue.put(STOP)
+            return self._utterance
+
+    def feed(self, text: str, utterance: int = None):
+        """Queue every sentence completed by this chunk of streamed text."""
+        with self._lock:
+            if self.muted or (utterance is not None and utterance != self._utterance):
+                return
+            sentences = self._splitter.feed(text)
+            self._enqueue(sentences)
+
+    def flush(self, utterance: int = None):
+        """Queue the trailing partial sentence once the response is finished."""
+        with self._lock:
+            if self.muted or (utterance is not None and utterance != self._utterance):
+                return
+            self._enqueue(self._splitter.flush())
+
+    def speak(self, text: str) -> int:
+        """Speak a complete text from the start."""
+        utterance = self.begin()
+        self.feed(text, utterance)
+        self.flush(utterance)
+        return utterance
+
+    def stop(self):
+        """Stop speaking and discard queued sentences."""
+        self.begin()
+
+    def cancel(self, utterance: int):
+        """Stop only if `utterance` is still the one being spoken."""
+        if utterance == self._utterance:
+            self.stop()
+
+    def mute(self):
+        self.muted = True
+        self.stop()
+
+    def unmute(self):
+        self.muted = False
+
+    @property
+    def is_speaking(self) -> bool:
+        return self._engine is not None and self._engine.isBusy()
+
+    def _enqueue(self, sentences):
+        if sentences:
+            self._ensure_worker()
+        for sentence in sentences:
+            self._queue.put((self._utterance, sentence))
+
+    def _drain(self):
+        try:
+            while True:
+                self._queue.get_nowait()
+        except queue.Empty:
+            pass
+
+    def _interrupt(self):
+        engine = self._engine
+        if engine is not None:
+            try:
+                engine.stop()
+            except Exception as e:
+                print(f"[DEBUG] TTS stop error: {e}")
+
+
+_default_pipeline = None
+_default_lock = threading.Lock()
+
+
+def get_speech_pipeline() -> SpeechPipeline:
+    """Process-wide speech pipeline (there is only one audio device)."""
+    global _default_pipeline
+    with _default_lock:
+        if _default_pipeline is None:
+            _default_pipeline = SpeechPipeline()
+        return _default_pipeline